@@ -0,0 +1,382 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+End-to-end load test of linkbot.py against local Slack, Jira and ServiceNow
+
+Starts the stubs in benchmarks.stubs, runs linkbot.py configured by
+linkconfig_example.py to use them, replays signed message events at a
+controlled rate and reports event throughput, ack and reply latency
+percentiles and backend calls per event, compared with a stored
+baseline.  Run from the repository root:
+
+    $ python -m benchmarks.load [--events N] [--rate N] [--async]
+          [--idp] [--processes N] [--retry-rate F] [--progressive]
+          [--corpus requests.jsonl]
+          [--save-baseline]
+
+A baseline only compares runs on the same machine; refresh it with
+--save-baseline before measuring a change.
+"""
+from benchmarks.match_index import make_corpus
+from benchmarks.stubs import (
+    StubConfig, StubServers, SlackStub, JiraStub, IdpStub, ServiceNowStub)
+from tornado.testing import bind_unused_port
+from random import Random
+import aiohttp
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'load_baseline.json')
+SIGNING_SECRET = 'benchmark-signing-secret'
+
+# metric: True if larger is better
+METRICS = {
+    'events_per_sec': True,
+    'ack_p50_ms': False,
+    'ack_p95_ms': False,
+    'ack_p99_ms': False,
+    'reply_p50_ms': False,
+    'reply_p95_ms': False,
+    'reply_p99_ms': False,
+    'backend_calls_per_event': False,
+    'slack_calls_per_event': False,
+}
+
+
+def load_corpus(path, count):
+    """
+    Return count message texts from path, a file of JSON lines with a
+    'text' or 'body' key, or of plain text lines, or a synthetic corpus
+    """
+    if not path:
+        return make_corpus(count)
+
+    texts = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+                texts.append(data.get('text') or data.get('body', ''))
+            except ValueError:
+                texts.append(line)
+
+    return [texts[n % len(texts)] for n in range(count)]
+
+
+def event_request(n, text):
+    """
+    Return the body and signed headers of message event n
+    """
+    now = time.time()
+    body = json.dumps({
+        'token': 'benchmark',
+        'team_id': 'T0BENCH',
+        'api_app_id': 'A0BENCH',
+        'type': 'event_callback',
+        'event_id': 'Ev{:08d}'.format(n),
+        'event_time': int(now),
+        'event': {
+            'type': 'message',
+            'channel': channel(n),
+            'channel_type': 'channel',
+            'user': 'U0USER',
+            'text': text,
+            'ts': '{:.6f}'.format(now),
+            'event_ts': '{:.6f}'.format(now),
+            'client_msg_id': 'bench-{:08d}'.format(n)},
+        'authorizations': [{
+            'team_id': 'T0BENCH', 'user_id': 'U0BENCH', 'is_bot': True}],
+    })
+    timestamp = str(int(now))
+    signature = hmac.new(
+        SIGNING_SECRET.encode(),
+        'v0:{}:{}'.format(timestamp, body).encode(),
+        hashlib.sha256).hexdigest()
+    return body, {
+        'Content-Type': 'application/json',
+        'X-Slack-Request-Timestamp': timestamp,
+        'X-Slack-Signature': 'v0=' + signature}
+
+
+def channel(n):
+    # a channel per event ties each reply to its event
+    return 'CB{:08d}'.format(n)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+async def replay(url, corpus, rate, concurrency, retry_rate=0):
+    """
+    Post the corpus as events to url at rate events/sec (0 for as fast as
+    concurrency allows), redelivering retry_rate of them as Slack does
+    after a slow ack, returning the send time and ack latency of each
+    """
+    retries = Random(0)
+    semaphore = asyncio.Semaphore(concurrency)
+    sent = [None] * len(corpus)
+    acks = [None] * len(corpus)
+    start = time.monotonic()
+
+    async def send(session, n, text):
+        if rate:
+            await asyncio.sleep(max(0, start + n / rate - time.monotonic()))
+        async with semaphore:
+            body, headers = event_request(n, text)
+            sent[n] = time.monotonic()
+            try:
+                async with session.post(url, data=body,
+                                        headers=headers) as response:
+                    await response.read()
+                    if response.status == 200:
+                        acks[n] = time.monotonic() - sent[n]
+                if retries.random() < retry_rate:
+                    headers.update({'X-Slack-Retry-Num': '1',
+                                    'X-Slack-Retry-Reason': 'http_timeout'})
+                    async with session.post(url, data=body,
+                                            headers=headers) as response:
+                        await response.read()
+            except aiohttp.ClientError:
+                pass
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[send(session, n, text)
+                               for n, text in enumerate(corpus)])
+
+    return sent, acks
+
+
+def wait_for_port(port, process, timeout=30, interval=0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('linkbot exited with {}'.format(
+                process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(interval)
+
+    raise RuntimeError('linkbot did not listen on {}'.format(port))
+
+
+def free_port():
+    sock, port = bind_unused_port()
+    sock.close()
+    return port
+
+
+def linkbot_env(args, slack, jira, servicenow, idp, workdir):
+    """
+    Return the environment for linkbot.py run from workdir with
+    linkconfig_example.py pointed at the stubs
+    """
+    if os.path.exists(os.path.join(ROOT, 'linkconfig.py')):
+        print('warning: {} shadows the benchmark configuration'.format(
+            os.path.join(ROOT, 'linkconfig.py')), file=sys.stderr)
+
+    shutil.copy(os.path.join(ROOT, 'linkconfig_example.py'),
+                os.path.join(workdir, 'linkconfig.py'))
+    env = dict(
+        os.environ,
+        PYTHONPATH=workdir,
+        PORT=str(free_port()),
+        METRICS_PORT=str(free_port()),
+        SLACK_BOT_TOKEN='xoxb-benchmark',
+        SLACK_SIGNING_SECRET=SIGNING_SECRET,
+        SLACK_API_URL=slack.url + 'api/',
+        JIRA_HOST=jira.url.rstrip('/'),
+        UW_SAML_CREDENTIALS="('benchmark', 'benchmark')",
+        SERVICE_NOW_HOST=servicenow.url.rstrip('/'),
+        SERVICE_NOW_CREDENTIALS="('benchmark', 'benchmark')",
+        ASYNC_MODE='true' if args.async_mode else 'false',
+        PROCESSES=str(args.processes),
+        PROGRESSIVE_REPLIES='true' if args.progressive else 'false')
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    if args.processes > 1:
+        env['PROMETHEUS_MULTIPROC_DIR'] = os.path.join(workdir, 'metrics')
+        os.mkdir(env['PROMETHEUS_MULTIPROC_DIR'])
+    if idp:
+        env['SAML_IDP'] = idp.url
+
+    return env
+
+
+def start_linkbot(args, slack, jira, servicenow, idp, workdir,
+                  interval=0.1):
+    """
+    Run linkbot.py with linkconfig_example.py pointed at the stubs,
+    returning once it listens
+    """
+    env = linkbot_env(args, slack, jira, servicenow, idp, workdir)
+    port = int(env['PORT'])
+    log = open(os.path.join(workdir, 'linkbot.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'linkbot.py')],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port, process, interval=interval)
+    except Exception:
+        process.kill()
+        raise
+
+    return process, port
+
+
+def run(args):
+    config = StubConfig(args.latency, args.error_rate)
+    servers = StubServers()
+    slack = servers.add(SlackStub(StubConfig(args.slack_latency, 0),
+                                  rate_limit=args.slack_rate_limit))
+    idp = servers.add(IdpStub(config)) if args.idp else None
+    jira = servers.add(JiraStub(config, idp_url=idp and idp.url),
+                       host='localhost')
+    servicenow = servers.add(ServiceNowStub(config))
+    if idp:
+        idp.acs_url = jira.url + 'Shibboleth.sso/SAML2/POST'
+    servers.start()
+
+    workdir = tempfile.mkdtemp(prefix='linkbot-load-')
+    process, port = start_linkbot(args, slack, jira, servicenow, idp,
+                                  workdir)
+    try:
+        corpus = load_corpus(args.corpus, args.events)
+        start = time.monotonic()
+        sent, acks = asyncio.run(replay(
+            'http://127.0.0.1:{}/slack/events'.format(port), corpus,
+            args.rate, args.concurrency, args.retry_rate))
+
+        # wait for replies to stop arriving
+        replies = 0
+        while True:
+            time.sleep(args.settle)
+            count = sum(len(r) for r in slack.replies.values())
+            if count == replies:
+                break
+            replies = count
+    finally:
+        process.terminate()
+        process.wait()
+        servers.stop()
+
+    acked = [ack for ack in acks if ack is not None]
+    reply_latency = []
+    for n in range(len(corpus)):
+        times = slack.replies.get(channel(n))
+        if times and sent[n]:
+            reply_latency.append(min(times) - sent[n])
+
+    last_ack = max(s + a for s, a in zip(sent, acks) if a is not None)
+    backend = jira.total() + servicenow.total()
+    results = {
+        'events': len(corpus),
+        'acked': len(acked),
+        'replies': replies,
+        'events_per_sec': round(len(acked) / (last_ack - start), 1),
+        'backend_calls_per_event': round(backend / len(corpus), 3),
+        'slack_calls_per_event': round(slack.total() / len(corpus), 3),
+        'slack_rate_limited': slack.throttled,
+        'idp_logins': idp.logins if idp else 0,
+    }
+    for name, values in [('ack', acked), ('reply', reply_latency)]:
+        for pct in (50, 95, 99):
+            value = percentile(values, pct)
+            results['{}_p{}_ms'.format(name, pct)] = (
+                None if value is None else round(value * 1000, 2))
+
+    print('linkbot log: {}'.format(os.path.join(workdir, 'linkbot.log')))
+    return results
+
+
+def compare(results, baseline, max_regression, metrics=METRICS):
+    """
+    Print results against baseline, returning the metrics that regressed
+    by more than max_regression
+    """
+    regressed = []
+    print('{:<26} {:>12} {:>12} {:>9}'.format(
+        'metric', 'baseline', 'current', 'change'))
+    for name, value in results.items():
+        base = baseline.get(name)
+        change = ''
+        if isinstance(base, (int, float)) and base and value is not None:
+            delta = (value - base) / float(base)
+            change = '{:+.1%}'.format(delta)
+            if name in metrics and (
+                    -delta if metrics[name] else delta) > max_regression:
+                regressed.append(name)
+                change += ' !'
+        print('{:<26} {:>12} {:>12} {:>9}'.format(
+            name, str(base), str(value), change))
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=200,
+                        help='events/sec, 0 for unthrottled')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--corpus', help='JSON lines or text file')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Jira and ServiceNow stub latency seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--slack-latency', type=float, default=0.02)
+    parser.add_argument('--slack-rate-limit', type=float, default=0,
+                        help='posts/sec/channel past which Slack says 429')
+    parser.add_argument('--retry-rate', type=float, default=0.0,
+                        help='fraction of events redelivered')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds without replies that end a run')
+    parser.add_argument('--async', dest='async_mode', action='store_true')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='pre-forked linkbot processes')
+    parser.add_argument('--progressive', action='store_true',
+                        help='post plain links, then update them')
+    parser.add_argument('--idp', action='store_true',
+                        help='put the Jira stub behind a fake IdP')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if compare(results, baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Micro-benchmark comparing per-bot message scanning with util.matcher
+
+Also measures the matcher's literal prefilter on chatter where few
+messages mention a link: the fraction of messages it rejects before
+any regex runs and the CPU time that saves.  Run from the repository
+root:
+
+    $ python -m benchmarks.match_index [--messages N] [--repeat N]
+          [--link-rate F]
+"""
+from linkbots import LinkBot
+from util.matcher import MatchIndex
+from random import Random
+import argparse
+import time
+import timeit
+
+
+SERVICENOW_MATCH = '(CHG|CTASK|INC|ITASK|PRB|PTASK|REQ|RTASK)[0-9]{7,}'
+JIRA_MATCH = r'[A-Z]{3,}\-[0-9]+'
+CHATTER = [
+    'has anyone looked at the deploy yet?',
+    'lunch in ten minutes',
+    'the build is green again, thanks all',
+    'can you take a look at {}?',
+    'I think {} is related to {}',
+    'rolling back, see {} for details',
+    'paging on-call about the outage',
+    'merged, should go out with the next release',
+]
+QUIET_CHATTER = [
+    'good morning!',
+    'standup in 5',
+    'who is on-call this week?',
+    'the wiki page is out of date, I will fix it',
+    'thanks, that worked',
+    'can someone review my PR when they get a chance?',
+    'I am out tomorrow afternoon',
+    'restarting the app servers now',
+    'looks like a DNS issue to me',
+    'meeting moved to 2:30',
+    'did the nightly backup finish?',
+    'ack',
+    'sounds good :+1:',
+    'the vendor says the fix ships in 4.2',
+    'coffee run, anyone?',
+    'error rate is back to normal',
+    'I updated the runbook with the new steps',
+    'we should talk about this at retro',
+    'is the staging db up?',
+    'heads up: maintenance window tonight 10-11pm',
+]
+
+
+def make_bots(count):
+    confs = [{'MATCH': SERVICENOW_MATCH}, {'MATCH': JIRA_MATCH}]
+    confs += [{'MATCH': 'kb{}[0-9]+'.format(n)} for n in range(count)]
+    return [LinkBot(conf) for conf in confs[:count]]
+
+
+def make_corpus(count, seed=0):
+    rand = Random(seed)
+    labels = ['INC{:07d}'.format(n) for n in range(50)]
+    labels += ['LINK-{}'.format(n) for n in range(50)]
+    labels += ['kb{}{}'.format(n % 10, n) for n in range(50)]
+    corpus = []
+    for _ in range(count):
+        chatter = rand.choice(CHATTER)
+        corpus.append(chatter.format(
+            *[rand.choice(labels) for _ in range(chatter.count('{}'))]))
+    return corpus
+
+
+def make_chatter(count, link_rate, seed=0):
+    """Return count messages, link_rate of them mentioning links."""
+    rand = Random(seed)
+    links = make_corpus(count, seed)
+    return [links[n] if rand.random() < link_rate
+            else rand.choice(QUIET_CHATTER) for n in range(count)]
+
+
+def per_bot(bot_list, corpus):
+    for text in corpus:
+        for bot in bot_list:
+            if bot.match_regex().search(text):
+                bot.match(text)
+
+
+def indexed(index, corpus):
+    for text in corpus:
+        index.match(text)
+
+
+def cpu_time(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat,
+                             timer=time.process_time))
+
+
+def prefiltered(args):
+    corpus = make_chatter(args.messages, args.link_rate)
+    print('\nchatter with {:.0%} link messages'.format(args.link_rate))
+    print('{:>5} {:>9} {:>14} {:>16} {:>10}'.format(
+        'bots', 'rejected', 'regex msg/s', 'prefilter msg/s', 'cpu saved'))
+    for count in [1, 2, 4, 8, 16, 32]:
+        bot_list = make_bots(count)
+        index = MatchIndex(bot_list)
+        plain = MatchIndex(bot_list, prefilter=False)
+        rejected = sum(map(index.rejects, corpus)) / float(len(corpus))
+        slow = cpu_time(lambda: indexed(plain, corpus), args.repeat)
+        fast = cpu_time(lambda: indexed(index, corpus), args.repeat)
+        print('{:>5} {:>9.1%} {:>14.0f} {:>16.0f} {:>10.1%}'.format(
+            count, rejected, len(corpus) / slow, len(corpus) / fast,
+            1 - fast / slow))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--link-rate', type=float, default=0.05,
+                        help='fraction of chatter mentioning links')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages)
+    print('{:>5} {:>14} {:>14} {:>8}'.format(
+        'bots', 'per-bot msg/s', 'index msg/s', 'speedup'))
+    for count in [1, 2, 4, 8, 16, 32]:
+        bot_list = make_bots(count)
+        index = MatchIndex(bot_list)
+        slow = min(timeit.repeat(lambda: per_bot(bot_list, corpus),
+                                 number=1, repeat=args.repeat))
+        fast = min(timeit.repeat(lambda: indexed(index, corpus),
+                                 number=1, repeat=args.repeat))
+        print('{:>5} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(
+            count, len(corpus) / slow, len(corpus) / fast, slow / fast))
+
+    prefiltered(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmark Jira and ServiceNow record payloads, decoding and memory
+
+Compares the payload bytes, decode time and memory per cached record
+of linkbot's field-projected JiraIssue and slotted ServiceNowRecord
+against the full issues and dict-backed records it used to keep.  The
+payloads are modelled by benchmarks.stubs.  Run from the repository
+root:
+
+    $ python -m benchmarks.records [--records N] [--number N]
+"""
+from benchmarks.stubs import jira_issue
+from linkbots.jirabot import JiraIssue
+from linkbots.servicenowbot import ServiceNowRecord
+from collections.abc import Mapping
+from types import SimpleNamespace
+import argparse
+import gc
+import json
+import timeit
+import tracemalloc
+
+
+def servicenow_result(number):
+    link = 'https://servicenow.example.com/api/now/table/sys_user/{}'
+    return {
+        'short_description': 'Benchmark record {}'.format(number),
+        'number': number,
+        'parent': {'display_value': 'PRB0000001',
+                   'link': link.format('0123456789abcdef0123456789abcdef')},
+        'state': 'In Progress',
+        'assigned_to': {'display_value': 'Bench Assignee',
+                        'link': link.format('fedcba9876543210fedcba98765432')},
+        'opened_by': {'display_value': 'Bench Reporter',
+                      'link': link.format('00112233445566778899aabbccddeeff')},
+        'sys_updated_on': '2023-01-01 12:00:00'}
+
+
+def full_jira_issue(data):
+    """Decode an issue as linkbot did before JiraIssue."""
+    fields = SimpleNamespace(**data['fields'])
+    for subobject in ['status', 'reporter', 'assignee']:
+        objdict = getattr(fields, subobject, None)
+        if objdict:
+            setattr(fields, subobject, SimpleNamespace(**objdict))
+    return SimpleNamespace(fields=fields)
+
+
+class DictServiceNowRecord:
+    """ServiceNowRecord as it was before __slots__."""
+    def __init__(self, **kwargs):
+        self.__dict__ = kwargs
+
+    def display(self, field):
+        value = getattr(self, field)
+        if isinstance(value, Mapping) and 'display_value' in value:
+            value = value.get('display_value')
+        return value
+
+
+def cases():
+    """Return (name, payload, decode) tuples, before and after."""
+    servicenow = json.dumps({'result': [servicenow_result('INC0000001')]})
+    return [
+        ('jira before', json.dumps(jira_issue('ABC-1')), full_jira_issue),
+        ('jira after', json.dumps(jira_issue('ABC-1', JiraIssue.rendered)),
+         JiraIssue),
+        ('servicenow before', servicenow,
+         lambda data: DictServiceNowRecord(**data['result'][0])),
+        ('servicenow after', servicenow,
+         lambda data: ServiceNowRecord(**data['result'][0])),
+    ]
+
+
+def record_bytes(payload, decode, count):
+    """Return the bytes each of count records decoded from payload
+    holds, as a cache would.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    records = [decode(json.loads(payload)) for n in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del records
+    return used / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--records', type=int, default=10000,
+                        help='records held to measure memory')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='decodes timed')
+    args = parser.parse_args()
+
+    print('{:<18} {:>14} {:>14} {:>14}'.format(
+        '', 'payload bytes', 'decode us', 'record bytes'))
+    for name, payload, decode in cases():
+        seconds = min(timeit.repeat(
+            lambda: decode(json.loads(payload)), number=args.number,
+            repeat=3))
+        print('{:<18} {:>14} {:>14.1f} {:>14.0f}'.format(
+            name, len(payload), seconds / args.number * 1e6,
+            record_bytes(payload, decode, args.records)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmark IdP form extraction against the BeautifulSoup implementation
+
+The pages are modelled on the two forms the UW IdP serves during a
+login: the username/password page, and the auto-submitting page that
+posts the SAMLResponse back to the SP.  Run from the repository root
+(BeautifulSoup must be installed for the comparison):
+
+    $ python -m benchmarks.saml_form [--number N]
+"""
+from util.saml import UwSamlSession, IDP
+from base64 import b64encode
+from urllib.parse import urljoin
+import argparse
+import os
+import timeit
+import tracemalloc
+
+
+def login_page():
+    styles = ''.join('.c{0} {{ margin: {0}px; }}\n'.format(n)
+                     for n in range(400))
+    script = ''.join('var v{0} = "<form>{0}</form>";\n'.format(n)
+                     for n in range(200))
+    footer = ''.join('<li><a href="/help/{0}">Help &amp; topic {0}</a></li>'
+                     .format(n) for n in range(300))
+    return (
+        '<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">'
+        '<title>UW NetID sign-in</title><style>{styles}</style>'
+        '<script>{script}</script></head><body><div id="main">'
+        '<form id="idplogindiv" action="/idp/profile/SAML2/Redirect/SSO'
+        '?execution=e1s1&amp;_eventId_proceed=1" method="post">'
+        '<label for="weblogin_netid">UW NetID</label>'
+        '<input id="weblogin_netid" name="j_username" type="text">'
+        '<input id="weblogin_password" name="j_password" type="password">'
+        '<input type="hidden" name="_eventId_proceed" value="">'
+        '<input type="checkbox" name="donotcache" value="1" checked>'
+        '<input type="submit" value="Sign in">'
+        '</form></div><footer><ul>{footer}</ul></footer></body></html>'
+    ).format(styles=styles, script=script, footer=footer).encode()
+
+
+def saml_response_page():
+    assertion = b64encode(os.urandom(12000)).decode()
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html>'
+        '<html><body onload="document.forms[0].submit()"><noscript><p>'
+        '<strong>Note:</strong> Since your browser does not support '
+        'JavaScript, you must press the Continue button once to proceed.'
+        '</p></noscript><form action="https&#x3a;&#x2f;&#x2f;jira.example'
+        '.com&#x2f;Shibboleth.sso&#x2f;SAML2&#x2f;POST" method="post">'
+        '<div><input type="hidden" name="RelayState" value="ss&#x3a;mem'
+        '&#x3a;abc123"/><input type="hidden" name="SAMLResponse" '
+        'value="{}"/></div><noscript><div><input type="submit" '
+        'value="Continue"/></div></noscript></form></body></html>'
+    ).format(assertion).encode()
+
+
+def bs4_form_data(content):
+    """The BeautifulSoup extraction UwSamlSession._form_data replaced"""
+    from bs4 import BeautifulSoup
+
+    bs = BeautifulSoup(content, 'html.parser')
+    form = bs.find('form')
+    url = urljoin(IDP, form['action'])
+    data = {element['name']: element.get('value')
+            for element in form.find_all('input')
+            if element.get('name')}
+    return url, data
+
+
+def peak_memory(fn, content):
+    tracemalloc.start()
+    fn(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    print('{:<14} {:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'page', 'bytes', 'bs4 ms', 'parser ms', 'bs4 KiB', 'parser KiB'))
+    for name, content in [('login', login_page()),
+                          ('saml response', saml_response_page())]:
+        assert UwSamlSession._form_data(content) == bs4_form_data(content)
+        times = []
+        for fn in [bs4_form_data, UwSamlSession._form_data]:
+            times.append(min(timeit.repeat(
+                lambda: fn(content), number=args.number, repeat=3)))
+        print('{:<14} {:>8} {:>12.3f} {:>12.3f} {:>12.1f} {:>12.1f}'.format(
+            name, len(content),
+            1000 * times[0] / args.number, 1000 * times[1] / args.number,
+            peak_memory(bs4_form_data, content) / 1024,
+            peak_memory(UwSamlSession._form_data, content) / 1024))
+
+
+if __name__ == '__main__':
+    main()
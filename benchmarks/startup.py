@@ -0,0 +1,166 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Startup time of linkbot.py against local Slack, Jira and ServiceNow
+
+Times importing linkbot.py configured by linkconfig_example.py, checking
+that the import leaves the modules linkbot defers unloaded, then times
+running linkbot.py against the benchmarks.stubs servers until it
+listens and until it answers a first message, compared with a stored
+baseline.  Run from the repository root:
+
+    $ python -m benchmarks.startup [--runs N] [--async] [--save-baseline]
+
+A baseline only compares runs on the same machine; refresh it with
+--save-baseline before measuring a change.  The build workflow does,
+recording a baseline from the base commit before checking the change
+against it, and fails on a regression or a deferred module loaded.
+"""
+from benchmarks.load import (
+    ROOT, compare, channel, event_request, linkbot_env, percentile,
+    start_linkbot)
+from benchmarks.stubs import (
+    StubConfig, StubServers, SlackStub, JiraStub, ServiceNowStub)
+from urllib.request import Request, urlopen
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+BASELINE = os.path.join(ROOT, 'benchmarks', 'startup_baseline.json')
+
+# metric: True if larger is better
+METRICS = {
+    'import_ms': False,
+    'listen_ms': False,
+    'first_reply_ms': False,
+}
+
+# modules only ASYNC_MODE needs
+DEFERRED = ['aiohttp', 'slack_bolt.async_app', 'slack_sdk.web.async_client']
+
+IMPORT = '''
+import json, sys, time
+start = time.perf_counter()
+import linkbot
+print(json.dumps({{
+    'seconds': time.perf_counter() - start,
+    'loaded': [name for name in {} if name in sys.modules]}}))
+'''.format(DEFERRED)
+
+
+def time_import(env, workdir):
+    """
+    Return the seconds importing linkbot took in a fresh interpreter and
+    the deferred modules it loaded
+    """
+    env = dict(env, PYTHONPATH=os.pathsep.join([workdir, ROOT]))
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT], cwd=workdir, env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    result = json.loads(output.decode().splitlines()[-1])
+    return result['seconds'], result['loaded']
+
+
+def time_first_reply(args, slack, jira, servicenow, workdir, n):
+    """
+    Return the seconds from running linkbot.py to it listening and to it
+    replying to a message
+    """
+    start = time.monotonic()
+    process, port = start_linkbot(args, slack, jira, servicenow, None,
+                                  workdir, interval=0.005)
+    listen = time.monotonic() - start
+    try:
+        body, headers = event_request(n, 'see ABC-{} please'.format(n))
+        urlopen(Request('http://127.0.0.1:{}/slack/events'.format(port),
+                        data=body.encode(), headers=headers)).read()
+        deadline = time.monotonic() + 30
+        while not slack.replies.get(channel(n)):
+            if time.monotonic() > deadline:
+                raise RuntimeError('linkbot did not reply')
+            time.sleep(0.005)
+
+        return listen, min(slack.replies[channel(n)]) - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(args):
+    servers = StubServers()
+    slack = servers.add(SlackStub(StubConfig(args.slack_latency, 0)))
+    jira = servers.add(JiraStub(StubConfig(args.latency, 0)),
+                       host='localhost')
+    servicenow = servers.add(ServiceNowStub(StubConfig(args.latency, 0)))
+    servers.start()
+
+    workdir = tempfile.mkdtemp(prefix='linkbot-startup-')
+    imports, listens, replies, loaded = [], [], [], set()
+    try:
+        env = linkbot_env(args, slack, jira, servicenow, None, workdir)
+        for n in range(args.runs):
+            seconds, modules = time_import(env, workdir)
+            imports.append(seconds)
+            if not args.async_mode:
+                loaded.update(modules)
+
+        for n in range(args.runs):
+            listen, reply = time_first_reply(
+                args, slack, jira, servicenow, workdir, n)
+            listens.append(listen)
+            replies.append(reply)
+    finally:
+        servers.stop()
+
+    print('linkbot log: {}'.format(os.path.join(workdir, 'linkbot.log')))
+    if loaded:
+        print('deferred modules loaded: {}'.format(', '.join(
+            sorted(loaded))), file=sys.stderr)
+
+    return {
+        'runs': args.runs,
+        'import_ms': round(percentile(imports, 50) * 1000, 1),
+        'listen_ms': round(percentile(listens, 50) * 1000, 1),
+        'first_reply_ms': round(percentile(replies, 50) * 1000, 1),
+        'deferred_loaded': len(loaded),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Jira and ServiceNow stub latency seconds')
+    parser.add_argument('--slack-latency', type=float, default=0.02)
+    parser.add_argument('--async', dest='async_mode', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, default=0.25)
+    args = parser.parse_args()
+    args.processes = 1
+    args.progressive = False
+
+    results = run(args)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressed = compare(results, baseline, args.max_regression, METRICS)
+    if regressed or results['deferred_loaded']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Local stand-ins for the Slack Web API, Jira REST API (optionally behind
+a fake IdP) and ServiceNow table API, for offline load tests
+
+Each stub answers after a configurable latency and fails a configurable
+fraction of requests with a 503, and counts the requests it serves.
+"""
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+from urllib.parse import parse_qs, quote
+from html import escape
+from random import Random
+from threading import Event, Thread
+import asyncio
+import json
+import re
+import time
+
+
+class StubConfig(object):
+    """Latency in seconds, jittered +/-50%, and error rate of a stub."""
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+
+class StubHandler(RequestHandler):
+    def initialize(self, stub):
+        self.stub = stub
+
+    async def prepare(self):
+        self.stub.count(self.request.path)
+        if not await self.stub.delay():
+            self.set_status(503)
+            self.finish()
+
+    def write_json(self, data):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(data))
+
+    def log_exception(self, *args):
+        pass
+
+
+class Stub(object):
+    """A stub API served by a tornado Application."""
+    def __init__(self, config=None, seed=0):
+        self.config = config or StubConfig()
+        self.calls = {}
+        self._random = Random(seed)
+
+    def count(self, path):
+        key = self.call_name(path)
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    def call_name(self, path):
+        return path
+
+    def total(self):
+        return sum(self.calls.values())
+
+    async def delay(self):
+        """Sleep for the stub latency, returning False if the request
+        should fail.
+        """
+        if self.config.latency:
+            await asyncio.sleep(
+                self.config.latency * self._random.uniform(0.5, 1.5))
+
+        return self._random.random() >= self.config.error_rate
+
+    def handlers(self):
+        raise NotImplementedError
+
+    def application(self):
+        return Application([
+            (path, handler, {'stub': self})
+            for path, handler in self.handlers()])
+
+
+class SlackHandler(StubHandler):
+    def post(self, method):
+        body = self.stub.body(self.request)
+        if method == 'auth.test':
+            self.write_json({
+                'ok': True, 'url': 'https://bench.slack.com/',
+                'team': 'bench', 'user': 'linkbot', 'team_id': 'T0BENCH',
+                'user_id': 'U0BENCH', 'bot_id': 'B0BENCH'})
+        elif method == 'conversations.info':
+            channel = body.get('channel', '')
+            self.write_json({
+                'ok': True,
+                'channel': {'id': channel, 'name': 'bench-' + channel}})
+        elif method == 'conversations.list':
+            self.write_json({
+                'ok': True,
+                'channels': [{'id': 'C0BENCH', 'name': 'bench'}],
+                'response_metadata': {'next_cursor': ''}})
+        else:
+            if method in ('chat.postMessage', 'chat.update'):
+                retry_after = self.stub.rate_limited(body)
+                if retry_after:
+                    self.set_status(429)
+                    self.set_header('Retry-After', str(retry_after))
+                    self.write_json({'ok': False, 'error': 'ratelimited'})
+                    return
+                self.stub.reply(body)
+            elif method == 'chat.unfurl':
+                self.stub.unfurls.append(body)
+            self.write_json({'ok': True, 'channel': body.get('channel'),
+                             'ts': '{:.6f}'.format(time.time())})
+
+
+class SlackStub(Stub):
+    """Slack Web API, recording the time of each reply by channel.
+    With a rate_limit, posts faster than that many a second to one
+    channel are answered 429.
+    """
+    def __init__(self, config=None, seed=0, rate_limit=0):
+        super(SlackStub, self).__init__(config, seed)
+        self.replies = {}
+        self.unfurls = []
+        self.rate_limit = rate_limit
+        self.throttled = 0
+        self._posted = {}
+
+    def call_name(self, path):
+        return path.rsplit('/', 1)[-1]
+
+    def handlers(self):
+        return [(r'/api/([\w.]+)', SlackHandler)]
+
+    def rate_limited(self, body):
+        """Return the seconds to retry after if a post to body's
+        channel is too soon after the last, else 0.
+        """
+        if not self.rate_limit:
+            return 0
+
+        now = time.monotonic()
+        channel = body.get('channel')
+        wait = self._posted.get(channel, 0) + 1.0 / self.rate_limit - now
+        if wait > 0:
+            self.throttled += 1
+            return max(1, int(wait + 0.999))
+
+        self._posted[channel] = now
+        return 0
+
+    def reply(self, body):
+        self.replies.setdefault(body.get('channel'), []).append(
+            time.monotonic())
+
+    @staticmethod
+    def body(request):
+        if 'json' in request.headers.get('Content-Type', ''):
+            return json.loads(request.body or b'{}')
+
+        return {key: values[0]
+                for key, values in parse_qs(request.body.decode()).items()}
+
+
+def jira_person(name):
+    return {
+        'self': 'https://jira.example.com/rest/api/2/user?username=bench',
+        'name': 'bench', 'key': 'bench', 'emailAddress': 'bench@uw.edu',
+        'avatarUrls': {size: 'https://jira.example.com/secure/useravatar'
+                       '?size={}&avatarId=10122'.format(size)
+                       for size in ('48x48', '24x24', '16x16', '32x32')},
+        'displayName': name, 'active': True, 'timeZone': 'America/Los_Angeles'}
+
+
+def jira_issue(key, fields=None):
+    """
+    Return issue key as Jira's REST API does, with every field modelled
+    on a busy issue unless fields is a list of the fields to return
+    """
+    data = {
+        'summary': 'Benchmark issue {}'.format(key),
+        'status': {
+            'self': 'https://jira.example.com/rest/api/2/status/3',
+            'description': 'This issue is being actively worked on.',
+            'iconUrl': 'https://jira.example.com/images/icons/inprogress.png',
+            'name': 'In Progress', 'id': '3',
+            'statusCategory': {'id': 4, 'key': 'indeterminate',
+                               'colorName': 'yellow', 'name': 'In Progress'}},
+        'reporter': jira_person('Bench Reporter'),
+        'assignee': jira_person('Bench Assignee'),
+        'updated': '2023-01-01T12:00:00.000-0800',
+        'created': '2022-12-01T09:30:00.000-0800',
+        'description': 'Steps to reproduce the problem.\n' * 40,
+        'labels': ['benchmark', 'linkbot', 'triage'],
+        'comment': {'startAt': 0, 'maxResults': 8, 'total': 8, 'comments': [{
+            'author': jira_person('Bench Commenter'),
+            'body': 'Comment {} on the issue, with some detail.\n'.format(
+                n) * 8,
+            'created': '2022-12-{:02d}T10:00:00.000-0800'.format(n + 1)}
+            for n in range(8)]},
+    }
+    data.update({'customfield_{}'.format(10000 + n): 'Custom value {}'.format(
+        n) for n in range(30)})
+    if fields is not None:
+        data = {field: data[field] for field in fields if field in data}
+
+    return {'key': key, 'fields': data}
+
+
+class JiraHandler(StubHandler):
+    def get(self, key=None):
+        if not self.stub.logged_in(self):
+            return
+
+        fields = self.get_argument('fields', None)
+        fields = fields.split(',') if fields else None
+        if key:
+            self.write_json(jira_issue(key.upper(), fields))
+            return
+
+        jql = self.get_argument('jql', '')
+        keys = re.findall(r'[\w-]+', jql.partition('(')[2])
+        start = int(self.get_argument('startAt', 0))
+        limit = int(self.get_argument('maxResults', 50))
+        self.write_json({
+            'startAt': start, 'total': len(keys),
+            'issues': [jira_issue(k.upper(), fields)
+                       for k in keys[start:start + limit]]})
+
+
+class JiraInfoHandler(StubHandler):
+    def get(self):
+        if self.stub.logged_in(self):
+            self.write_json({'baseUrl': self.stub.url, 'version': '9.4.0'})
+
+
+class JiraStub(Stub):
+    """Jira REST API.  With idp_url, requests without a session cookie
+    are redirected to the IdP stub to log in.
+    """
+    cookie = 'BENCHSESSION'
+
+    def __init__(self, config=None, seed=0, idp_url=None):
+        super(JiraStub, self).__init__(config, seed)
+        self.idp_url = idp_url
+        self.url = None
+
+    def call_name(self, path):
+        return path.rsplit('/', 1)[-1] if path.endswith(
+            ('/search', '/serverInfo')) else 'issue'
+
+    def handlers(self):
+        return [
+            (r'/rest/api/latest/search', JiraHandler),
+            (r'/rest/api/latest/serverInfo', JiraInfoHandler),
+            (r'/rest/api/latest/issue/([\w-]+)', JiraHandler),
+            (r'/Shibboleth.sso/SAML2/POST', AcsHandler)]
+
+    def logged_in(self, handler):
+        if not self.idp_url or handler.get_cookie(self.cookie):
+            return True
+
+        handler.redirect('{}idp/profile/SAML2/Redirect/SSO?target={}'.format(
+            self.idp_url, quote(handler.request.full_url(), safe='')))
+        return False
+
+
+class AcsHandler(RequestHandler):
+    def initialize(self, stub):
+        self.stub = stub
+
+    def post(self):
+        self.set_cookie(self.stub.cookie, 'bench')
+        self.redirect(self.get_body_argument('RelayState'))
+
+
+class IdpHandler(StubHandler):
+    def get(self):
+        self.write(self.stub.form(
+            '/idp/profile/SAML2/Redirect/SSO?execution=e1s1', {
+                'j_username': '', 'j_password': '',
+                'target': self.get_argument('target')}))
+
+    def post(self):
+        if self.get_body_argument('j_username', None) is None:
+            self.set_status(400)
+            return
+
+        self.stub.logins += 1
+        self.write(self.stub.form(
+            self.stub.acs_url, {
+                'SAMLResponse': 'YmVuY2g=',
+                'RelayState': self.get_body_argument('target')}))
+
+
+class IdpStub(Stub):
+    """An IdP that accepts any credentials."""
+    def __init__(self, config=None, seed=0):
+        super(IdpStub, self).__init__(config, seed)
+        self.acs_url = None
+        self.logins = 0
+
+    def handlers(self):
+        return [(r'/idp/profile/SAML2/Redirect/SSO', IdpHandler)]
+
+    @staticmethod
+    def form(action, inputs):
+        return '<html><body><form action="{}" method="post">{}</form>' \
+            '</body></html>'.format(escape(action), ''.join(
+                '<input type="hidden" name="{}" value="{}">'.format(
+                    escape(name), escape(value))
+                for name, value in inputs.items()))
+
+
+class ServiceNowHandler(StubHandler):
+    def get(self, table):
+        query = self.get_argument('sysparm_query', '')
+        if query.startswith('numberIN'):
+            numbers = query[len('numberIN'):].split(',')
+        else:
+            numbers = [query.partition('=')[2]]
+
+        self.write_json({'result': [{
+            'short_description': 'Benchmark record {}'.format(number),
+            'number': number.upper(),
+            'parent': '',
+            'state': 'In Progress',
+            'assigned_to': {'display_value': 'Bench Assignee'},
+            'opened_by': {'display_value': 'Bench Reporter'},
+            'sys_updated_on': '2023-01-01 12:00:00'} for number in numbers]})
+
+
+class ServiceNowStub(Stub):
+    """ServiceNow table API."""
+    def call_name(self, path):
+        return path.rsplit('/', 1)[-1]
+
+    def handlers(self):
+        return [(r'/api/now/table/(\w+)', ServiceNowHandler)]
+
+
+class StubServers(object):
+    """Serve stubs from a background thread, each on its own port of
+    the given host.
+    """
+    def __init__(self):
+        self._stubs = []
+        self._loop = None
+
+    def add(self, stub, host='127.0.0.1'):
+        sock, port = bind_unused_port()
+        stub.url = 'http://{}:{}/'.format(host, port)
+        self._stubs.append((stub, sock))
+        return stub
+
+    def start(self):
+        ready = Event()
+
+        def run():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self._loop = IOLoop.current()
+            for stub, sock in self._stubs:
+                HTTPServer(stub.application()).add_sockets([sock])
+            ready.set()
+            self._loop.start()
+
+        Thread(target=run, daemon=True, name='stubs').start()
+        ready.wait()
+
+    def stop(self):
+        if self._loop:
+            self._loop.add_callback(self._loop.stop)
@@ -18,6 +18,55 @@ Configuration:
       or
         LINK_CLASS - linkbots.LinkBot subclass
         plus other keys necessary to support class configuration
+      and optionally
+        NAME - a word naming the bot's shared cache, snapshot entry and
+        webhook route, needed to tell apart two bots of one LINK_CLASS
+    SLACK_API_URL - optionally send Web API calls somewhere other than
+        https://slack.com/api/, such as the benchmark stubs
+    ASYNC_MODE - optionally serve events on a single event loop with
+        Bolt's AsyncApp and non-blocking backend clients
+    METRICS_CHANNELS, METRICS_CHANNEL_LIMIT - optionally label message
+        metrics with only the listed channels, or the first LIMIT seen
+    EVENT_QUEUE_SIZE, EVENT_WORKERS - optionally size the queue of
+        message events awaiting lookups, past which replies are plain
+        links, and the number of workers taking from it
+    EVENT_DEDUPE_WINDOW - optionally set the seconds an event id is
+        remembered to drop Slack's redeliveries
+    CHANNEL_CACHE_SIZE, CHANNEL_CACHE_TTL - optionally bound the channel
+        name directory used to label metrics.  Subscribe the app to
+        channel_rename and group_rename events to keep names current
+    SLACK_POST_RATE, SLACK_POST_BURST - optionally set the replies a
+        second, and the burst of them, posted to any one channel.  Each
+        message's replies are joined into one post
+    PROCESSES - optionally serve events from this many pre-forked
+        processes, sharing lookups, channel names and slash command
+        state through SHARED_STORE, a sqlite file (a temporary one by
+        default).  Set PROMETHEUS_MULTIPROC_DIR to an empty directory
+        so metrics are reported across processes
+    SHARED_STORE_SIZE, SHARED_STORE_PURGE - optionally bound the values
+        SHARED_STORE keeps in each namespace, such as a bot's cache or
+        the event dedupe window, and set the seconds between purges of
+        expired values and those past the bound
+    UNFURL_LINKS - optionally unfurl pasted Jira /browse/ and ServiceNow
+        record URLs in one chat.unfurl per message rather than replying
+        to them.  Subscribe the app to link_shared events and add the
+        Jira and ServiceNow hosts to its unfurl domains
+    SNAPSHOT_FILE, SNAPSHOT_INTERVAL - optionally save the lookup caches
+        and channel names to this file every INTERVAL seconds (300 by
+        default), loading them back at startup so a restart starts warm
+    PROGRESSIVE_REPLIES, ENRICH_BUDGET - optionally reply to Jira and
+        ServiceNow links with the plain link at once, updating the reply
+        with the record's summary if its lookup finishes within BUDGET
+        seconds (5 by default).  Otherwise the plain link stays
+    DEBUG_SECRET - optionally serve a sampling profile of every thread at
+        /debug/profile?seconds=N, as collapsed stacks, to requests
+        bearing this secret as a bearer token
+    WEBHOOK_SECRET - optionally, in a LINKBOTS entry for jirabot or
+        servicenowbot, accept the backend's webhooks at
+        /webhooks/<bot NAME or name>, updating or evicting the cached records
+        they name, so a longer CACHE_TTL still shows current records.
+        Webhooks authenticate with the secret as a bearer token, basic
+        auth password or X-Hub-Signature sha256 HMAC of the body
 
 Run linkbot
 
@@ -27,11 +76,25 @@ Run linkbot
 """
 
 from slack_bolt import App
+from slack_sdk import WebClient
 from importlib import import_module
+from threading import Thread
 from util.slash_cmd import SlashCommand
-from util.metrics import metrics_server
+from util.channels import init_channel_directory
+from util.matcher import MatchIndex
+from util.metrics import init_metrics, metrics_server, metrics_reset
+from util.shared import init_shared_store
+from util.snapshot import Snapshot
+from util.startup import startup_listening
+from util.workers import init_lookup_pool
+from util.events import init_event_queue
+from util.replies import init_channel_limiter
+import util.channels
+import util.shared
 from util.endpoint import init_endpoint_server, endpoint_server
 import linkconfig
+import tempfile
+import asyncio
 import sys
 import os
 import logging
@@ -46,10 +109,48 @@ logging.basicConfig(level=logging.INFO,
 
 logger = logging.getLogger(__name__)
 
+# bound metrics label cardinality
+init_metrics(channels=getattr(linkconfig, 'METRICS_CHANNELS', None),
+             channel_limit=getattr(linkconfig, 'METRICS_CHANNEL_LIMIT', 100))
+
 # initialize slack API framework
-slack_app = App(
+async_mode = getattr(linkconfig, 'ASYNC_MODE', False)
+slack_options = {}
+if async_mode:
+    # the async stack pulls in aiohttp, so only import it if needed
+    from slack_bolt.async_app import AsyncApp as SlackApp
+    from slack_sdk.web.async_client import AsyncWebClient as SlackClient
+else:
+    SlackApp, SlackClient = App, WebClient
+
+    # check the token once listening rather than before, see warm()
+    slack_options['token_verification_enabled'] = False
+
+if getattr(linkconfig, 'SLACK_API_URL', None):
+    slack_options['client'] = SlackClient(
+        token=linkconfig.SLACK_BOT_TOKEN, base_url=linkconfig.SLACK_API_URL)
+
+slack_app = SlackApp(
     logger=logger,
-    ssl_check_enabled=False)
+    ssl_check_enabled=False,
+    **slack_options)
+
+# share state between pre-forked processes
+processes = getattr(linkconfig, 'PROCESSES', 1)
+shared_store = getattr(linkconfig, 'SHARED_STORE', None)
+if processes > 1 and not shared_store:
+    shared_store = os.path.join(
+        tempfile.mkdtemp(prefix='linkbot-'), 'shared.sqlite')
+
+if shared_store:
+    init_shared_store(
+        shared_store, size=getattr(linkconfig, 'SHARED_STORE_SIZE', 100000),
+        purge_interval=getattr(linkconfig, 'SHARED_STORE_PURGE', 60))
+
+# fan out backend lookups on a bounded worker pool, sized before the
+# bots open their backend connection pools
+init_lookup_pool(getattr(linkconfig, 'LOOKUP_WORKERS', 8),
+                 getattr(linkconfig, 'LOOKUP_HOST_LIMIT', 4))
 
 # import, initialize and register message event handlers for linkbots
 bot_list = []
@@ -66,9 +167,6 @@ for bot_conf in getattr(linkconfig, 'LINKBOTS', []):
 
         logger.info("loading {}: {}".format(bot.name(), bot.match_pattern()))
 
-        # add bot's message event handler
-        slack_app.message(bot.match_regex())(bot.send_message)
-
     except Exception as ex:
         logger.error(
             "Cannot load module {}: {}".format(module_name, ex))
@@ -76,33 +174,182 @@ for bot_conf in getattr(linkconfig, 'LINKBOTS', []):
 if len(bot_list) < 1:
     logger.warning("No linkbots configured")
 
+# acknowledge events at once, queueing their lookups
+init_event_queue(getattr(linkconfig, 'EVENT_QUEUE_SIZE', 1000),
+                 getattr(linkconfig, 'EVENT_WORKERS', 8),
+                 getattr(linkconfig, 'EVENT_DEDUPE_WINDOW', 600),
+                 store=util.shared.shared_store)
+
+# keep each channel's replies within slack's rate limit
+init_channel_limiter(getattr(linkconfig, 'SLACK_POST_RATE', 1.0),
+                     getattr(linkconfig, 'SLACK_POST_BURST', 3))
+
+# scan each message once for every bot's links
+unfurl_links = getattr(linkconfig, 'UNFURL_LINKS', False)
+progressive = getattr(linkconfig, 'ENRICH_BUDGET', 5) if getattr(
+    linkconfig, 'PROGRESSIVE_REPLIES', False) else None
+match_index = MatchIndex(bot_list, unfurl=unfurl_links,
+                         progressive=progressive)
+
+# keep channel names for metrics without waiting on slack
+init_channel_directory(getattr(linkconfig, 'CHANNEL_CACHE_SIZE', 10000),
+                       getattr(linkconfig, 'CHANNEL_CACHE_TTL', 3600),
+                       store=util.shared.shared_store)
+
+# prepare linkbot slash command
+slash_cmd = SlashCommand(bot_list=bot_list, logger=logger,
+                         store=util.shared.shared_store)
+
 
 # flag bot-generated messages
-@slack_app.middleware
 def message_filter(payload, context, next):
     context['is_bot_message'] = payload.get('bot_id') is not None
     next()
 
 
-@slack_app.event({"type": "message"})
+# pick up slash command state set by other processes
+def sync_state(next):
+    slash_cmd.sync()
+    next()
+
+
 def unmatched_request(logger, body):
     logger.debug("acknowleding unmatched message")
 
 
-# prepare linkbot slash command
-slash_cmd = SlashCommand(bot_list=bot_list, logger=logger)
-slack_app.command("/{}".format(slash_cmd.name))(slash_cmd.command)
+async def async_message_filter(payload, context, next):
+    context['is_bot_message'] = payload.get('bot_id') is not None
+    await next()
+
+
+async def async_sync_state(next):
+    slash_cmd.sync()
+    await next()
+
+
+async def async_unmatched_request(logger, body):
+    logger.debug("acknowleding unmatched message")
+
+
+def channel_rename(event):
+    util.channels.channel_directory.rename(
+        event['channel']['id'], event['channel']['name'])
+
+
+async def async_channel_rename(event):
+    channel_rename(event)
+
+
+if async_mode:
+    slack_app.middleware(async_message_filter)
+    slack_app.middleware(async_sync_state)
+    slack_app.message()(match_index.async_send_message)
+    slack_app.event({"type": "message"})(async_unmatched_request)
+    slack_app.event("channel_rename")(async_channel_rename)
+    slack_app.event("group_rename")(async_channel_rename)
+    slack_app.command("/{}".format(slash_cmd.name))(slash_cmd.async_command)
+    if unfurl_links:
+        slack_app.event("link_shared")(match_index.async_unfurl)
+else:
+    slack_app.middleware(message_filter)
+    slack_app.middleware(sync_state)
+    slack_app.message()(match_index.send_message)
+    slack_app.event({"type": "message"})(unmatched_request)
+    slack_app.event("channel_rename")(channel_rename)
+    slack_app.event("group_rename")(channel_rename)
+    slack_app.command("/{}".format(slash_cmd.name))(slash_cmd.command)
+    if unfurl_links:
+        slack_app.event("link_shared")(match_index.unfurl)
+
+# accept backend webhooks keeping the bots' caches current
+webhooks = {}
+for bot in bot_list:
+    if bot.webhook_secret:
+        if not bot.webhooks:
+            logger.warning("{} has no webhooks".format(bot.name()))
+        elif bot.route() in webhooks:
+            logger.error("{} webhooks need a NAME apart from {}'s".format(
+                bot.namespace(), webhooks[bot.route()].namespace()))
+        else:
+            webhooks[bot.route()] = bot
+
+# restart with the caches and channel names of the last run
+snapshot = None
+if getattr(linkconfig, 'SNAPSHOT_FILE', None):
+    snapshot = Snapshot(linkconfig.SNAPSHOT_FILE,
+                        getattr(linkconfig, 'SNAPSHOT_INTERVAL', 300))
 
 # prepare slack event endpoint
-init_endpoint_server(slack_app)
+init_endpoint_server(slack_app, async_mode=async_mode, webhooks=webhooks,
+                     debug_secret=getattr(linkconfig, 'DEBUG_SECRET', None))
 
 if __name__ == '__main__':
-    try:
+    def supervise():
         # open metrics exporter endpoint
         metrics_server(int(os.environ.get('METRICS_PORT', 9100)))
 
+    def warm(name, connect):
+        # connect to slack and the bots' backends ahead of the first event
+        try:
+            connect()
+        except Exception as ex:
+            logger.error("warm {}: {}".format(name, ex))
+
+    async def async_warm(name, connect):
+        try:
+            await connect()
+        except Exception as ex:
+            logger.error("warm {}: {}".format(name, ex))
+
+    def restore():
+        # caches are shared through the store, so one process will do
+        caches = {bot.namespace(): bot.cache for bot in bot_list
+                  if bot.cache is not None}
+        try:
+            snapshot.load(caches, util.channels.channel_directory)
+        except Exception as ex:
+            logger.error("snapshot: {}".format(ex))
+
+        snapshot.start(caches, util.channels.channel_directory)
+
+    def start(task_id):
+        startup_listening()
+        for name, connect in [('slack', slack_app.client.auth_test)] + [
+                (bot.name(), bot.async_warm if async_mode else bot.warm)
+                for bot in bot_list]:
+            if async_mode:
+                asyncio.ensure_future(async_warm(name, connect))
+            else:
+                Thread(target=warm, args=(name, connect), daemon=True,
+                       name='warm').start()
+
+        # warm channel names in the background, in one process when
+        # names are shared; the async app's client is bound to the event
+        # loop, so bulk loads use a blocking one
+        if task_id == 0:
+            util.channels.channel_directory.start(
+                WebClient(token=slack_app.client.token,
+                          base_url=slack_app.client.base_url) if async_mode
+                else slack_app.client)
+            if snapshot:
+                Thread(target=restore, daemon=True, name='snapshot').start()
+
+            # the store is shared, so one process purges it
+            if util.shared.shared_store is not None:
+                util.shared.shared_store.start()
+
+    try:
+        if processes > 1 and not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            logger.warning("metrics will only report one of {} processes "
+                           "without PROMETHEUS_MULTIPROC_DIR".format(
+                               processes))
+
+        metrics_reset()
+
         # open slack event endpoint
-        endpoint_server(int(os.environ.get("PORT", 3000)))
+        endpoint_server(int(os.environ.get("PORT", 3000)),
+                        processes=processes, supervise=supervise,
+                        start=start)
     except Exception as e:
         logger.exception(e)
         logger.critical(e)
@@ -6,10 +6,26 @@
 """
 Class implementing linkbot matching and reporting
 """
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
 from random import choice
-from util import channel_name
-from util.metrics import metrics_counter
+from util.cache import LookupCache
+from util.events import SeenEvents
+from util.flight import SingleFlight
+from util.http import CircuitOpenError
+from util.metrics import (
+    metrics_lookup_time, metrics_suppressed, metrics_webhook_update)
+from util.replies import post_replies, async_post_replies
+from util.workers import submit_lookup, chain_future, await_lookup
+import util.shared
+import asyncio
+import logging
 import re
+import time
+
+
+logger = logging.getLogger(__name__)
 
 
 class LinkBot(object):
@@ -33,42 +49,510 @@ class LinkBot(object):
     ]
     default_match = r'_THIS_COULD_BE_OVERRIDDEN_'
 
+    # conf keys the bot can't work without
+    required = ('MATCH',)
+
+    # True if the bot reads its backend's webhooks, see webhook_updates()
+    webhooks = False
+
+    # True if message() adds a summary looked up from the backend to
+    # plain_message(), see summary()
+    enriches = False
+
+    # lookup cache settings, overridden by CACHE_* conf keys.  subclasses
+    # opt into caching their backend lookups with a non-zero cache_ttl
+    cache_ttl = 0
+    cache_size = 1024
+    cache_negative_ttl = 30
+    cache_stale_ttl = 60
+
+    # seconds a label expanded in a channel or thread isn't expanded there
+    # again, overridden by the SUPPRESS_WINDOW conf key.  0 disables
+    suppress_window = 0
+    suppress_size = 10000
+
     def __init__(self, conf):
+        missing = [key for key in self.required if not conf.get(key)]
+        if missing:
+            raise ValueError("missing {}".format(', '.join(missing)))
+
         self._conf = conf
+        self._host = conf.get('HOST')
         match = conf.get('MATCH', self.default_match)
+        self._match = match
         self._regex = re.compile(r'(\A|\W)+({})'.format(match), flags=re.I)
         self._quips = conf.get('QUIPS', self.QUIPS)
         self._link = conf.get('LINK', '{}|{}')
         self._quiplist = []
         self._do_quip = True
+        self._flight = SingleFlight(self.name())
+        self._cache = None
+        cache_ttl = conf.get('CACHE_TTL', self.cache_ttl)
+        if cache_ttl:
+            self._cache = LookupCache(
+                self.name(),
+                size=conf.get('CACHE_SIZE', self.cache_size),
+                ttl=cache_ttl,
+                negative_ttl=conf.get(
+                    'CACHE_NEGATIVE_TTL', self.cache_negative_ttl),
+                stale_ttl=conf.get('CACHE_STALE_TTL', self.cache_stale_ttl),
+                store=util.shared.shared_store,
+                namespace=self.namespace())
+
+        self._expanded = None
+        suppress_window = conf.get('SUPPRESS_WINDOW', self.suppress_window)
+        if suppress_window:
+            self._expanded = SeenEvents(
+                window=suppress_window,
+                size=conf.get('SUPPRESS_SIZE', self.suppress_size),
+                store=util.shared.shared_store,
+                namespace='{} expanded'.format(self.namespace()))
 
     def name(self):
         return "linkbot ({})".format(self.match_pattern())
 
+    def namespace(self):
+        """Return the name this bot's shared records and snapshot go by:
+        the NAME conf key, else name() qualified by HOST, so bots of one
+        class on different hosts keep apart."""
+        if self._conf.get('NAME'):
+            return self._conf['NAME']
+
+        if self._host:
+            return '{} {}'.format(self.name(), self._host)
+
+        return self.name()
+
+    def route(self):
+        """Return the path component of this bot's /webhooks/ route: the
+        NAME conf key, else name()."""
+        return self._conf.get('NAME') or self.name()
+
     def match_regex(self):
         return self._regex
 
     def match_pattern(self):
         return self._regex.pattern
 
+    def match_source(self):
+        return self._match
+
     def match(self, text):
         """Return a set of unique matches for text."""
         return set(match[1] for match in self._regex.findall(text))
 
-    def message(self, link_label):
+    def unsuppressed(self, matches, message):
+        """Return the matches not expanded within the suppression window
+        in message's channel or thread.
+        """
+        if self._expanded is None:
+            return list(matches)
+
+        place = (message.get('channel'), message.get('thread_ts'))
+        fresh = [match for match in matches
+                 if not self._expanded.recent(place + (match.upper(),))]
+        if len(fresh) < len(matches):
+            metrics_suppressed(self.name(), len(matches) - len(fresh))
+
+        return fresh
+
+    def expanded(self, matches, message):
+        """Remember matches as expanded in message's channel or thread,
+        once their replies are posted.
+        """
+        if self._expanded is not None and matches:
+            place = (message.get('channel'), message.get('thread_ts'))
+            self._expanded.seen(*[place + (match.upper(),)
+                                  for match in matches])
+
+    @property
+    def cache(self):
+        """The bot's LookupCache, or None if it doesn't cache lookups."""
+        return self._cache
+
+    @property
+    def webhook_secret(self):
+        return self._conf.get('WEBHOOK_SECRET')
+
+    def record_key(self, link_label):
+        """Return the key the backend knows link_label's record by.
+        Subclasses whose backend ignores case override this.
+        """
+        return link_label
+
+    def lookup(self, key, fetch):
+        """Return fetch(key), by way of the bot's cache if configured.
+        Concurrent lookups of a key share one fetch.
+        """
+        fetch = partial(self._flight.fetch, fetch)
+        key = self.record_key(key)
+        with self._timed_lookup():
+            if self._cache is not None:
+                return self._cache.get(key, fetch)
+
+            return fetch(key)
+
+    def lookup_many(self, keys, fetch_many):
+        """Return a dict of results for keys from fetch_many(keys), by way
+        of the bot's cache if configured.  fetch_many returns a tuple of
+        a dict of results by key and a list of the keys not found.
+        """
+        fetch_many = partial(self._flight.fetch_many, fetch_many)
+        records = {key: self.record_key(key) for key in keys}
+        with self._timed_lookup():
+            if self._cache is not None:
+                results = self._cache.get_many(
+                    list(dict.fromkeys(records.values())), fetch_many)
+            else:
+                results = fetch_many(list(dict.fromkeys(records.values())))[0]
+
+        return {key: results[record] for key, record in records.items()
+                if record in results}
+
+    def webhook_updates(self, payloads):
+        """Return a dict of the records the backend's webhook payloads
+        carry by record key, or None for a record that should be looked
+        up again.  Subclasses setting webhooks override this.
+        """
+        raise NotImplementedError
+
+    def invalidate(self, updates):
+        """Apply a dict of records by record key, or None to evict, to
+        the bot's cache, returning the number applied.  Records that
+        aren't cached are left for a lookup to fetch.
+        """
+        if self._cache is None:
+            return 0
+
+        updated = evicted = 0
+        for key, record in updates.items():
+            if record is None:
+                self._cache.evict(key)
+                evicted += 1
+            elif self._cache.replace(key, record):
+                updated += 1
+
+        metrics_webhook_update(self.name(), 'update', updated)
+        metrics_webhook_update(self.name(), 'evict', evicted)
+        return updated + evicted
+
+    def prefetch(self, matches):
+        """Return a dict of lookup results for matches, or None if the bot
+        looks up each match as its message is built.  Subclasses with a
+        batch lookup override this.
+        """
+        return None
+
+    def warm(self):
+        """Build the bot's backend client and connect to its HOST ahead
+        of the first lookup.  Subclasses with a backend override this.
+        """
+        pass
+
+    async def async_warm(self):
+        """Coroutine version of warm()."""
+        pass
+
+    def url_label(self, url):
+        """Return the label of the record url links to, or None if url
+        isn't one of the bot's links.  Subclasses that unfurl their
+        backend's links override this.
+        """
+        return None
+
+    def unfurl(self, link_label, record=None):
+        """Return the Slack attachment unfurling a link to link_label."""
+        return {'text': self.message(link_label, record)}
+
+    def unfurls(self, labels):
+        """Return a future of a dict of unfurl attachments by label for
+        labels, looked up in one batch on the lookup pool.
+        """
+        return submit_lookup(self._host, self._unfurls, list(labels))
+
+    def plain_message(self, link_label):
+        """Return message text for link_label without a backend lookup,
+        used when the bot's backend is failing.
+        """
         return self._message_text(self._link.format(link_label, link_label))
 
+    def message(self, link_label, record=None):
+        return self.plain_message(link_label)
+
+    def summary(self, link_label, record=None):
+        """Return the text message() adds to plain_message() for
+        link_label, looking up its record if need be.  Subclasses that
+        enrich override this.
+        """
+        return ''
+
     def send_message(self, message, context, say, client, logger):
         if context.get('is_bot_message'):
             logger.debug('Ignore bot message')
             return
 
-        for match in self.match(message.get('text', '')):
+        self.reply(self.unsuppressed(self.match(message.get('text', '')),
+                                     message),
+                   message, say, client, logger)
+
+    def reply(self, matches, message, say, client, logger):
+        """Post a response for the matches found in message."""
+        matches = list(matches)
+        self.post(self.replies(matches), message, say, client, logger,
+                  posted=partial(self._posted, matches, message))
+
+    def replies(self, matches):
+        """Return a list of futures of the message text for each of the
+        matches, in order.  Lookups for bots with a backend HOST are
+        fanned out on the lookup pool, batched by prefetch() when there
+        is more than one match.
+        """
+        return self._texts(matches, self._text, self.message)
+
+    def summaries(self, matches):
+        """Return a list of futures of the summary() of each of the
+        matches, in order, looked up as replies() does.
+        """
+        return self._texts(matches, self.summary, self.summary)
+
+    def plain_replies(self, matches):
+        """Return a list of completed futures of the plain message text
+        for each of the matches, for when lookups must be skipped.
+        """
+        texts = []
+        for match in matches:
+            text = Future()
+            try:
+                text.set_result(self.plain_message(match))
+            except Exception as ex:
+                text.set_exception(ex)
+
+            texts.append(text)
+
+        return texts
+
+    def plain_texts(self, matches):
+        """Return a list of the plain message text, or the exception
+        raised building it, for each of the matches, as async_replies()
+        does, for when lookups must be skipped.
+        """
+        texts = []
+        for match in matches:
+            try:
+                texts.append(self.plain_message(match))
+            except Exception as ex:
+                texts.append(ex)
+
+        return texts
+
+    def post(self, texts, message, say, client, logger, posted=None):
+        """Post the futures of message text as one reply to message."""
+        post_replies(texts, message, say, client, logger, posted=posted)
+
+    def _posted(self, matches, message, indexes):
+        self.expanded([matches[n] for n in indexes], message)
+
+    def _texts(self, matches, lookup, build):
+        """Return a list of futures of lookup(match) for each of the
+        matches, or of build(match, record) for those prefetched.
+        """
+        matches = list(matches)
+        texts = [Future() for match in matches]
+        if len(matches) > 1:
+            batch = submit_lookup(self._host, self.prefetch, matches)
+            batch.add_done_callback(
+                partial(self._fan_out, matches, texts, lookup, build))
+        else:
+            self._fan_out(matches, texts, lookup, build, None)
+
+        return texts
+
+    def _fan_out(self, matches, texts, lookup, build, batch):
+        records = None
+        if batch:
+            try:
+                records = batch.result()
+            except Exception as ex:
+                logger.error("prefetch: {}".format(ex))
+
+        for match, text in zip(matches, texts):
+            if records is None:
+                chain_future(submit_lookup(self._host, lookup, match), text)
+            elif match in records:
+                chain_future(submit_lookup(
+                    None, build, match, records[match]), text)
+            else:
+                text.set_exception(KeyError("{} not found".format(match)))
+
+    def _unfurls(self, labels):
+        records = self.prefetch(labels)
+        attachments = {}
+        for label in labels:
+            try:
+                if records is None:
+                    attachments[label] = self.unfurl(label)
+                elif label in records:
+                    attachments[label] = self.unfurl(label, records[label])
+            except Exception as ex:
+                logger.error("unfurl {}: {}".format(label, ex))
+
+        return attachments
+
+    def _text(self, match):
+        try:
+            return self.message(match)
+        except CircuitOpenError as ex:
+            logger.warning("{}: {}".format(self.name(), ex))
+            return self.plain_message(match)
+
+    async def async_lookup(self, key, fetch):
+        """Coroutine version of lookup() for a coroutine fetch(key)."""
+        fetch = partial(self._flight.async_fetch,
+                        partial(await_lookup, self._host, fetch))
+        key = self.record_key(key)
+        with self._timed_lookup():
+            if self._cache is not None:
+                return await self._cache.async_get(key, fetch)
+
+            return await fetch(key)
+
+    async def async_lookup_many(self, keys, fetch_many):
+        """Coroutine version of lookup_many() for a coroutine
+        fetch_many(keys).
+        """
+        fetch_many = partial(self._flight.async_fetch_many,
+                             partial(await_lookup, self._host, fetch_many))
+        records = {key: self.record_key(key) for key in keys}
+        with self._timed_lookup():
+            if self._cache is not None:
+                results = await self._cache.async_get_many(
+                    list(dict.fromkeys(records.values())), fetch_many)
+            else:
+                results = (await fetch_many(
+                    list(dict.fromkeys(records.values()))))[0]
+
+        return {key: results[record] for key, record in records.items()
+                if record in results}
+
+    async def async_prefetch(self, matches):
+        """Coroutine version of prefetch()."""
+        return None
+
+    async def async_message(self, link_label, record=None):
+        """Coroutine version of message().  Subclasses with a backend
+        override this to look up link_label without blocking.
+        """
+        return self.message(link_label, record)
+
+    async def async_unfurl(self, link_label, record=None):
+        """Coroutine version of unfurl()."""
+        return {'text': await self.async_message(link_label, record)}
+
+    async def async_unfurls(self, labels):
+        """Coroutine version of unfurls(), returning the dict."""
+        labels = list(labels)
+        records = await self.async_prefetch(labels)
+        attachments = {}
+        for label in labels:
+            try:
+                if records is None:
+                    attachments[label] = await self.async_unfurl(label)
+                elif label in records:
+                    attachments[label] = self.unfurl(label, records[label])
+            except Exception as ex:
+                logger.error("unfurl {}: {}".format(label, ex))
+
+        return attachments
+
+    async def async_summary(self, link_label, record=None):
+        """Coroutine version of summary().  Subclasses that enrich
+        override this to look up link_label without blocking.
+        """
+        return self.summary(link_label, record)
+
+    async def async_send_message(self, message, context, say, client,
+                                 logger):
+        """Coroutine version of send_message() for AsyncApp."""
+        if context.get('is_bot_message'):
+            logger.debug('Ignore bot message')
+            return
+
+        matches = self.unsuppressed(
+            self.match(message.get('text', '')), message)
+        texts = await self.async_replies(matches)
+        await self.async_post(texts, message, say, client, logger,
+                              posted=partial(self._posted, matches, message))
+
+    async def async_replies(self, matches):
+        """Return a list of the message text, or the exception raised
+        building it, for each of the matches, in order, looking them up
+        concurrently.
+        """
+        return await self._async_texts(matches, self._async_text)
+
+    async def async_summaries(self, matches):
+        """Return a list of the summary() of each of the matches, or the
+        exception raised looking it up, in order, looked up as
+        async_replies() does.
+        """
+        return await self._async_texts(matches, self._async_summary)
+
+    async def _async_texts(self, matches, text):
+        matches = list(matches)
+        records = None
+        if len(matches) > 1:
             try:
-                say(self.message(match), parse='none')
-                metrics_counter(channel_name(message.get('channel'), client))
+                records = await self.async_prefetch(matches)
             except Exception as ex:
-                logger.error("send_message: {}".format(ex))
+                logger.error("prefetch: {}".format(ex))
+
+        return await asyncio.gather(
+            *[text(match, records) for match in matches],
+            return_exceptions=True)
+
+    async def async_post(self, texts, message, say, client, logger,
+                         posted=None):
+        """Coroutine version of post()."""
+        await async_post_replies(texts, message, say, client, logger,
+                                 posted=posted)
+
+    @contextmanager
+    def _timed_lookup(self):
+        """Record the time and outcome of the lookup in the block."""
+        start = time.monotonic()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'found'
+        except KeyError:
+            outcome = 'not_found'
+            raise
+        except CircuitOpenError:
+            outcome = 'circuit_open'
+            raise
+        finally:
+            metrics_lookup_time(
+                self.name(), outcome, time.monotonic() - start)
+
+    async def _async_text(self, match, records):
+        if records is None:
+            try:
+                return await self.async_message(match)
+            except CircuitOpenError as ex:
+                logger.warning("{}: {}".format(self.name(), ex))
+                return self.plain_message(match)
+        elif match in records:
+            return await self.async_message(match, records[match])
+
+        raise KeyError("{} not found".format(match))
+
+    async def _async_summary(self, match, records):
+        if records is None:
+            return await self.async_summary(match)
+        elif match in records:
+            return self.summary(match, records[match])
+
+        raise KeyError("{} not found".format(match))
 
     @property
     def quip(self):
@@ -9,20 +9,60 @@ Subclass implementing integrated Jira link matching and reporting
 from linkbots import LinkBot as LinkBotBase
 from datetime import datetime
 from urllib.parse import quote
-from types import SimpleNamespace
-from util.saml import UwSamlSession
+from threading import Lock
+from util.saml import UwSamlSession, AsyncUwSamlSession
+import asyncio
+import re
+
+
+class JiraIssue:
+    """
+    A Jira issue's key and the fields linkbot renders, with people and
+    status reduced to their names.  Any other fields requested are kept
+    in extra, which is None if there are none.
+    """
+    __slots__ = ('key', 'summary', 'status', 'reporter', 'assignee',
+                 'updated', 'extra')
+
+    rendered = ('summary', 'status', 'reporter', 'assignee', 'updated')
+
+    def __init__(self, data, fields=rendered):
+        """
+        Decode the REST API's issue JSON, keeping only fields.
+        """
+        values = data.get('fields') or {}
+        self.key = data.get('key')
+        self.summary = values.get('summary')
+        self.status = self._name(values.get('status'), 'name')
+        self.reporter = self._name(values.get('reporter'), 'displayName')
+        self.assignee = self._name(values.get('assignee'), 'displayName')
+        self.updated = values.get('updated')
+        extra = {field: values[field] for field in fields
+                 if field not in self.rendered and field in values}
+        self.extra = extra or None
+
+    @staticmethod
+    def _name(value, key):
+        return value.get(key) if value else None
 
 
 class UwSamlJira:
     """
     A Jira client with a saml session to handle authn on an SSO redirect
     """
-    def __init__(self, host='', auth=(None, None)):
+    def __init__(self, host='', auth=(None, None), cookie_file=None,
+                 session_lifetime=None, timeout=None, retries=None,
+                 fields=JiraIssue.rendered):
         """
-        Initialize with the basic auth so we use our _session.
+        Initialize with the basic auth so we use our _session, fetching
+        only fields of each issue.
         """
-        self._session = UwSamlSession(credentials=auth)
+        self._session = UwSamlSession(credentials=auth,
+                                      cookie_file=cookie_file,
+                                      session_lifetime=session_lifetime,
+                                      timeout=timeout, retries=retries)
         self.host = host
+        self.fields = fields
 
     def issue(self, issue_number):
         """
@@ -31,41 +71,174 @@ class UwSamlJira:
         """
         url = "{}/rest/api/latest/issue/{}".format(
             self.host, quote(issue_number))
-        response = self._session.get(url)
+        response = self._session.get(url, params=self._issue_params())
+        if response.status_code == 404:
+            raise KeyError("{} not found".format(issue_number))
+
+        response.raise_for_status()
+        return self._issue(response.json())
+
+    def server_info(self):
+        """
+        Return the Jira server info, logging in first if need be.
+        """
+        response = self._session.get(self._server_info_url())
+        response.raise_for_status()
+        return response.json()
+
+    def issues(self, issue_numbers, page_size=50):
+        """
+        Return a tuple of a dict of JIRA issues keyed by issue number and
+        a list of the issue numbers not found, using JQL searches of at
+        most page_size keys each.
+        """
+        found = {}
+        numbers = list(issue_numbers)
+        for i in range(0, len(numbers), page_size):
+            requested, params = self._search(numbers[i:i + page_size])
+            while True:
+                response = self._session.get(
+                    self._search_url(), params=params)
+                response.raise_for_status()
+                if self._search_page(response.json(), requested, params,
+                                     found):
+                    break
+
+        return found, [n for n in numbers if n not in found]
+
+    def _search_url(self):
+        return "{}/rest/api/latest/search".format(self.host)
+
+    def _server_info_url(self):
+        return "{}/rest/api/latest/serverInfo".format(self.host)
+
+    def _issue_params(self):
+        return {'fields': ','.join(self.fields)}
+
+    def _search(self, numbers):
+        """
+        Return a dict of requested issue numbers keyed by upper case key
+        and the search params for them.
+        """
+        requested = {n.upper(): n for n in numbers}
+        params = {
+            # quoted, so keys like AND-1 aren't read as JQL keywords
+            'jql': 'key in ({})'.format(
+                ','.join('"{}"'.format(key) for key in requested)),
+            'validateQuery': 'warn',
+            'maxResults': len(requested),
+            'startAt': 0,
+            'fields': ','.join(self.fields)
+        }
+        return requested, params
+
+    def _search_page(self, data, requested, params, found):
+        """
+        Add the issues in a page of search results to found and advance
+        params to the next page, returning True on the last page.
+        """
+        issues = data.get('issues', [])
+        for issue in issues:
+            number = requested.get(issue.get('key', '').upper())
+            if number:
+                found[number] = self._issue(issue)
+
+        params['startAt'] += len(issues)
+        return not issues or params['startAt'] >= data.get('total', 0)
+
+    def _issue(self, data):
+        return JiraIssue(data, self.fields)
+
+
+class AsyncUwSamlJira(UwSamlJira):
+    """
+    A UwSamlJira looking up issues without blocking the event loop
+    """
+    def __init__(self, host='', auth=(None, None), cookie_file=None,
+                 session_lifetime=None, timeout=None, retries=None,
+                 fields=JiraIssue.rendered):
+        self._session = AsyncUwSamlSession(credentials=auth,
+                                           cookie_file=cookie_file,
+                                           session_lifetime=session_lifetime,
+                                           timeout=timeout, retries=retries)
+        self.host = host
+        self.fields = fields
+
+    async def issue(self, issue_number):
+        """
+        Coroutine version of UwSamlJira.issue.
+        """
+        url = "{}/rest/api/latest/issue/{}".format(
+            self.host, quote(issue_number))
+        response = await self._session.get(url,
+                                           params=self._issue_params())
         if response.status_code == 404:
             raise KeyError("{} not found".format(issue_number))
 
         response.raise_for_status()
-        data = response.json()
+        return self._issue(response.json())
+
+    async def server_info(self):
+        """
+        Coroutine version of UwSamlJira.server_info.
+        """
+        response = await self._session.get(self._server_info_url())
+        response.raise_for_status()
+        return response.json()
+
+    async def issues(self, issue_numbers, page_size=50):
+        """
+        Coroutine version of UwSamlJira.issues, searching the pages of
+        keys concurrently.
+        """
+        numbers = list(issue_numbers)
+        found = {}
+        await asyncio.gather(*[
+            self._search_all(numbers[i:i + page_size], found)
+            for i in range(0, len(numbers), page_size)])
+        return found, [n for n in numbers if n not in found]
 
-        fields = SimpleNamespace(**data['fields'])
-        subobjects = ['status', 'reporter', 'assignee']
-        for subobject in subobjects:
-            objdict = getattr(fields, subobject, None)
-            if objdict:
-                setattr(fields, subobject, SimpleNamespace(**objdict))
-        return SimpleNamespace(fields=fields)
+    async def _search_all(self, numbers, found):
+        requested, params = self._search(numbers)
+        while True:
+            response = await self._session.get(
+                self._search_url(), params=params)
+            response.raise_for_status()
+            if self._search_page(response.json(), requested, params, found):
+                break
 
 
 class LinkBot(LinkBotBase):
     """
-    Subclass LinkBot to customize response for JIRA links
+    Subclass LinkBot to customize response for JIRA links.  Only the
+    rendered fields of an issue are fetched, plus any listed in the
+    optional FIELDS conf key.
     """
     default_match = r'[A-Z]{3,}\-[0-9]+'
+    required = ('HOST',)
+    cache_ttl = 120
+    webhooks = True
+    enriches = True
 
     def __init__(self, conf):
         if 'LINK' not in conf:
-            conf['LINK'] = '<{}/browse/{{}}|{{}}>'.format(conf['HOST'])
+            conf['LINK'] = '<{}/browse/{{}}|{{}}>'.format(conf.get('HOST'))
         super(LinkBot, self).__init__(conf)
-        self.jira = UwSamlJira(host=conf.get('HOST'),
-                               auth=conf.get('AUTH'))
+        self._fields = tuple(dict.fromkeys(
+            JiraIssue.rendered + tuple(conf.get('FIELDS', ()))))
+        self._jira = None
+        self._jira_lock = Lock()
+        self._async_jira = None
+        host = re.sub(r'^https?://', '', conf.get('HOST').rstrip('/'))
+        self._browse_regex = re.compile(r'https?://{}/browse/({})/?'.format(
+            re.escape(host), self.match_source()), flags=re.I)
 
     def name(self):
         return "jirabot"
 
     @staticmethod
     def pretty_update_time(issue):
-        updated = issue.fields.updated
+        updated = issue.updated
         try:
             update_dt = datetime.strptime(updated, '%Y-%m-%dT%H:%M:%S.%f%z')
             updated = update_dt.strftime("%Y-%m-%d %H:%M:%S")
@@ -73,17 +246,110 @@ class LinkBot(LinkBotBase):
             pass
         return updated
 
-    def _get_name(self, person):
-        return person and person.displayName or 'None'
+    def _get_name(self, name):
+        return name or 'None'
 
-    def message(self, link_label):
+    @property
+    def jira(self):
+        if self._jira is None:
+            with self._jira_lock:
+                if self._jira is None:
+                    self._jira = UwSamlJira(
+                        host=self._conf.get('HOST'),
+                        auth=self._conf.get('AUTH'),
+                        cookie_file=self._conf.get('COOKIE_FILE'),
+                        session_lifetime=self._conf.get('SESSION_LIFETIME'),
+                        timeout=self._conf.get('TIMEOUT'),
+                        retries=self._conf.get('RETRIES'),
+                        fields=self._fields)
+        return self._jira
+
+    @property
+    def async_jira(self):
+        if self._async_jira is None:
+            # aiohttp cookie jars are saved in their own format
+            cookie_file = self._conf.get('COOKIE_FILE')
+            self._async_jira = AsyncUwSamlJira(
+                host=self._conf.get('HOST'), auth=self._conf.get('AUTH'),
+                cookie_file=cookie_file and '{}.async'.format(cookie_file),
+                session_lifetime=self._conf.get('SESSION_LIFETIME'),
+                timeout=self._conf.get('TIMEOUT'),
+                retries=self._conf.get('RETRIES'),
+                fields=self._fields)
+        return self._async_jira
+
+    def record_key(self, link_label):
+        # Jira issue keys ignore case
+        return link_label.upper()
+
+    def webhook_updates(self, payloads):
+        """Return the issues carried by Jira issue event webhook
+        payloads, or None for a deleted issue.
+        """
+        updates = {}
+        for payload in payloads:
+            issue = payload['issue']
+            key = self.record_key(issue['key'])
+            if payload.get('webhookEvent') == 'jira:issue_deleted' or \
+                    not issue.get('fields'):
+                updates[key] = None
+            else:
+                updates[key] = JiraIssue(issue, self._fields)
+        return updates
+
+    def url_label(self, url):
+        """Return the issue key a /browse/ url on HOST links to."""
+        match = self._browse_regex.fullmatch(url.partition('?')[0])
+        return match.group(1).upper() if match else None
+
+    def unfurl(self, link_label, issue=None):
+        if issue is None:
+            issue = self.lookup(link_label, self.jira.issue)
+        lines = self._details(issue)
+        return {'title': '{}: {}'.format(link_label, lines[0]),
+                'text': '\n'.join(lines[1:])}
+
+    async def async_unfurl(self, link_label, issue=None):
+        if issue is None:
+            issue = await self.async_lookup(link_label, self.async_jira.issue)
+        return self.unfurl(link_label, issue)
+
+    def warm(self):
+        self.jira.server_info()
+
+    async def async_warm(self):
+        await self.async_jira.server_info()
+
+    def prefetch(self, matches):
+        return self.lookup_many(matches, self.jira.issues)
+
+    async def async_prefetch(self, matches):
+        return await self.async_lookup_many(matches, self.async_jira.issues)
+
+    async def async_message(self, link_label, issue=None):
+        if issue is None:
+            issue = await self.async_lookup(link_label, self.async_jira.issue)
+        return self.message(link_label, issue)
+
+    async def async_summary(self, link_label, issue=None):
+        if issue is None:
+            issue = await self.async_lookup(link_label, self.async_jira.issue)
+        return self.summary(link_label, issue)
+
+    def message(self, link_label, issue=None):
         msg = super(LinkBot, self).message(link_label)
-        issue = self.jira.issue(link_label)
-        summary = issue.fields.summary
-        reporter = '*Reporter* ' + self._get_name(issue.fields.reporter)
-        assignee = '*Assignee* ' + self._get_name(issue.fields.assignee)
-        updated = '*Last Update* ' + self.pretty_update_time(issue)
-        status = '*Status* ' + issue.fields.status.name
-        lines = list(map(self.escape_html,
-                         [summary, reporter, assignee, status, updated]))
-        return '\n> '.join([msg] + lines)
+        return msg + self.summary(link_label, issue)
+
+    def summary(self, link_label, issue=None):
+        if issue is None:
+            issue = self.lookup(link_label, self.jira.issue)
+        return ''.join('\n> ' + line for line in self._details(issue))
+
+    def _details(self, issue):
+        summary = issue.summary or ''
+        reporter = '*Reporter* ' + self._get_name(issue.reporter)
+        assignee = '*Assignee* ' + self._get_name(issue.assignee)
+        updated = '*Last Update* ' + (self.pretty_update_time(issue) or '')
+        status = '*Status* ' + self._get_name(issue.status)
+        return list(map(self.escape_html,
+                        [summary, reporter, assignee, status, updated]))
@@ -7,15 +7,19 @@
 Subclass implementing integrated Service Now link matching and reporting
 """
 from linkbots import LinkBot as LinkBotBase
-from urllib.parse import urlencode
-from functools import partial
-import requests
+from urllib.parse import urlencode, urlsplit, parse_qs
+from threading import Lock
+from util.async_http import AsyncSession
+from util.http import BackendSession
+import asyncio
 import collections
 import re
 
 
-class ServiceNowClient(requests.Session):
-    """ServiceNow REST client for looking up records."""
+class ServiceNowTables(object):
+    """Record links, table API queries and results for a ServiceNow
+    host, shared by the blocking and non-blocking clients.
+    """
     api = '/api/now/table'
     table_map = {
         'CHG': 'change_request',
@@ -29,46 +33,60 @@ class ServiceNowClient(requests.Session):
     }
     _digits_regex = re.compile('[0-9]')
 
-    def __init__(self, host='', auth=()):
-        """Initialize ServiceNowClient with a host and user/password tuple."""
-        super(ServiceNowClient, self).__init__()
-        self.headers.update({"Content-Type": "application/json",
-                            "Accept": "application/json"})
-        self.auth = auth
+    def __init__(self, host=''):
         self.host = host
 
-    def get_number(self, number, full_payload=False):
-        """Look up a service now record based on its number (eg REQ0000001).
-        Return a ServiceNowRecord with, the attributes of which are controlled
-        by ServiceNowRecord.fields, unless full_payload, in which case return
-        all the attributes.
-        """
-        table = self._table_from_number(number)
-        url = self.host + self.api
+    def link(self, number):
+        """Return a link to a record given its number."""
+        fargs = {'host': self.host, 'table': self._table_from_number(number),
+                 'number': number}
+        return ('{host}/{table}.do?sysparm_table={table}'
+                '&sysparm_query=number%3D{number}').format(**fargs)
+
+    def _query_url(self, table, query, limit, full_payload=False):
         fields = []
         if not full_payload:
             fields = ServiceNowRecord.fields
         query = {
-            'sysparm_query': 'number={num}'.format(num=number),
+            'sysparm_query': query,
             'sysparm_display_value': 'true',
-            'sysparm_limit': '1',
+            'sysparm_limit': str(limit),
             'sysparm_fields': ','.join(fields)
         }
+        url = self.host + self.api
         url += '/{table}?{query}'.format(table=table, query=urlencode(query))
-        response = self.get(url)
-        if response.status_code != 200:
-            raise IOError('bad service now response ' + str(response))
-        result = next(iter(response.json()['result']), None)
-        if not result:
-            raise KeyError(number + ' not found')
-        return ServiceNowRecord(**result)
+        return url
 
-    def link(self, number):
-        """Return a link to a record given its number."""
-        fargs = {'host': self.host, 'table': self._table_from_number(number),
-                 'number': number}
-        return ('{host}/{table}.do?sysparm_table={table}'
-                '&sysparm_query=number%3D{number}').format(**fargs)
+    def _tables(self, numbers):
+        """Return a dict of lists of numbers keyed by table, and a list
+        of the numbers with unrecognized types.
+        """
+        tables = collections.defaultdict(list)
+        unrecognized = []
+        for number in numbers:
+            try:
+                tables[self._table_from_number(number)].append(number)
+            except KeyError:
+                unrecognized.append(number)
+        return tables, unrecognized
+
+    @staticmethod
+    def _in_query(numbers):
+        return 'numberIN{nums}'.format(
+            nums=','.join(number.upper() for number in numbers))
+
+    @staticmethod
+    def _records(numbers, results):
+        """Return a dict of ServiceNowRecords for results keyed by the
+        requested numbers.
+        """
+        requested = {number.upper(): number for number in numbers}
+        records = {}
+        for result in results:
+            number = requested.get(str(result.get('number')).upper())
+            if number:
+                records[number] = ServiceNowRecord(**result)
+        return records
 
     def _table_from_number(self, number):
         """Given a number, parse out the record type and return the matching
@@ -81,9 +99,118 @@ class ServiceNowClient(requests.Session):
         return table
 
 
+class ServiceNowClient(ServiceNowTables, BackendSession):
+    """ServiceNow REST client for looking up records."""
+    def __init__(self, host='', auth=(), timeout=None, retries=None):
+        """Initialize ServiceNowClient with a host and user/password tuple,
+        and optionally (connect, read) timeouts and a GET retry count.
+        """
+        BackendSession.__init__(self, timeout=timeout, retries=retries)
+        ServiceNowTables.__init__(self, host)
+        self.headers.update({"Content-Type": "application/json",
+                            "Accept": "application/json"})
+        self.auth = auth
+
+    def get_number(self, number, full_payload=False):
+        """Look up a service now record based on its number (eg REQ0000001).
+        Return a ServiceNowRecord with, the attributes of which are controlled
+        by ServiceNowRecord.fields, unless full_payload, in which case return
+        all the attributes.
+        """
+        table = self._table_from_number(number)
+        results = self._query(table, 'number={num}'.format(num=number), 1,
+                              full_payload)
+        result = next(iter(results), None)
+        if not result:
+            raise KeyError(number + ' not found')
+        return ServiceNowRecord(**result)
+
+    def get_numbers(self, numbers, full_payload=False):
+        """Look up several service now records at once, making one request
+        per table. Return a tuple of a dict of ServiceNowRecords keyed by
+        number and a list of the numbers not found.
+        """
+        tables, missing = self._tables(numbers)
+        records = {}
+        for table, batch in tables.items():
+            results = self._query(table, self._in_query(batch), len(batch),
+                                  full_payload)
+            records.update(self._records(batch, results))
+
+        missing += [number for number in numbers
+                    if number not in records and number not in missing]
+        return records, missing
+
+    def ping(self):
+        """Make a minimal query, opening a connection to the host and
+        checking the credentials.
+        """
+        self._query(self.table_map['INC'], '', 1)
+
+    def _query(self, table, query, limit, full_payload=False):
+        """Return the list of table results for an encoded query."""
+        response = self.get(self._query_url(table, query, limit,
+                                            full_payload))
+        if response.status_code != 200:
+            raise IOError('bad service now response ' + str(response))
+        return response.json()['result']
+
+
+class AsyncServiceNowClient(ServiceNowTables):
+    """ServiceNow REST client looking up records without blocking the
+    event loop.
+    """
+    def __init__(self, host='', auth=(), timeout=None, retries=None):
+        super(AsyncServiceNowClient, self).__init__(host)
+        self._session = AsyncSession(auth=auth, headers={
+            "Content-Type": "application/json",
+            "Accept": "application/json"}, timeout=timeout, retries=retries)
+
+    async def get_number(self, number, full_payload=False):
+        """Coroutine version of ServiceNowClient.get_number."""
+        table = self._table_from_number(number)
+        results = await self._query(
+            table, 'number={num}'.format(num=number), 1, full_payload)
+        result = next(iter(results), None)
+        if not result:
+            raise KeyError(number + ' not found')
+        return ServiceNowRecord(**result)
+
+    async def ping(self):
+        """Coroutine version of ServiceNowClient.ping."""
+        await self._query(self.table_map['INC'], '', 1)
+
+    async def get_numbers(self, numbers, full_payload=False):
+        """Coroutine version of ServiceNowClient.get_numbers, querying
+        the tables concurrently.
+        """
+        tables, missing = self._tables(numbers)
+        results = await asyncio.gather(*[
+            self._query(table, self._in_query(batch), len(batch),
+                        full_payload)
+            for table, batch in tables.items()])
+        records = {}
+        for batch, result in zip(tables.values(), results):
+            records.update(self._records(batch, result))
+
+        missing += [number for number in numbers
+                    if number not in records and number not in missing]
+        return records, missing
+
+    async def _query(self, table, query, limit, full_payload=False):
+        response = await self._session.get(
+            self._query_url(table, query, limit, full_payload))
+        if response.status_code != 200:
+            raise IOError('bad service now response ' + str(response))
+        return response.json()['result']
+
+
 class ServiceNowRecord:
     """A record returned from ServiceNowClient. The default fields are ones
-    deemed interesting to summarize a record.
+    deemed interesting to summarize a record.  A field whose value is an
+    object keeps its display_value, and attributes beyond the fields, as
+    a full_payload brings, are kept in extra, which is None if there are
+    none.
     """
     fields = {
         'short_description': 'Subject',
@@ -94,44 +221,164 @@ class ServiceNowRecord:
         'opened_by': 'Opened By',
         'sys_updated_on': 'Last Update'}
 
+    __slots__ = tuple(fields) + ('extra',)
+
     def __init__(self, **kwargs):
-        self.__dict__ = kwargs
+        for field in self.fields:
+            value = kwargs.pop(field, None)
+            # decoded JSON objects are dicts
+            if isinstance(value, dict) and 'display_value' in value:
+                value = value.get('display_value')
+            setattr(self, field, value)
+        self.extra = kwargs or None
 
     def __repr__(self):
-        inner = ', '.join(map(partial(str.join, '='), self.items()))
+        inner = ', '.join('{}={}'.format(*item) for item in self.items())
         return 'ServiceNowRecord({inner})'.format(inner=inner)
 
     def items(self, pretty_names=False):
         """Yield the key/value tuples of the the record. If pretty_names,
-        change the key to a user-facing value. If value is an object,
-        check display_value for a more friendly value.
+        change the key to a user-facing value.
         """
         for field in self.fields:
             value = getattr(self, field)
-            is_mapping = isinstance(value, collections.Mapping)
-            if is_mapping and 'display_value' in value:
-                value = value.get('display_value')
             if pretty_names:
                 field = self.fields.get(field, field)
             yield field, value
 
 
 class LinkBot(LinkBotBase):
-    _ticket_regex = '|'.join(ServiceNowClient.table_map)
+    _ticket_regex = '|'.join(ServiceNowTables.table_map)
     default_match = '({})[0-9]{{7,}}'.format(_ticket_regex)
+    required = ('HOST',)
+    cache_ttl = 120
+    webhooks = True
+    enriches = True
 
     def __init__(self, conf):
         super(LinkBot, self).__init__(conf)
-        self.client = ServiceNowClient(
-            host=conf.get('HOST'), auth=conf.get('AUTH'))
+        self._client = None
+        self._client_lock = Lock()
+        self._async_client = None
+        self._tables = ServiceNowTables(conf.get('HOST'))
+        self._netloc = urlsplit(conf.get('HOST')).netloc.lower()
+        self._number_regex = re.compile(self.match_source(), flags=re.I)
 
     def name(self):
         return "servicenowbot"
 
-    def message(self, link_label):
-        record = self.client.get_number(link_label)
-        link = self._strlink(link_label)
-        lines = [self._quip(link)]
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = ServiceNowClient(
+                        host=self._conf.get('HOST'),
+                        auth=self._conf.get('AUTH'),
+                        timeout=self._conf.get('TIMEOUT'),
+                        retries=self._conf.get('RETRIES'))
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncServiceNowClient(
+                host=self._conf.get('HOST'), auth=self._conf.get('AUTH'),
+                timeout=self._conf.get('TIMEOUT'),
+                retries=self._conf.get('RETRIES'))
+        return self._async_client
+
+    def record_key(self, link_label):
+        # ServiceNow numbers ignore case
+        return link_label.upper()
+
+    def webhook_updates(self, payloads):
+        """Return the records carried by ServiceNow business rule
+        payloads of the record's ServiceNowRecord.fields, or None for a
+        deleted record or one sent without them.
+        """
+        updates = {}
+        for payload in payloads:
+            key = self.record_key(payload['number'])
+            if payload.get('operation') == 'delete' or \
+                    not all(f in payload for f in ServiceNowRecord.fields):
+                updates[key] = None
+            else:
+                updates[key] = ServiceNowRecord(**{
+                    f: payload[f] for f in ServiceNowRecord.fields})
+        return updates
+
+    def url_label(self, url):
+        """Return the number of the record a HOST .do url queries for by
+        number, as ServiceNowClient.link() makes them.
+        """
+        parts = urlsplit(url)
+        if parts.netloc.lower() != self._netloc or \
+                not parts.path.endswith('.do'):
+            return None
+
+        for query in parse_qs(parts.query).get('sysparm_query', []):
+            field, _, number = query.partition('=')
+            if field == 'number' and self._number_regex.fullmatch(number):
+                return number.upper()
+
+        return None
+
+    def unfurl(self, link_label, record=None):
+        if record is None:
+            record = self.lookup(link_label, self.client.get_number)
+        lines = self._details(record)
+        return {'title': '{}: {}'.format(link_label, lines[0]),
+                'text': '\n'.join(lines[1:])}
+
+    async def async_unfurl(self, link_label, record=None):
+        if record is None:
+            record = await self.async_lookup(
+                link_label, self.async_client.get_number)
+        return self.unfurl(link_label, record)
+
+    def warm(self):
+        self.client.ping()
+
+    async def async_warm(self):
+        await self.async_client.ping()
+
+    def prefetch(self, matches):
+        return self.lookup_many(matches, self.client.get_numbers)
+
+    async def async_prefetch(self, matches):
+        return await self.async_lookup_many(
+            matches, self.async_client.get_numbers)
+
+    async def async_message(self, link_label, record=None):
+        if record is None:
+            record = await self.async_lookup(
+                link_label, self.async_client.get_number)
+        return self.message(link_label, record)
+
+    async def async_summary(self, link_label, record=None):
+        if record is None:
+            record = await self.async_lookup(
+                link_label, self.async_client.get_number)
+        return self.summary(link_label, record)
+
+    def plain_message(self, link_label):
+        return self._quip(self._strlink(link_label))
+
+    def message(self, link_label, record=None):
+        if record is None:
+            record = self.lookup(link_label, self.client.get_number)
+        return self.plain_message(link_label) + self.summary(
+            link_label, record)
+
+    def summary(self, link_label, record=None):
+        if record is None:
+            record = self.lookup(link_label, self.client.get_number)
+        return ''.join('\n> ' + line for line in self._details(record))
+
+    def _details(self, record):
+        """Return the record's subject followed by its other fields."""
+        lines = []
         for key, value in record.items(pretty_names=True):
             if key == 'Subject':
                 lines.append(value or 'No subject')
@@ -140,8 +387,8 @@ class LinkBot(LinkBotBase):
                 lines.append('*{key}* {link}'.format(key=key, link=link))
             elif value and key != 'Number':
                 lines.append('*{key}* {value}'.format(key=key, value=value))
-        return '\n> '.join(lines)
+        return lines
 
     def _strlink(self, link_label):
-        link = self.client.link(link_label)
+        link = self._tables.link(self.record_key(link_label))
         return '<{link}|{label}>'.format(link=link, label=link_label)
@@ -8,11 +8,41 @@ from ast import literal_eval
 
 SLACK_BOT_TOKEN = os.environ.get('SLACK_BOT_TOKEN')
 SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
+SLACK_API_URL = os.environ.get('SLACK_API_URL')
 LOG_FILE = os.environ.get('LOG_FILE', 'linkbot.log')
 JIRA_HOST = os.environ.get('JIRA_HOST')
 UW_SAML_CREDENTIALS = os.environ.get('UW_SAML_CREDENTIALS')
+SAML_COOKIE_FILE = os.environ.get('SAML_COOKIE_FILE')
 SERVICE_NOW_HOST = os.environ.get('SERVICE_NOW_HOST')
 SERVICE_NOW_CREDENTIALS = os.environ.get('SERVICE_NOW_CREDENTIALS')
+SERVICE_NOW_WEBHOOK_SECRET = os.environ.get('SERVICE_NOW_WEBHOOK_SECRET')
+JIRA_WEBHOOK_SECRET = os.environ.get('JIRA_WEBHOOK_SECRET')
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'false').lower() == 'true'
+LOOKUP_WORKERS = int(os.environ.get('LOOKUP_WORKERS', 8))
+LOOKUP_HOST_LIMIT = int(os.environ.get('LOOKUP_HOST_LIMIT', 4))
+BACKEND_TIMEOUT = literal_eval(os.environ.get('BACKEND_TIMEOUT', '(3.05, 10)'))
+BACKEND_RETRIES = int(os.environ.get('BACKEND_RETRIES', 2))
+CHANNEL_CACHE_SIZE = int(os.environ.get('CHANNEL_CACHE_SIZE', 10000))
+CHANNEL_CACHE_TTL = int(os.environ.get('CHANNEL_CACHE_TTL', 3600))
+METRICS_CHANNELS = (os.environ['METRICS_CHANNELS'].split(',')
+                    if os.environ.get('METRICS_CHANNELS') else None)
+METRICS_CHANNEL_LIMIT = int(os.environ.get('METRICS_CHANNEL_LIMIT', 100))
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 8))
+EVENT_DEDUPE_WINDOW = int(os.environ.get('EVENT_DEDUPE_WINDOW', 600))
+SLACK_POST_RATE = float(os.environ.get('SLACK_POST_RATE', 1.0))
+SLACK_POST_BURST = int(os.environ.get('SLACK_POST_BURST', 3))
+PROCESSES = int(os.environ.get('PROCESSES', 1))
+SHARED_STORE = os.environ.get('SHARED_STORE')
+SHARED_STORE_SIZE = int(os.environ.get('SHARED_STORE_SIZE', 100000))
+SHARED_STORE_PURGE = int(os.environ.get('SHARED_STORE_PURGE', 60))
+DEBUG_SECRET = os.environ.get('DEBUG_SECRET')
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 300))
+UNFURL_LINKS = os.environ.get('UNFURL_LINKS', 'false').lower() == 'true'
+PROGRESSIVE_REPLIES = os.environ.get(
+    'PROGRESSIVE_REPLIES', 'false').lower() == 'true'
+ENRICH_BUDGET = float(os.environ.get('ENRICH_BUDGET', 5))
 
 
 LINKBOTS = []
@@ -22,7 +52,10 @@ if SERVICE_NOW_HOST and SERVICE_NOW_CREDENTIALS:
     LINKBOTS.append({
         'LINK_CLASS': 'servicenowbot',
         'HOST': SERVICE_NOW_HOST,
-        'AUTH': literal_eval(SERVICE_NOW_CREDENTIALS)
+        'AUTH': literal_eval(SERVICE_NOW_CREDENTIALS),
+        'TIMEOUT': BACKEND_TIMEOUT,
+        'RETRIES': BACKEND_RETRIES,
+        'WEBHOOK_SECRET': SERVICE_NOW_WEBHOOK_SECRET
     })
 
 if JIRA_HOST:
@@ -30,7 +63,11 @@ if JIRA_HOST:
         LINKBOTS.append({
             'LINK_CLASS': 'jirabot',
             'HOST': JIRA_HOST,
-            'AUTH': literal_eval(UW_SAML_CREDENTIALS)
+            'AUTH': literal_eval(UW_SAML_CREDENTIALS),
+            'COOKIE_FILE': SAML_COOKIE_FILE,
+            'TIMEOUT': BACKEND_TIMEOUT,
+            'RETRIES': BACKEND_RETRIES,
+            'WEBHOOK_SECRET': JIRA_WEBHOOK_SECRET
         })
     else:
         LINKBOTS += [
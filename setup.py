@@ -15,9 +15,9 @@ setup(
     author_email="aca-it@uw.edu",
     install_requires=[
         'tornado>=6,<7',
-        'beautifulsoup4',
         'simplejson',
         'slack_bolt',
+        'aiohttp',
         'requests',
         'django-prometheus'],
     license='Apache License, Version 2.0',
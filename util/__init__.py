@@ -6,20 +6,19 @@
 """
 Helper functions
 """
-
-channel_cache = {'None': 'None'}
+from util import channels
 
 
 def channel_name(channel_id, client):
     """
-    Given a channel id, return corresponding channel name
+    Given a channel id, return corresponding channel name without waiting
+    on Slack, or None if the name isn't known yet
     """
-    channel = str(channel_id)
-    if channel not in channel_cache:
-        try:
-            info = client.conversations_info(channel=channel_id)
-            channel_cache[channel] = info['channel']['name']
-        except Exception:
-            channel_cache[channel] = channel_id
+    return channels.channel_directory.name(channel_id, client)
+
 
-    return channel_cache[channel]
+async def async_channel_name(channel_id, client):
+    """
+    Coroutine version of channel_name for an AsyncWebClient
+    """
+    return await channels.channel_directory.async_name(channel_id, client)
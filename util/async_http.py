@@ -0,0 +1,130 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Classes providing a non-blocking HTTP session for linkbot backends
+"""
+from base64 import b64encode
+from util.http import (
+    BackendSession, RETRY_METHODS, RETRY_STATUS, circuit_breaker,
+    retry_delay)
+from util.metrics import metrics_backend_latency
+import util.workers
+import asyncio
+import json
+import time
+
+
+class AsyncResponse(object):
+    """
+    A completely read aiohttp response offering the parts of the
+    requests.Response interface that linkbot backends use.
+    """
+    def __init__(self, status_code, url, content):
+        self.status_code = status_code
+        self.url = url
+        self.content = content
+
+    def __repr__(self):
+        return '<AsyncResponse [{}]>'.format(self.status_code)
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError('{} error for url {}'.format(
+                self.status_code, self.url))
+
+
+class AsyncSession(object):
+    """
+    An aiohttp session, opened on first use so that it binds to the
+    running event loop, with the timeouts, connection limit, retries and
+    circuit breakers of util.http.BackendSession.  aiohttp itself is
+    imported on first use too, so that only ASYNC_MODE pays for it.
+    """
+    timeout = BackendSession.timeout
+    retries = BackendSession.retries
+    backoff = BackendSession.backoff
+
+    def __init__(self, auth=None, headers=None, timeout=None, retries=None,
+                 pool_size=None):
+        self._headers = dict(headers or {})
+        if auth:
+            self._headers['Authorization'] = 'Basic {}'.format(
+                b64encode(':'.join(auth).encode()).decode())
+        self.timeout = timeout or self.timeout
+        if not isinstance(self.timeout, tuple):
+            # requests takes one timeout for both
+            self.timeout = (self.timeout, self.timeout)
+        self.retries = self.retries if retries is None else retries
+        self._pool_size = pool_size or util.workers.lookup_host_limit
+        self._session = None
+
+    @property
+    def session(self):
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            connect, read = self.timeout
+            self._session = aiohttp.ClientSession(
+                headers=self._headers, cookie_jar=self._cookie_jar(),
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=self._pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=connect, sock_read=read))
+
+        return self._session
+
+    def _cookie_jar(self):
+        import aiohttp
+
+        return aiohttp.CookieJar()
+
+    async def request(self, method, url, **kwargs):
+        import aiohttp
+
+        breaker = circuit_breaker(url)
+        breaker.check()
+        retries = self.retries if method.upper() in RETRY_METHODS else 0
+        start = time.monotonic()
+        try:
+            for attempt in range(retries + 1):
+                if attempt:
+                    await asyncio.sleep(retry_delay(attempt, self.backoff))
+                try:
+                    response = await self._request(method, url, **kwargs)
+                except (aiohttp.ClientConnectionError,
+                        asyncio.TimeoutError):
+                    if attempt < retries:
+                        continue
+                    raise
+                if response.status_code not in RETRY_STATUS:
+                    break
+        except Exception:
+            breaker.failure()
+            raise
+        except BaseException:
+            # cancelled, say
+            breaker.abandon()
+            raise
+
+        metrics_backend_latency(breaker.host, time.monotonic() - start)
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
+
+    async def _request(self, method, url, **kwargs):
+        async with self.session.request(method, url, **kwargs) as response:
+            return AsyncResponse(
+                response.status, str(response.url), await response.read())
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
@@ -0,0 +1,351 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class implementing a bounded lookup cache for linkbot backends
+"""
+from collections import OrderedDict
+from threading import Lock, Thread
+from util.metrics import metrics_cache
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LookupCache(object):
+    """LRU cache of backend lookup results.
+
+    Found results live for ttl seconds, not-found results (a KeyError
+    raised by the fetch function) for negative_ttl seconds.  For
+    stale_ttl seconds after expiry a cached result is still returned
+    while a background thread refreshes it, so a hot key never blocks
+    on the backend.  Other fetch errors are never cached.
+
+    With a util.shared.SharedStore, results are also kept there, and
+    keys missing from this process's cache are looked for there before
+    fetching, so pre-forked processes share their lookups.  The store is
+    the authority: a process checks it again for a key it has cached
+    after store_recheck seconds, so an update or eviction made by one
+    process reaches the others.  Results are kept in the store under
+    namespace, which defaults to name.
+    """
+    store_recheck = 1
+
+    def __init__(self, name, size=1024, ttl=300, negative_ttl=30,
+                 stale_ttl=60, store=None, namespace=None):
+        self.name = name
+        self.namespace = namespace or name
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.store = store
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = Lock()
+
+    def get(self, key, fetch):
+        """Return the cached result for key, calling fetch(key) to
+        look it up when it isn't cached.
+        """
+        cached = self._cached([key])
+        if key in cached:
+            value, found, stale = cached[key]
+            if stale:
+                Thread(target=self._refresh, args=(stale, fetch),
+                       daemon=True).start()
+
+            return self._result(value, found)
+
+        value, found = self._fetch(key, fetch)
+        return self._result(value, found)
+
+    def get_many(self, keys, fetch_many):
+        """Return a dict of results for keys, calling fetch_many(keys)
+        for the keys that aren't cached.  fetch_many returns a tuple of
+        a dict of results by key and a list of keys not found.  Keys not
+        found are left out of the returned dict.
+        """
+        cached = self._cached(keys)
+        stale = [key for value, found, key in cached.values() if key]
+        if stale:
+            Thread(target=self._refresh_many, args=(stale, fetch_many),
+                   daemon=True).start()
+
+        results = {key: value for key, (value, found, s) in cached.items()
+                   if found}
+        uncached = [key for key in keys if key not in cached]
+        if uncached:
+            results.update(self._fetch_many(uncached, fetch_many))
+
+        return results
+
+    async def async_get(self, key, fetch):
+        """Coroutine version of get() for a coroutine fetch(key)."""
+        cached = self._cached([key])
+        if key in cached:
+            value, found, stale = cached[key]
+            if stale:
+                asyncio.ensure_future(self._async_refresh(stale, fetch))
+
+            return self._result(value, found)
+
+        value, found = await self._async_fetch(key, fetch)
+        return self._result(value, found)
+
+    async def async_get_many(self, keys, fetch_many):
+        """Coroutine version of get_many() for a coroutine
+        fetch_many(keys).
+        """
+        cached = self._cached(keys)
+        stale = [key for value, found, key in cached.values() if key]
+        if stale:
+            asyncio.ensure_future(self._async_refresh_many(stale, fetch_many))
+
+        results = {key: value for key, (value, found, s) in cached.items()
+                   if found}
+        uncached = [key for key in keys if key not in cached]
+        if uncached:
+            results.update(await self._async_fetch_many(uncached, fetch_many))
+
+        return results
+
+    def put(self, key, value, found=True, ttl=None):
+        """Cache value for key, evicting the least recently used."""
+        if ttl is None:
+            ttl = self.ttl if found else self.negative_ttl
+        self._put(key, value, found, time.monotonic() + (
+            ttl if self.store is None else min(ttl, self.store_recheck)))
+        if self.store is not None:
+            try:
+                self.store.put(self.namespace, key, (value, found),
+                               ttl + (self.stale_ttl if found else 0))
+            except Exception as ex:
+                logger.error("store {} {}: {}".format(self.name, key, ex))
+
+    def replace(self, key, value):
+        """Cache value for key as put() does if key is cached, here or
+        in the store, returning True if it was.
+        """
+        with self._lock:
+            cached = key in self._entries
+
+        if not cached and self.store is not None:
+            try:
+                self.store.entry(self.namespace, key)
+                cached = True
+            except KeyError:
+                pass
+            except Exception as ex:
+                logger.error("store {} {}: {}".format(self.name, key, ex))
+
+        if cached:
+            self.put(key, value)
+
+        return cached
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+        if self.store is not None:
+            self.store.delete(self.namespace, key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+        if self.store is not None:
+            self.store.clear(self.namespace)
+
+    def snapshot(self):
+        """Return a list of (key, value, found, expires) tuples for the
+        cached entries, where expires is a time.time().
+        """
+        if self.store is not None:
+            # the store keeps found results through their stale_ttl
+            return [(key, value, found,
+                     expires - (self.stale_ttl if found else 0))
+                    for key, (value, found), expires in
+                    self.store.items(self.namespace)]
+
+        offset = time.time() - time.monotonic()
+        with self._lock:
+            return [(key, value, found, expires + offset)
+                    for key, (value, found, expires) in self._entries.items()]
+
+    def restore(self, entries):
+        """Cache the entries of a snapshot() that haven't expired, found
+        ones through their stale_ttl, returning the number cached.
+        """
+        now = time.time()
+        restored = 0
+        for key, value, found, expires in entries:
+            ttl = expires - now
+            if ttl > (-self.stale_ttl if found else 0):
+                self.put(key, value, found, ttl=ttl)
+                restored += 1
+
+        return restored
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cached(self, keys):
+        """Return a dict of (value, found, stale key) tuples for keys that
+        are usably cached, where stale key is set if the caller should
+        refresh it.
+        """
+        if self.store is not None:
+            self._load(keys)
+
+        now = time.monotonic()
+        cached = {}
+        events = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    events.append('miss')
+                    continue
+
+                self._entries.move_to_end(key)
+                value, found, expires = entry
+                if now < expires:
+                    events.append('hit')
+                    cached[key] = (value, found, None)
+                elif found and now < expires + self.stale_ttl:
+                    events.append('stale')
+                    refresh = key not in self._refreshing
+                    self._refreshing.add(key)
+                    cached[key] = (value, found, key if refresh else None)
+                else:
+                    events.append('miss')
+
+        for event in events:
+            metrics_cache(self.name, event)
+
+        return cached
+
+    def _put(self, key, value, found, expires):
+        evicted = 0
+        with self._lock:
+            self._entries[key] = (value, found, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                evicted += 1
+
+        for _ in range(evicted):
+            metrics_cache(self.name, 'eviction')
+
+    def _load(self, keys):
+        """Copy keys this process hasn't got fresh from the shared store
+        into its cache.
+        """
+        now = time.monotonic()
+        with self._lock:
+            keys = [key for key in keys if key not in self._entries or
+                    self._entries[key][2] <= now]
+
+        for key in keys:
+            try:
+                (value, found), expires = self.store.entry(self.namespace, key)
+            except KeyError:
+                # expired or evicted by another process
+                with self._lock:
+                    self._entries.pop(key, None)
+                continue
+            except Exception as ex:
+                logger.error("store {} {}: {}".format(self.name, key, ex))
+                return
+
+            # the store keeps found results through their stale_ttl
+            expires -= self.stale_ttl if found else 0
+            self._put(key, value, found, now + min(
+                expires - time.time(), self.store_recheck))
+
+    def _fetch(self, key, fetch):
+        try:
+            value = fetch(key)
+            found = True
+        except KeyError as ex:
+            value = ex.args
+            found = False
+
+        self.put(key, value, found)
+        return value, found
+
+    def _fetch_many(self, keys, fetch_many):
+        found, missing = fetch_many(keys)
+        self._put_many(found, missing)
+        return found
+
+    async def _async_fetch(self, key, fetch):
+        try:
+            value = await fetch(key)
+            found = True
+        except KeyError as ex:
+            value = ex.args
+            found = False
+
+        self.put(key, value, found)
+        return value, found
+
+    async def _async_fetch_many(self, keys, fetch_many):
+        found, missing = await fetch_many(keys)
+        self._put_many(found, missing)
+        return found
+
+    def _put_many(self, found, missing):
+        for key, value in found.items():
+            self.put(key, value)
+
+        for key in missing:
+            self.put(key, ('{} not found'.format(key),), False)
+
+    def _refresh(self, key, fetch):
+        try:
+            self._fetch(key, fetch)
+        except Exception as ex:
+            logger.error("refresh {} {}: {}".format(self.name, key, ex))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh_many(self, keys, fetch_many):
+        try:
+            self._fetch_many(keys, fetch_many)
+        except Exception as ex:
+            logger.error("refresh {} {}: {}".format(self.name, keys, ex))
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+
+    async def _async_refresh(self, key, fetch):
+        try:
+            await self._async_fetch(key, fetch)
+        except Exception as ex:
+            logger.error("refresh {} {}: {}".format(self.name, key, ex))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    async def _async_refresh_many(self, keys, fetch_many):
+        try:
+            await self._async_fetch_many(keys, fetch_many)
+        except Exception as ex:
+            logger.error("refresh {} {}: {}".format(self.name, keys, ex))
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+
+    @staticmethod
+    def _result(value, found):
+        if not found:
+            raise KeyError(*value)
+
+        return value
@@ -0,0 +1,277 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class implementing a bounded, refreshing channel name directory
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from slack_sdk.errors import SlackApiError
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelDirectory(object):
+    """LRU map of Slack channel id to channel name.
+
+    Names are bulk loaded with conversations_list at startup and every
+    reload_interval seconds after.  A name is never looked up on the
+    caller's path: a channel that isn't known yet, or whose entry is
+    older than ttl seconds, answers with what is known (None at worst)
+    while conversations_info fetches it in the background.  Failed
+    fetches are retried after negative_ttl seconds.  With a
+    util.shared.SharedStore, names are shared with other processes.
+    A bulk load page Slack rate limits is retried after the Retry-After
+    it asks for, up to load_retries times.
+    """
+    page_size = 1000
+    load_retries = 5
+    namespace = 'channels'
+
+    def __init__(self, size=10000, ttl=3600, negative_ttl=300,
+                 reload_interval=21600, store=None):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.reload_interval = reload_interval
+        self.store = store
+        self._entries = OrderedDict()
+        self._pending = set()
+        self._lock = Lock()
+        self._executor = None
+
+    def name(self, channel_id, client):
+        """Return the name of channel_id, or None if it isn't known yet,
+        fetching it with client in the background if it is unknown or
+        stale.
+        """
+        if channel_id is None:
+            return 'None'
+
+        channel = str(channel_id)
+        name, refresh = self._cached(channel)
+        if refresh:
+            self._fetcher().submit(self._fetch, channel, client)
+
+        return name
+
+    async def async_name(self, channel_id, client):
+        """Coroutine version of name() for an AsyncWebClient."""
+        if channel_id is None:
+            return 'None'
+
+        channel = str(channel_id)
+        name, refresh = self._cached(channel)
+        if refresh:
+            asyncio.ensure_future(self._async_fetch(channel, client))
+
+        return name
+
+    def put(self, channel_id, name, ttl=None):
+        """Record name for channel_id, evicting the least recently used."""
+        ttl = self.ttl if ttl is None else ttl
+        self._put(channel_id, name, time.monotonic() + ttl)
+        if self.store is not None:
+            try:
+                self.store.put(self.namespace, channel_id, name, ttl)
+            except Exception as ex:
+                logger.error("store channel {}: {}".format(channel_id, ex))
+
+    def rename(self, channel_id, name):
+        """Handle a channel_rename or group_rename event."""
+        self.put(channel_id, name)
+
+    def load(self, client):
+        """Bulk load every channel name visible to client."""
+        start = time.monotonic()
+        loaded = 0
+        cursor = None
+        retries = 0
+        while True:
+            try:
+                response = client.conversations_list(
+                    types='public_channel,private_channel',
+                    exclude_archived=True, limit=self.page_size,
+                    cursor=cursor)
+            except SlackApiError as ex:
+                retry_after = self._retry_after(ex)
+                if retry_after is None or retries >= self.load_retries:
+                    raise
+
+                # resume at the same page once slack allows
+                retries += 1
+                time.sleep(retry_after)
+                continue
+
+            retries = 0
+            for channel in response.get('channels', []):
+                self.put(channel['id'], channel['name'])
+                loaded += 1
+
+            cursor = response.get(
+                'response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+        logger.info("loaded {} channel names in {:.1f}s".format(
+            loaded, time.monotonic() - start))
+
+    def start(self, client):
+        """Load channel names with client now and every reload_interval
+        seconds after, in a background thread.
+        """
+        Thread(target=self._reload, args=(client,), daemon=True,
+               name='channels').start()
+
+    def snapshot(self):
+        """Return a list of (channel id, name, expires) tuples for the
+        known names, where expires is a time.time().
+        """
+        if self.store is not None:
+            return self.store.items(self.namespace)
+
+        offset = time.time() - time.monotonic()
+        with self._lock:
+            return [(channel, name, expires + offset)
+                    for channel, (name, expires) in self._entries.items()]
+
+    def restore(self, entries):
+        """Record the names of a snapshot() that haven't expired,
+        returning the number recorded.
+        """
+        now = time.time()
+        restored = 0
+        for channel, name, expires in entries:
+            if expires > now:
+                self.put(channel, name, ttl=expires - now)
+                restored += 1
+
+        return restored
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cached(self, channel):
+        """Return the best known name for channel and whether the caller
+        should fetch it.
+        """
+        if self.store is not None:
+            self._load(channel)
+
+        with self._lock:
+            entry = self._entries.get(channel)
+            if entry:
+                self._entries.move_to_end(channel)
+                name, expires = entry
+                if time.monotonic() < expires:
+                    return name, False
+            else:
+                name = None
+
+            refresh = channel not in self._pending
+            self._pending.add(channel)
+            return name, refresh
+
+    def _put(self, channel_id, name, expires):
+        with self._lock:
+            self._entries[channel_id] = (name, expires)
+            self._entries.move_to_end(channel_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _load(self, channel):
+        """Copy channel from the shared store if this process hasn't got
+        a fresh name for it.
+        """
+        now = time.monotonic()
+        entry = self._entries.get(channel)
+        if entry and now < entry[1]:
+            return
+
+        try:
+            name, expires = self.store.entry(self.namespace, channel)
+            self._put(channel, name, now + expires - time.time())
+        except KeyError:
+            pass
+        except Exception as ex:
+            logger.error("store channel {}: {}".format(channel, ex))
+
+    def _fetcher(self):
+        # a single thread keeps conversations_info calls well under
+        # Slack's rate limit
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='channels')
+
+            return self._executor
+
+    @staticmethod
+    def _retry_after(ex):
+        """Return the seconds Slack asked to wait before retrying if ex
+        is a 429, else None.
+        """
+        response = getattr(ex, 'response', None)
+        if getattr(response, 'status_code', None) != 429:
+            return None
+
+        for key, value in (response.headers or {}).items():
+            if key.lower() == 'retry-after':
+                try:
+                    return float(value)
+                except (TypeError, ValueError):
+                    pass
+
+        return 1.0
+
+    def _fetch(self, channel, client):
+        try:
+            info = client.conversations_info(channel=channel)
+            self.put(channel, info['channel']['name'])
+        except Exception as ex:
+            logger.debug("channel {}: {}".format(channel, ex))
+            self._put_unknown(channel)
+        finally:
+            with self._lock:
+                self._pending.discard(channel)
+
+    async def _async_fetch(self, channel, client):
+        try:
+            info = await client.conversations_info(channel=channel)
+            self.put(channel, info['channel']['name'])
+        except Exception as ex:
+            logger.debug("channel {}: {}".format(channel, ex))
+            self._put_unknown(channel)
+        finally:
+            with self._lock:
+                self._pending.discard(channel)
+
+    def _put_unknown(self, channel):
+        with self._lock:
+            entry = self._entries.get(channel)
+
+        self.put(channel, entry[0] if entry else None,
+                 ttl=self.negative_ttl)
+
+    def _reload(self, client):
+        while True:
+            try:
+                self.load(client)
+            except Exception as ex:
+                logger.error("channel load: {}".format(ex))
+
+            time.sleep(self.reload_interval)
+
+
+channel_directory = ChannelDirectory()
+
+
+def init_channel_directory(size, ttl, store=None):
+    global channel_directory
+
+    channel_directory = ChannelDirectory(size=size, ttl=ttl, store=store)
@@ -7,22 +7,228 @@
 Functions providing linkbot events endpoint
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from slack_bolt.adapter.tornado import SlackEventsHandler
-from tornado.web import Application
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
 from tornado.ioloop import IOLoop
+from util.metrics import metrics_process_exit, metrics_webhook_request
+from util.profile import stack_sampler
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import signal
+import sys
 
 tornado_api = None
+logger = logging.getLogger(__name__)
 
 
-# prepare slack event endpoint
-def init_endpoint_server(slack_app):
+class WebhookHandler(RequestHandler):
+    """
+    Apply a backend's webhook, a JSON payload or a list of them, to the
+    cache of the bot named in the path
+    """
+    def initialize(self, bots):
+        self.bots = bots
+
+    def post(self, source):
+        bot = self.bots.get(source)
+        if bot is None:
+            self.send_error(404)
+            return
+
+        if not request_authorized(bot.webhook_secret, self.request):
+            metrics_webhook_request(source, 'unauthorized')
+            self.send_error(401)
+            return
+
+        try:
+            payloads = json.loads(self.request.body)
+            if isinstance(payloads, dict):
+                payloads = [payloads]
+
+            updates = bot.webhook_updates(payloads)
+        except Exception as ex:
+            logger.warning("webhook {}: {}".format(source, ex))
+            metrics_webhook_request(source, 'invalid')
+            self.send_error(400)
+            return
+
+        applied = bot.invalidate(updates)
+        metrics_webhook_request(source, 'ok')
+        self.write({'applied': applied})
+
+
+class ProfileHandler(RequestHandler):
+    """
+    Profile every thread for the requested seconds, returning collapsed
+    stacks.  One profile runs at a time, on its own thread rather than
+    one of the event loop's default executor
+    """
+    executor = ThreadPoolExecutor(max_workers=1,
+                                  thread_name_prefix='profile')
+    running = False
+
+    def initialize(self, secret):
+        self.secret = secret
+
+    async def get(self):
+        if not request_authorized(self.secret, self.request):
+            self.send_error(401)
+            return
+
+        try:
+            seconds = float(self.get_argument('seconds', '10'))
+        except ValueError:
+            self.send_error(400)
+            return
+
+        if ProfileHandler.running:
+            self.send_error(409)
+            return
+
+        # sample off the event loop so it shows up in the profile
+        ProfileHandler.running = True
+        try:
+            stacks = await IOLoop.current().run_in_executor(
+                self.executor, stack_sampler.profile, seconds)
+        finally:
+            ProfileHandler.running = False
+
+        if stacks is None:
+            self.send_error(409)
+            return
+
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(stacks)
+
+
+def request_authorized(secret, request):
+    """
+    Return True if request carries secret as a bearer token or basic auth
+    password, or signs its body with it in X-Hub-Signature
+    """
+    signature = request.headers.get('X-Hub-Signature', '')
+    if signature.startswith('sha256='):
+        expected = hmac.new(secret.encode(), request.body,
+                            hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature[7:], expected)
+
+    scheme, _, credentials = request.headers.get(
+        'Authorization', '').partition(' ')
+    if scheme.lower() == 'basic':
+        try:
+            credentials = base64.b64decode(
+                credentials).decode().partition(':')[2]
+        except ValueError:
+            return False
+    elif scheme.lower() != 'bearer':
+        return False
+
+    return hmac.compare_digest(credentials.encode(), secret.encode())
+
+
+# prepare slack event, backend webhook and debug endpoints
+def init_endpoint_server(slack_app, async_mode=False, webhooks=None,
+                         debug_secret=None):
+    """
+    Serve slack_app's events, and the webhooks of the bots in webhooks,
+    a dict keyed by bot name, at /webhooks/<name>.  With a debug_secret,
+    serve profiles at /debug/profile?seconds=N
+    """
     global tornado_api
 
-    tornado_api = Application(
-        [("/slack/events", SlackEventsHandler, {'app': slack_app})])
+    handler = SlackEventsHandler
+    if async_mode:
+        # the async adapter pulls in aiohttp, so only import it if needed
+        from slack_bolt.adapter.tornado.async_handler import (
+            AsyncSlackEventsHandler)
+
+        handler = AsyncSlackEventsHandler
+
+    routes = [("/slack/events", handler, {'app': slack_app})]
+    if webhooks:
+        routes.append((r"/webhooks/(\w+)", WebhookHandler,
+                       {'bots': webhooks}))
+    if debug_secret:
+        routes.append(("/debug/profile", ProfileHandler,
+                       {'secret': debug_secret}))
+
+    tornado_api = Application(routes)
 
 
 # run slack event endpoing
-def endpoint_server(port):
-    tornado_api.listen(port)
+def endpoint_server(port, processes=1, supervise=None, start=None):
+    """
+    Serve slack events on port.  With more than one process, fork that
+    many workers to share it, and the parent process calls supervise()
+    and tends them.  Each serving process calls start(task_id) on its
+    event loop once it is serving.
+    """
+    sockets = bind_sockets(port)
+    task_id = 0
+    if processes > 1:
+        task_id = fork_workers(processes, supervise)
+    elif supervise:
+        supervise()
+
+    server = HTTPServer(tornado_api)
+    server.add_sockets(sockets)
+    if start:
+        IOLoop.current().add_callback(start, task_id)
+
     IOLoop.current().start()
+
+
+def fork_workers(count, supervise=None):
+    """
+    Fork count worker processes, returning each worker's task id in it.
+    The parent calls supervise(), replaces workers that exit until it is
+    signalled to stop, then exits once its workers have.
+    """
+    workers = {}
+    stopping = []
+
+    def fork(task_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return True
+
+        workers[pid] = task_id
+        return False
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    for task_id in range(count):
+        if fork(task_id):
+            return task_id
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if supervise:
+        supervise()
+
+    while workers:
+        pid, status = os.wait()
+        if pid not in workers:
+            continue
+
+        task_id = workers.pop(pid)
+        metrics_process_exit(pid)
+        if not stopping:
+            logger.warning("worker {} ({}) exited with status {}".format(
+                task_id, pid, status))
+            if fork(task_id):
+                return task_id
+
+    sys.exit(0)
@@ -0,0 +1,197 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Classes and functions queueing message event work off the ack path
+"""
+from collections import OrderedDict
+from queue import Queue, Full
+from threading import Lock, Thread
+from util.metrics import (
+    metrics_event_queued, metrics_event_dequeued, metrics_event_dropped,
+    metrics_event_retry)
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class SeenEvents(object):
+    """Remember event keys for window seconds, holding at most size.
+    With a util.shared.SharedStore, keys are remembered there under
+    namespace instead, so that every process sees them.
+    """
+    def __init__(self, window=600, size=10000, store=None,
+                 namespace='events'):
+        self.window = window
+        self.size = size
+        self.store = store
+        self.namespace = namespace
+        self._seen = OrderedDict()
+        self._lock = Lock()
+
+    def seen(self, *keys):
+        """Return True if any of keys was seen within the window,
+        remembering them all.
+        """
+        keys = [key for key in keys if key]
+        if self.store is not None:
+            added = [self.store.add(self.namespace, key, True, self.window)
+                     for key in keys]
+            return not all(added)
+
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            found = any(key in self._seen for key in keys)
+            for key in keys:
+                self._seen[key] = now
+                self._seen.move_to_end(key)
+
+        return found
+
+    def recent(self, key):
+        """Return True if key was seen within the window, without
+        remembering it.
+        """
+        if self.store is not None:
+            try:
+                self.store.get(self.namespace, key)
+                return True
+            except KeyError:
+                return False
+
+        with self._lock:
+            self._expire(time.monotonic())
+            return key in self._seen
+
+    def remember(self, key):
+        """Return True and remember key if it wasn't seen within the
+        window.  Unlike seen(), a key already seen keeps its time.
+        """
+        if self.store is not None:
+            return self.store.add(self.namespace, key, True, self.window)
+
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._seen:
+                return False
+
+            self._seen[key] = now
+            return True
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        while self._seen and (
+                len(self._seen) > self.size or
+                next(iter(self._seen.values())) < now - self.window):
+            self._seen.popitem(last=False)
+
+
+class EventQueue(object):
+    """Bounded queue of event work run by a fixed set of threads."""
+    def __init__(self, size=1000, workers=8):
+        self._queue = Queue(maxsize=size)
+        self._workers = workers
+        self._started = False
+        self._lock = Lock()
+
+    def submit(self, fn, *args):
+        """Queue fn(*args), returning False if the queue is full."""
+        self._start()
+        try:
+            self._queue.put_nowait((fn, args))
+        except Full:
+            metrics_event_dropped()
+            return False
+
+        metrics_event_queued()
+        return True
+
+    def _start(self):
+        with self._lock:
+            if not self._started:
+                for n in range(self._workers):
+                    Thread(target=self._run, daemon=True,
+                           name='event-{}'.format(n)).start()
+                self._started = True
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            metrics_event_dequeued()
+            try:
+                fn(*args)
+            except Exception as ex:
+                logger.exception("event: {}".format(ex))
+
+
+class AsyncEventQueue(object):
+    """Coroutine version of EventQueue run by worker tasks on the
+    event loop.
+    """
+    def __init__(self, size=1000, workers=8):
+        self._size = size
+        self._workers = workers
+        self._queue = None
+
+    def submit(self, fn, *args):
+        """Queue coroutine function fn(*args), returning False if the
+        queue is full.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait((fn, args))
+        except asyncio.QueueFull:
+            metrics_event_dropped()
+            return False
+
+        metrics_event_queued()
+        return True
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self._size)
+            for n in range(self._workers):
+                asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            fn, args = await self._queue.get()
+            metrics_event_dequeued()
+            try:
+                await fn(*args)
+            except Exception as ex:
+                logger.exception("event: {}".format(ex))
+
+
+event_queue = EventQueue()
+async_event_queue = AsyncEventQueue()
+seen_events = SeenEvents()
+
+
+def init_event_queue(size, workers, window, store=None):
+    global event_queue, async_event_queue, seen_events
+
+    event_queue = EventQueue(size=size, workers=workers)
+    async_event_queue = AsyncEventQueue(size=size, workers=workers)
+    seen_events = SeenEvents(window=window, store=store)
+
+
+def duplicate_event(body, request):
+    """
+    Return True if the event in body was already received, counting
+    Slack's redeliveries
+    """
+    event = body.get('event', {})
+    duplicate = seen_events.seen(
+        body.get('event_id'), event.get('client_msg_id'))
+    if request and request.headers.get('x-slack-retry-num'):
+        metrics_event_retry('duplicate' if duplicate else 'processed')
+
+    return duplicate
@@ -0,0 +1,157 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class coalescing concurrent backend lookups of the same key
+"""
+from concurrent.futures import Future
+from threading import Lock
+from util.metrics import metrics_coalesced
+import asyncio
+
+
+class SingleFlight(object):
+    """Share one in-flight fetch of a key among every caller asking for
+    it meanwhile, so a link pasted into many channels at once is looked
+    up once.  Callers receive the fetch's result or the exception it
+    raised.  Threads and coroutines are coalesced separately, since an
+    asyncio future belongs to its event loop.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = Lock()
+
+    def fetch(self, fetch, key):
+        """Return fetch(key), sharing a call already fetching key."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                self._calls[key] = Future()
+
+        if call is not None:
+            metrics_coalesced(self.name)
+            return call.result()
+
+        try:
+            result = fetch(key)
+        except BaseException as ex:
+            self._finish({key: ex})
+            raise
+
+        self._finish({key: result})
+        return result
+
+    def fetch_many(self, fetch_many, keys):
+        """Return fetch_many(keys), a tuple of a dict of results by key
+        and a list of the keys not found, fetching only the keys no call
+        is already fetching and sharing the results of those that are.
+        """
+        waiting, leading = self._claim(self._calls, keys, Future)
+        found, missing = {}, []
+        if leading:
+            try:
+                found, missing = fetch_many(leading)
+            except BaseException as ex:
+                self._finish({key: ex for key in leading})
+                raise
+
+            self._finish(self._outcomes(leading, found))
+
+        for key, call in waiting.items():
+            try:
+                found[key] = call.result()
+            except KeyError:
+                missing.append(key)
+
+        return found, missing
+
+    async def async_fetch(self, fetch, key):
+        """Coroutine version of fetch() for a coroutine fetch(key)."""
+        call = self._async_calls.get(key)
+        if call is not None:
+            metrics_coalesced(self.name)
+            return await asyncio.shield(call)
+
+        self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fetch(key)
+        except BaseException as ex:
+            self._async_finish({key: ex})
+            raise
+
+        self._async_finish({key: result})
+        return result
+
+    async def async_fetch_many(self, fetch_many, keys):
+        """Coroutine version of fetch_many() for a coroutine
+        fetch_many(keys).
+        """
+        waiting, leading = self._claim(
+            self._async_calls, keys,
+            asyncio.get_running_loop().create_future)
+        found, missing = {}, []
+        if leading:
+            try:
+                found, missing = await fetch_many(leading)
+            except BaseException as ex:
+                self._async_finish({key: ex for key in leading})
+                raise
+
+            self._async_finish(self._outcomes(leading, found))
+
+        for key, call in waiting.items():
+            try:
+                found[key] = await asyncio.shield(call)
+            except KeyError:
+                missing.append(key)
+
+        return found, missing
+
+    def _claim(self, calls, keys, future):
+        """Return a dict of the calls already fetching keys and a list of
+        the keys left to fetch, registering a call for each of them.
+        """
+        with self._lock:
+            waiting = {key: calls[key] for key in keys if key in calls}
+            leading = [key for key in dict.fromkeys(keys)
+                       if key not in waiting]
+            for key in leading:
+                calls[key] = future()
+
+        if waiting:
+            metrics_coalesced(self.name, len(waiting))
+
+        return waiting, leading
+
+    @staticmethod
+    def _outcomes(keys, found):
+        return {key: found[key] if key in found else KeyError(
+            '{} not found'.format(key)) for key in keys}
+
+    def _finish(self, outcomes):
+        """Settle the calls for the keys in outcomes, a dict of result or
+        exception by key, and let the next caller fetch again.
+        """
+        with self._lock:
+            calls = [(self._calls.pop(key), outcome)
+                     for key, outcome in outcomes.items()]
+
+        for call, outcome in calls:
+            if isinstance(outcome, BaseException):
+                call.set_exception(outcome)
+            else:
+                call.set_result(outcome)
+
+    def _async_finish(self, outcomes):
+        for key, outcome in outcomes.items():
+            call = self._async_calls.pop(key)
+            if isinstance(outcome, asyncio.CancelledError):
+                call.cancel()
+            elif isinstance(outcome, BaseException):
+                call.set_exception(outcome)
+                # callers may all have gone, don't log it as unretrieved
+                call.exception()
+            else:
+                call.set_result(outcome)
@@ -0,0 +1,160 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Classes providing the HTTP transport shared by linkbot backend clients
+"""
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from urllib.parse import urlparse
+from util.metrics import metrics_backend_latency, metrics_circuit_state
+import util.workers
+import requests
+import random
+import time
+
+
+# responses worth retrying an idempotent request for
+RETRY_STATUS = (502, 503, 504)
+RETRY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of making a request to a host that is failing."""
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast once a host has failed failure_threshold requests in a
+    row, letting a single trial request through every reset_timeout
+    seconds until one succeeds.
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    failure_threshold = 5
+    reset_timeout = 30
+
+    def __init__(self, host):
+        self.host = host
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._trial = False
+        self._lock = Lock()
+
+    def check(self):
+        """Raise CircuitOpenError if a request to host should not be made."""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() < self._opened + self.reset_timeout:
+                    raise CircuitOpenError(
+                        'circuit open for {}'.format(self.host))
+                self._set_state(self.HALF_OPEN)
+            elif self.state == self.HALF_OPEN and self._trial:
+                raise CircuitOpenError(
+                    'circuit half-open for {}'.format(self.host))
+
+            self._trial = self.state == self.HALF_OPEN
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial = False
+            self._set_state(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if (self.state == self.HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                self._opened = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def abandon(self):
+        """Let another request try the host after a trial that ended
+        without telling whether the host works.
+        """
+        with self._lock:
+            self._trial = False
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            metrics_circuit_state(self.host, state)
+
+
+_breakers = {}
+_breakers_lock = Lock()
+
+
+def circuit_breaker(url):
+    """
+    Return the CircuitBreaker for url's host
+    """
+    host = urlparse(url).netloc
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+
+        return _breakers[host]
+
+
+def retry_delay(attempt, backoff):
+    """
+    Return seconds to wait before retry attempt, with full jitter
+    """
+    return random.uniform(0, backoff * (2 ** attempt))
+
+
+class BackendSession(requests.Session):
+    """
+    A requests.Session with connect and read timeouts, a connection pool
+    sized to the lookup concurrency, retries with jittered backoff for
+    idempotent requests and a circuit breaker per host.
+    """
+    timeout = (3.05, 10)
+    retries = 2
+    backoff = 0.25
+
+    def __init__(self, timeout=None, retries=None, pool_size=None):
+        super(BackendSession, self).__init__()
+        self.timeout = timeout or self.timeout
+        self.retries = self.retries if retries is None else retries
+        adapter = HTTPAdapter(
+            pool_maxsize=pool_size or util.workers.lookup_host_limit)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        breaker = circuit_breaker(url)
+        breaker.check()
+        retries = self.retries if method.upper() in RETRY_METHODS else 0
+        start = time.monotonic()
+        try:
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(retry_delay(attempt, self.backoff))
+                try:
+                    response = super(BackendSession, self).request(
+                        method, url, *args, **kwargs)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt < retries:
+                        continue
+                    raise
+                if response.status_code not in RETRY_STATUS:
+                    break
+        except Exception:
+            breaker.failure()
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+
+        metrics_backend_latency(breaker.host, time.monotonic() - start)
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
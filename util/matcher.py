@@ -0,0 +1,530 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class implementing a single-pass matcher across configured linkbots
+"""
+from util.events import duplicate_event
+from util.metrics import (
+    metrics_event_time, metrics_match_time, metrics_matched)
+from util.replies import (
+    post_replies, async_post_replies, post_progressive,
+    async_post_progressive, post_unfurls, async_post_unfurls)
+from functools import partial
+import util.events
+import asyncio
+import re
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# most literal strings a pattern's required set may hold
+LITERAL_LIMIT = 64
+
+# zero-width items don't break a run of literals
+_ZERO_WIDTH = (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT)
+_REPEATS = tuple(op for op in (
+    sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+    getattr(sre_parse, 'POSSESSIVE_REPEAT', None)) if op is not None)
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+class MatchIndex(object):
+    """Merge every bot's MATCH into one compiled alternation of named
+    lookahead groups so each message is scanned once, and dispatch each
+    hit to the bot that owns it.
+
+    Per-bot semantics are preserved: a match must start the text or
+    follow a non-word character, matching is case-insensitive, a bot
+    never matches inside its own previous match, and each bot sees its
+    matches once, in the order they appear.  Bots whose MATCH cannot be
+    merged (backreferences, conflicting group names) are scanned with
+    their own regex.
+
+    Messages are prefiltered: when every bot's MATCH requires one of a
+    set of literal strings, a message containing none of them is passed
+    over without running a regex.  Bots whose MATCH has no such literal
+    are always scanned.
+
+    With unfurl, links to a bot's records are answered by unfurling
+    them on link_shared events, and messages aren't also replied to for
+    them.
+
+    With progressive, replies of bots that enrich links are posted as
+    plain links at once, then updated with the summaries looked up
+    within progressive seconds.
+    """
+    _unmergeable_regex = re.compile(r'\\[1-9]|\(\?P=')
+    _nonword_regex = re.compile(r'\W*')
+    _url_regex = re.compile(r'<(https?://[^|>\s]+)(\|[^>]*)?>')
+
+    def __init__(self, bot_list, prefilter=True, unfurl=False,
+                 progressive=None):
+        self._unfurl = unfurl
+        self._progressive = progressive
+        self._groups = []
+        self._fallback = []
+        self._regex = None
+        self._literals = None
+        self._fallback_literals = {}
+
+        lookaheads = []
+        for bot in bot_list:
+            match = bot.match_source()
+            if self._unmergeable_regex.search(match):
+                self._fallback.append(bot)
+                continue
+
+            group = 'bot{}'.format(len(self._groups))
+            self._groups.append((group, bot))
+            lookaheads.append((match, group))
+
+        if lookaheads:
+            pattern = r'(?<!\w)(?={})'.format(
+                '|'.join('(?:{})'.format(m) for m, g in lookaheads))
+            pattern += ''.join('(?=(?P<{}>{}))?'.format(g, m)
+                               for m, g in lookaheads)
+            try:
+                self._regex = re.compile(pattern, flags=re.I)
+            except re.error:
+                self._fallback = list(bot_list)
+                self._groups = []
+
+        if prefilter:
+            self._literals = merge_literals(
+                [required_literals(bot.match_source())
+                 for group, bot in self._groups])
+            self._fallback_literals = {
+                bot: required_literals(bot.match_source())
+                for bot in self._fallback}
+
+    def bots(self):
+        return [bot for group, bot in self._groups] + self._fallback
+
+    def unsuppressed(self, matched, message):
+        """Return the (bot, matches) tuples in matched left with matches
+        not recently expanded where message was posted.
+        """
+        matched = [(bot, bot.unsuppressed(matches, message))
+                   for bot, matches in matched]
+        return [(bot, matches) for bot, matches in matched if matches]
+
+    def match(self, text):
+        """Return a list of (bot, matches) tuples for text, where matches
+        is the list of unique labels the bot matched, in order.
+        """
+        # re.I folds a few non-ASCII characters that lower() doesn't
+        lowered = text.lower() if text.isascii() else None
+        hits = {group: {} for group, bot in self._groups}
+        if self._regex and self._candidate(lowered, self._literals):
+            start = time.monotonic()
+            pending = {}
+            for found in self._regex.finditer(text):
+                for group, label in found.groupdict().items():
+                    if label is None:
+                        continue
+
+                    begin = found.start(group)
+                    last = pending.get(group)
+                    if last and begin < last[1] + 1:
+                        # past \A the per-bot (\A|\W)+ prefix is greedy,
+                        # so a later start in the same non-word run wins
+                        if not (last[0] and self._nonword_regex.fullmatch(
+                                text, last[0], begin)):
+                            continue
+                    elif last:
+                        hits[group].setdefault(last[2], None)
+
+                    pending[group] = (begin, found.end(group), label)
+
+            for group, last in pending.items():
+                hits[group].setdefault(last[2], None)
+
+            # merged bots share one scan
+            metrics_match_time('index', time.monotonic() - start)
+
+        matched = [(bot, list(hits[group])) for group, bot in self._groups
+                   if hits[group]]
+        for bot in self._fallback:
+            if not self._candidate(lowered,
+                                   self._fallback_literals.get(bot)):
+                continue
+
+            start = time.monotonic()
+            matches = bot.match(text)
+            metrics_match_time(bot.name(), time.monotonic() - start)
+            if matches:
+                matched.append((bot, list(matches)))
+
+        for bot, matches in matched:
+            metrics_matched(bot.name(), len(matches))
+
+        return matched
+
+    def match_urls(self, links):
+        """Return a list of (bot, urls) tuples for the links of a
+        link_shared event, where urls is a dict of the label of each
+        link the bot unfurls by url.
+        """
+        matched = {}
+        for link in links:
+            url = link.get('url', '')
+            for bot in self.bots():
+                label = bot.url_label(url)
+                if label:
+                    matched.setdefault(bot, {})[url] = label
+                    break
+
+        return list(matched.items())
+
+    def message_text(self, message):
+        """Return message's text, less any links unfurled instead."""
+        text = message.get('text', '')
+        if self._unfurl and '<http' in text:
+            text = self._url_regex.sub(self._unfurled, text)
+
+        return text
+
+    def _unfurled(self, found):
+        if any(bot.url_label(found.group(1)) for bot in self.bots()):
+            return ' '
+
+        return found.group(0)
+
+    def rejects(self, text):
+        """Return True if the prefilter passes over text without running
+        any regex.
+        """
+        lowered = text.lower() if text.isascii() else None
+        return not (self._regex and self._candidate(
+            lowered, self._literals)) and not any(
+                self._candidate(lowered, self._fallback_literals.get(bot))
+                for bot in self._fallback)
+
+    @staticmethod
+    def _candidate(lowered, literals):
+        """Return False if lowered text can't match, lacking literals."""
+        return lowered is None or literals is None or any(
+            literal in lowered for literal in literals)
+
+    def send_message(self, message, context, say, client, logger,
+                     body=None, request=None):
+        """Bolt message event handler queueing a reply for every matching
+        bot, or replying with plain links if the queue is full.
+        """
+        if context.get('is_bot_message'):
+            logger.debug('Ignore bot message')
+            return
+
+        if duplicate_event(body or {}, request):
+            logger.debug('Ignore duplicate event')
+            return
+
+        start = time.monotonic()
+        matched = self.unsuppressed(
+            self.match(self.message_text(message)), message)
+        if matched and not util.events.event_queue.submit(
+                self.reply, matched, message, say, client, logger, start):
+            post_replies([text for bot, matches in matched
+                          for text in bot.plain_replies(matches)],
+                         message, say, client, logger)
+
+    def reply(self, matched, message, say, client, logger, start):
+        """Post every matching bot's replies to message as one reply."""
+        if self._enriching(matched):
+            # start every bot's lookups before posting plain links
+            replies = []
+            for bot, matches in matched:
+                if bot.enriches:
+                    replies.extend(zip(bot.plain_replies(matches),
+                                       bot.summaries(matches)))
+                else:
+                    replies.extend((text, None)
+                                   for text in bot.replies(matches))
+
+            post_progressive(replies, message, say, client, logger,
+                             self._progressive, start,
+                             posted=partial(self._posted, matched, message))
+        else:
+            # start every bot's lookups before waiting on any
+            texts = [text for bot, matches in matched
+                     for text in bot.replies(matches)]
+            post_replies(texts, message, say, client, logger,
+                         posted=partial(self._posted, matched, message))
+
+        metrics_event_time(time.monotonic() - start)
+
+    async def async_send_message(self, message, context, say, client,
+                                 logger, body=None, request=None):
+        """Coroutine version of send_message for AsyncApp."""
+        if context.get('is_bot_message'):
+            logger.debug('Ignore bot message')
+            return
+
+        if duplicate_event(body or {}, request):
+            logger.debug('Ignore duplicate event')
+            return
+
+        start = time.monotonic()
+        matched = self.unsuppressed(
+            self.match(self.message_text(message)), message)
+        if matched and not util.events.async_event_queue.submit(
+                self.async_reply, matched, message, say, client, logger,
+                start):
+            await async_post_replies(
+                [text for bot, matches in matched
+                 for text in bot.plain_texts(matches)],
+                message, say, client, logger)
+
+    async def async_reply(self, matched, message, say, client, logger,
+                          start):
+        """Coroutine version of reply()."""
+        if self._enriching(matched):
+            summaries = [asyncio.ensure_future(bot.async_summaries(matches))
+                         if bot.enriches else None
+                         for bot, matches in matched]
+            replies = []
+            for (bot, matches), task in zip(matched, summaries):
+                if task is None:
+                    replies.append((await bot.async_replies(matches), None))
+                else:
+                    replies.append((bot.plain_texts(matches), task))
+
+            await async_post_progressive(
+                replies, message, say, client, logger, self._progressive,
+                start, posted=partial(self._posted, matched, message))
+        else:
+            pending = await asyncio.gather(
+                *[bot.async_replies(matches) for bot, matches in matched])
+            await async_post_replies(
+                [text for texts in pending for text in texts],
+                message, say, client, logger,
+                posted=partial(self._posted, matched, message))
+
+        metrics_event_time(time.monotonic() - start)
+
+    @staticmethod
+    def _posted(matched, message, indexes):
+        """Remember the matches at indexes, counting every bot's matches
+        in turn, as expanded where message was posted.
+        """
+        labels = [(bot, match) for bot, matches in matched
+                  for match in matches]
+        expanded = {}
+        for n in indexes:
+            bot, match = labels[n]
+            expanded.setdefault(bot, []).append(match)
+
+        for bot, matches in expanded.items():
+            bot.expanded(matches, message)
+
+    def _enriching(self, matched):
+        """Return True if replies to matched post plain links first."""
+        return self._progressive is not None and any(
+            bot.enriches for bot, matches in matched)
+
+    def unfurl(self, event, client, logger, body=None, request=None):
+        """Bolt link_shared event handler queueing one unfurl of every
+        link a bot recognizes.
+        """
+        if duplicate_event(body or {}, request):
+            logger.debug('Ignore duplicate event')
+            return
+
+        matched = self.match_urls(event.get('links', []))
+        if matched and not util.events.event_queue.submit(
+                self.send_unfurls, matched, event, client, logger):
+            logger.warning('Event queue full, not unfurling')
+
+    def send_unfurls(self, matched, event, client, logger):
+        """Unfurl every matching bot's links in one chat.unfurl, each bot
+        looking up its links in one batch.
+        """
+        # start every bot's lookups before waiting on any
+        pending = [(urls, bot.unfurls(set(urls.values())))
+                   for bot, urls in matched]
+        unfurls = {}
+        for urls, attachments in pending:
+            try:
+                attachments = attachments.result()
+            except Exception as ex:
+                logger.error("unfurl: {}".format(ex))
+                continue
+
+            unfurls.update({url: attachments[label]
+                            for url, label in urls.items()
+                            if label in attachments})
+
+        if unfurls:
+            post_unfurls(unfurls, event, client, logger)
+
+    async def async_unfurl(self, event, client, logger, body=None,
+                           request=None):
+        """Coroutine version of unfurl for AsyncApp."""
+        if duplicate_event(body or {}, request):
+            logger.debug('Ignore duplicate event')
+            return
+
+        matched = self.match_urls(event.get('links', []))
+        if matched and not util.events.async_event_queue.submit(
+                self.async_send_unfurls, matched, event, client, logger):
+            logger.warning('Event queue full, not unfurling')
+
+    async def async_send_unfurls(self, matched, event, client, logger):
+        """Coroutine version of send_unfurls()."""
+        pending = await asyncio.gather(
+            *[bot.async_unfurls(set(urls.values())) for bot, urls in matched],
+            return_exceptions=True)
+        unfurls = {}
+        for (bot, urls), attachments in zip(matched, pending):
+            if isinstance(attachments, Exception):
+                logger.error("unfurl: {}".format(attachments))
+                continue
+
+            unfurls.update({url: attachments[label]
+                            for url, label in urls.items()
+                            if label in attachments})
+
+        if unfurls:
+            await async_post_unfurls(unfurls, event, client, logger)
+
+
+def required_literals(pattern):
+    """Return a set of lower case strings at least one of which appears
+    in any case-insensitive match of pattern, or None if there is none
+    worth checking.
+    """
+    try:
+        literals = _sequence_literals(sre_parse.parse(pattern, re.I))
+    except (re.error, RecursionError):
+        return None
+
+    return _minimal(literals)
+
+
+def merge_literals(literal_sets):
+    """Return the strings at least one of which appears in text matching
+    any of literal_sets, or None if any set is None or there are none.
+    """
+    merged = set()
+    for literals in literal_sets:
+        if literals is None:
+            return None
+        merged |= literals
+
+    return _minimal(merged)
+
+
+def _minimal(literals):
+    """Return literals less any string containing another, which is
+    found whenever the one it contains is, or None if none are left.
+    """
+    if not literals or '' in literals:
+        return None
+
+    minimal = set()
+    for literal in sorted(literals, key=len):
+        if not any(shorter in literal for shorter in minimal):
+            minimal.add(literal)
+
+    return frozenset(minimal)
+
+
+def _sequence_literals(items):
+    """Return the most selective set of strings one of which a match of
+    the sequence of parsed items must contain, or None.
+    """
+    best = None
+    run = {''}
+    for op, av in items:
+        strings = _exact_strings(op, av)
+        if strings is not None and len(run) * len(strings) <= LITERAL_LIMIT:
+            run = {a + b for a in run for b in strings}
+            continue
+
+        best = _selective(best, run)
+        if strings is not None:
+            run = strings
+        else:
+            run = {''}
+            best = _selective(best, _item_literals(op, av))
+
+    return _selective(best, run)
+
+
+def _exact_strings(op, av):
+    """Return the set of every string the parsed item matches, lower
+    cased, or None if it isn't a small set of ASCII literals.
+    """
+    if op in _ZERO_WIDTH:
+        return {''}
+    if op == sre_parse.LITERAL:
+        return {chr(av).lower()} if av < 128 else None
+    if op == sre_parse.IN:
+        if all(o == sre_parse.LITERAL and a < 128 for o, a in av):
+            return {chr(a).lower() for o, a in av}
+        return None
+    if op == sre_parse.SUBPATTERN:
+        return _exact_sequence(av[-1])
+    if _ATOMIC_GROUP is not None and op == _ATOMIC_GROUP:
+        return _exact_sequence(av)
+    if op == sre_parse.BRANCH:
+        strings = set()
+        for branch in av[1]:
+            exact = _exact_sequence(branch)
+            if exact is None:
+                return None
+            strings |= exact
+        return strings if len(strings) <= LITERAL_LIMIT else None
+
+    return None
+
+
+def _exact_sequence(items):
+    strings = {''}
+    for op, av in items:
+        exact = _exact_strings(op, av)
+        if exact is None or len(strings) * len(exact) > LITERAL_LIMIT:
+            return None
+        strings = {a + b for a in strings for b in exact}
+
+    return strings
+
+
+def _item_literals(op, av):
+    """Return the strings one of which a match of a parsed item that
+    isn't a small set of literals must contain, or None.
+    """
+    if op == sre_parse.SUBPATTERN:
+        return _sequence_literals(av[-1])
+    if _ATOMIC_GROUP is not None and op == _ATOMIC_GROUP:
+        return _sequence_literals(av)
+    if op == sre_parse.BRANCH:
+        literals = set()
+        for branch in av[1]:
+            required = _sequence_literals(branch)
+            if required is None:
+                return None
+            literals |= required
+        return literals if len(literals) <= LITERAL_LIMIT else None
+    if op in _REPEATS and av[0] > 0:
+        return _sequence_literals(av[2])
+
+    return None
+
+
+def _selective(a, b):
+    """Return the more selective of two required literal sets: the one
+    whose shortest string is longer, then the smaller.
+    """
+    if not a or '' in a:
+        return b if b and '' not in b else None
+    if not b or '' in b:
+        return a
+
+    rank_a = (min(map(len, a)), -len(a))
+    rank_b = (min(map(len, b)), -len(b))
+    return a if rank_a >= rank_b else b
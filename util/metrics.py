@@ -5,8 +5,22 @@
 # SPDX-License-Identifier: Apache-2.0
 """
 Functions supporting Prometheus metrics
+
+When PROMETHEUS_MULTIPROC_DIR names a directory, every linkbot process
+writes its samples there and the metrics server reports their sum.
 """
-from prometheus_client import start_http_server, Counter
+from prometheus_client import (
+    start_http_server, CollectorRegistry, Counter, Gauge, Histogram,
+    multiprocess, REGISTRY)
+from threading import Lock
+import os
+
+# channel label settings, see init_metrics()
+OTHER_CHANNEL = 'other'
+_channel_allow = None
+_channel_limit = 100
+_channels = set()
+_channels_lock = Lock()
 
 # prepare metrics
 linkbot_message_count = Counter(
@@ -14,16 +28,413 @@ linkbot_message_count = Counter(
     'LinkBot message match and sent count',
     ['channel'])
 
+linkbot_match_count = Counter(
+    'match_count',
+    'LinkBot links matched in messages, before suppression',
+    ['bot'])
+
+linkbot_cache_count = Counter(
+    'lookup_cache_count',
+    'LinkBot lookup cache hit, stale, miss and eviction count',
+    ['bot', 'event'])
+
+linkbot_coalesced_count = Counter(
+    'lookup_coalesced_count',
+    'LinkBot backend lookups saved by sharing one already in flight',
+    ['bot'])
+
+linkbot_lookup_queue = Gauge(
+    'lookup_queue_depth',
+    'LinkBot lookups waiting for a worker',
+    multiprocess_mode='livesum')
+
+linkbot_lookup_wait = Histogram(
+    'lookup_wait_seconds',
+    'LinkBot lookup wait for its host and a worker in seconds',
+    ['host'])
+
+linkbot_saml_login_count = Counter(
+    'saml_login_count',
+    'LinkBot UW SAML IdP login count',
+    ['result'])
+
+linkbot_saml_login_time = Histogram(
+    'saml_login_seconds',
+    'LinkBot UW SAML IdP login time in seconds')
+
+linkbot_backend_latency = Histogram(
+    'backend_request_seconds',
+    'LinkBot backend request latency in seconds, including retries',
+    ['host'])
+
+linkbot_circuit_state = Gauge(
+    'backend_circuit_state',
+    'LinkBot backend circuit breaker state (0 closed, 1 half-open, 2 open)',
+    ['host'],
+    multiprocess_mode='livemax')
+
+linkbot_event_time = Histogram(
+    'event_handling_seconds',
+    'LinkBot message event handling time in seconds, match to last reply')
+
+linkbot_reply_time = Histogram(
+    'reply_seconds',
+    'LinkBot progressive reply time in seconds, from match to posting plain'
+    ' links (first) and to updating them with summaries (enriched)',
+    ['stage'])
+
+linkbot_enrich_count = Counter(
+    'enrich_count',
+    'LinkBot progressive reply summaries, by result',
+    ['result'])
+
+linkbot_match_time = Histogram(
+    'match_seconds',
+    'LinkBot message match time in seconds',
+    ['bot'],
+    buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025,
+             .05, .1))
+
+linkbot_lookup_time = Histogram(
+    'lookup_seconds',
+    'LinkBot lookup time in seconds, including the cache',
+    ['bot', 'outcome'])
+
+linkbot_post_time = Histogram(
+    'slack_post_seconds',
+    'LinkBot Slack message post time in seconds')
+
+linkbot_post_delay = Histogram(
+    'slack_post_delay_seconds',
+    'LinkBot seconds a post waited on its channel rate limit',
+    buckets=(0, .1, .25, .5, 1, 2, 5, 10, 30))
+
+linkbot_rate_limited = Counter(
+    'slack_rate_limited_count',
+    'LinkBot Slack posts answered 429 and retried after Retry-After')
+
+linkbot_suppressed_count = Counter(
+    'mention_suppressed_count',
+    'LinkBot mentions not expanded, expanded recently in the same place',
+    ['bot'])
+
+linkbot_event_queue = Gauge(
+    'event_queue_depth',
+    'LinkBot message events waiting for a worker',
+    multiprocess_mode='livesum')
+
+linkbot_event_dropped = Counter(
+    'event_dropped_count',
+    'LinkBot message events answered with plain links, queue full')
+
+linkbot_event_retry = Counter(
+    'event_retry_count',
+    'LinkBot Slack event redeliveries, duplicate or processed',
+    ['result'])
+
+linkbot_webhook_request = Counter(
+    'webhook_request_count',
+    'LinkBot backend webhook requests by source and result',
+    ['source', 'result'])
+
+linkbot_webhook_update = Counter(
+    'webhook_invalidation_count',
+    'LinkBot cached records updated or evicted by backend webhooks',
+    ['source', 'action'])
+
+linkbot_snapshot_size = Gauge(
+    'snapshot_size_bytes',
+    'LinkBot size of the cache snapshot last saved or loaded',
+    multiprocess_mode='max')
+
+linkbot_snapshot_time = Gauge(
+    'snapshot_seconds',
+    'LinkBot seconds the last cache snapshot save or load took',
+    ['operation'],
+    multiprocess_mode='max')
+
+linkbot_snapshot_load = Counter(
+    'snapshot_load_count',
+    'LinkBot cache snapshot loads by result',
+    ['result'])
+
+linkbot_startup = Gauge(
+    'startup_seconds',
+    'LinkBot seconds from process start to listening and first reply',
+    ['phase'],
+    multiprocess_mode='max')
+
+
+def init_metrics(channels=None, channel_limit=100):
+    """
+    Bound message_sent_count channel labels to the channels allow-list,
+    if given, otherwise to the first channel_limit channels seen.  Other
+    channels are counted as OTHER_CHANNEL.
+    """
+    global _channel_allow, _channel_limit
+
+    _channel_allow = set(channels) if channels is not None else None
+    _channel_limit = channel_limit
+
+
+def channel_label(channel_name):
+    """
+    Return the message_sent_count label for channel_name, "other" for a
+    channel whose name isn't known yet
+    """
+    if channel_name is None:
+        return OTHER_CHANNEL
+
+    if _channel_allow is not None:
+        return channel_name if channel_name in _channel_allow else (
+            OTHER_CHANNEL)
+
+    with _channels_lock:
+        if channel_name in _channels:
+            return channel_name
+
+        if len(_channels) < _channel_limit:
+            _channels.add(channel_name)
+            return channel_name
 
-def metrics_counter(channel_name):
+    return OTHER_CHANNEL
+
+
+def metrics_counter(channel_name, count=1):
     """
     Increment channel_name message counter
     """
-    linkbot_message_count.labels(channel_name).inc()
+    linkbot_message_count.labels(channel_label(channel_name)).inc(count)
+
+
+def metrics_matched(bot_name, count):
+    """
+    Count links a bot matched
+    """
+    linkbot_match_count.labels(bot_name).inc(count)
+
+
+def metrics_coalesced(bot_name, count=1):
+    """
+    Count backend lookups saved by sharing one already in flight
+    """
+    linkbot_coalesced_count.labels(bot_name).inc(count)
+
+
+def metrics_cache(bot_name, event):
+    """
+    Increment bot_name lookup cache event counter
+    """
+    linkbot_cache_count.labels(bot_name, event).inc()
+
+
+def metrics_lookup_queued():
+    """
+    Count a lookup waiting for a worker
+    """
+    linkbot_lookup_queue.inc()
+
+
+def metrics_lookup_started(host, wait):
+    """
+    Record the time a lookup against host waited to start, for the host's
+    limit and a worker
+    """
+    linkbot_lookup_queue.dec()
+    linkbot_lookup_wait.labels(host).observe(wait)
+
+
+def metrics_saml_login(seconds, result):
+    """
+    Record an IdP login and the time it took
+    """
+    linkbot_saml_login_count.labels(result).inc()
+    linkbot_saml_login_time.observe(seconds)
+
+
+def metrics_backend_latency(host, seconds):
+    """
+    Record the time a backend request to host took
+    """
+    linkbot_backend_latency.labels(host).observe(seconds)
+
+
+def metrics_circuit_state(host, state):
+    """
+    Record host's circuit breaker state
+    """
+    linkbot_circuit_state.labels(host).set(state)
+
+
+def metrics_event_time(seconds):
+    """
+    Record the time handling a message event took
+    """
+    linkbot_event_time.observe(seconds)
+
+
+def metrics_reply_time(stage, seconds):
+    """
+    Record the time a progressive reply took to reach stage
+    """
+    linkbot_reply_time.labels(stage).observe(seconds)
+
+
+def metrics_enriched(result, count=1):
+    """
+    Count progressive reply summaries with result
+    """
+    linkbot_enrich_count.labels(result).inc(count)
+
+
+def metrics_match_time(bot_name, seconds):
+    """
+    Record the time matching a message for bot_name took
+    """
+    linkbot_match_time.labels(bot_name).observe(seconds)
+
+
+def metrics_lookup_time(bot_name, outcome, seconds):
+    """
+    Record the time a bot_name lookup with outcome took
+    """
+    linkbot_lookup_time.labels(bot_name, outcome).observe(seconds)
+
+
+def metrics_post_time(seconds):
+    """
+    Record the time posting a message to Slack took
+    """
+    linkbot_post_time.observe(seconds)
+
+
+def metrics_post_delay(seconds):
+    """
+    Record the time a post waited on its channel rate limit
+    """
+    linkbot_post_delay.observe(seconds)
+
+
+def metrics_rate_limited():
+    """
+    Count a post Slack rate limited
+    """
+    linkbot_rate_limited.inc()
+
+
+def metrics_suppressed(bot_name, count):
+    """
+    Count bot_name mentions suppressed as recently expanded
+    """
+    linkbot_suppressed_count.labels(bot_name).inc(count)
+
+
+def metrics_event_queued():
+    """
+    Count a message event waiting for a worker
+    """
+    linkbot_event_queue.inc()
+
+
+def metrics_event_dequeued():
+    """
+    Count a message event taken by a worker
+    """
+    linkbot_event_queue.dec()
+
+
+def metrics_event_dropped():
+    """
+    Count a message event shed because the queue was full
+    """
+    linkbot_event_dropped.inc()
+
+
+def metrics_event_retry(result):
+    """
+    Count a Slack event redelivery
+    """
+    linkbot_event_retry.labels(result).inc()
+
+
+def metrics_webhook_request(source, result):
+    """
+    Count a backend webhook request
+    """
+    linkbot_webhook_request.labels(source, result).inc()
+
+
+def metrics_webhook_update(source, action, count=1):
+    """
+    Count cached records a backend webhook updated or evicted
+    """
+    linkbot_webhook_update.labels(source, action).inc(count)
+
+
+def metrics_snapshot(operation, seconds, size):
+    """
+    Record the time and size of a cache snapshot save or load
+    """
+    linkbot_snapshot_time.labels(operation).set(seconds)
+    linkbot_snapshot_size.set(size)
+
+
+def metrics_snapshot_load(result):
+    """
+    Count a cache snapshot load: ok, missing, corrupt or old_format
+    """
+    linkbot_snapshot_load.labels(result).inc()
+
+
+def metrics_startup(phase, seconds):
+    """
+    Record the seconds from process start to a startup phase
+    """
+    linkbot_startup.labels(phase).set(seconds)
+
+
+def metrics_reset():
+    """
+    Remove samples left in the multiprocess directory by earlier runs
+    """
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        keep = '_{}.db'.format(os.getpid())
+        for name in os.listdir(path):
+            if name.endswith('.db') and not name.endswith(keep):
+                os.remove(os.path.join(path, name))
+
+
+def metrics_samples():
+    """
+    Return a list of every metric's current samples, aggregated across
+    processes in multiprocess mode
+    """
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    return [sample for metric in registry.collect()
+            for sample in metric.samples]
+
+
+def metrics_process_exit(pid):
+    """
+    Discard the live gauges of exited process pid
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
 
 
 def metrics_server(port):
     """
-    Serve metrics requests
+    Serve metrics requests, aggregated across processes in multiprocess
+    mode
     """
-    start_http_server(port)
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+    else:
+        start_http_server(port)
@@ -0,0 +1,67 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class sampling every thread's stack into a collapsed stack profile
+"""
+from collections import Counter
+from threading import Lock
+import sys
+import threading
+import time
+
+
+class StackSampler(object):
+    """Sampling profiler counting the distinct stacks of every thread,
+    sampled interval seconds apart.  Profiles are returned as collapsed
+    stacks, one "thread;outer;...;inner count" line per stack, the input
+    of flamegraph.pl and speedscope.  Nothing is sampled between
+    profiles, and only one runs at a time.
+    """
+    def __init__(self, interval=0.01, max_seconds=60):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = Lock()
+
+    def profile(self, seconds):
+        """Sample for seconds, at most max_seconds, returning the
+        collapsed stacks, or None if a profile is already running.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+
+        try:
+            stacks = self._sample(min(seconds, self.max_seconds))
+        finally:
+            self._lock.release()
+
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in stacks.most_common())
+
+    def _sample(self, seconds):
+        stacks = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stacks[self._stack(names.get(ident, ident), frame)] += 1
+
+            time.sleep(self.interval)
+
+        return stacks
+
+    @staticmethod
+    def _stack(thread, frame):
+        names = []
+        while frame is not None:
+            names.append('{}:{}'.format(
+                frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+            frame = frame.f_back
+
+        return ';'.join([str(thread)] + names[::-1])
+
+
+stack_sampler = StackSampler()
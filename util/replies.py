@@ -0,0 +1,577 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class and functions posting each message's replies to Slack as one post
+through a per-channel rate limiter, progressively updated with summaries
+if need be, and each link_shared event's unfurls as one chat.unfurl
+"""
+from collections import OrderedDict
+from functools import partial
+from threading import Lock, Timer
+from util import channel_name, async_channel_name
+from util.metrics import (
+    metrics_counter, metrics_post_time, metrics_post_delay,
+    metrics_rate_limited, metrics_reply_time, metrics_enriched)
+from util.startup import startup_replied
+import util.events
+import asyncio
+import time
+
+
+# Slack truncates message text much longer than this
+MAX_TEXT = 4000
+SEPARATOR = '\n\n'
+
+# times a post answered with a 429 is retried
+RATE_LIMIT_RETRIES = 2
+
+
+class ChannelLimiter(object):
+    """Token bucket for each of at most size channels, allowing rate
+    posts a second in bursts of up to burst.  A channel Slack has
+    rate limited is held for the Retry-After it asked for.
+    """
+    def __init__(self, rate=1.0, burst=3, size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def reserve(self, channel):
+        """Take a token for channel, returning the seconds to wait for
+        it before posting.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, held = self._bucket(channel, now)
+            tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+            self._buckets[channel] = (tokens, now, held)
+
+        return max(0, -tokens / self.rate, held - now)
+
+    def hold(self, channel, seconds):
+        """Hold posts to channel for seconds."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, held = self._bucket(channel, now)
+            self._buckets[channel] = (tokens, updated,
+                                      max(held, now + seconds))
+
+    def _bucket(self, channel, now):
+        bucket = self._buckets.pop(channel, None)
+        if bucket is None:
+            bucket = (self.burst, now, 0)
+            while len(self._buckets) >= self.size:
+                self._buckets.popitem(last=False)
+
+        return bucket
+
+
+channel_limiter = ChannelLimiter()
+
+
+def init_channel_limiter(rate, burst):
+    global channel_limiter
+
+    channel_limiter = ChannelLimiter(rate=rate, burst=burst)
+
+
+def join_replies(texts):
+    """Return a list of (text, count) tuples joining texts into as few
+    posts as fit MAX_TEXT, with the count of texts joined into each.
+    """
+    posts = []
+    for text in texts:
+        if posts and len(posts[-1][0]) + len(SEPARATOR) + len(text) <= \
+                MAX_TEXT:
+            posts[-1] = (posts[-1][0] + SEPARATOR + text, posts[-1][1] + 1)
+        else:
+            posts.append((text, 1))
+
+    return posts
+
+
+def post_replies(texts, message, say, client, logger, posted=None):
+    """Post the futures of message text in texts, in order, as one reply
+    to message, leaving out those that failed.  posted, if given, is
+    called with the indexes of the texts that were posted.
+    """
+    replies, kept = [], []
+    for n, text in enumerate(texts):
+        try:
+            replies.append(text.result())
+            kept.append(n)
+        except Exception as ex:
+            logger.error("send_message: {}".format(ex))
+
+    _post_replies(replies, message, say, client, logger,
+                  partial(_report, posted, kept) if posted else None)
+
+
+async def async_post_replies(texts, message, say, client, logger,
+                             posted=None):
+    """Coroutine version of post_replies() for texts that are message
+    text or the exception raised building it.
+    """
+    replies, kept = [], []
+    for n, text in enumerate(texts):
+        if isinstance(text, Exception):
+            logger.error("send_message: {}".format(text))
+        else:
+            replies.append(text)
+            kept.append(n)
+
+    await _async_post_replies(
+        replies, message, say, client, logger,
+        partial(_report, posted, kept) if posted else None)
+
+
+def post_progressive(replies, message, say, client, logger, budget, start,
+                     posted=None):
+    """Post the (text, summary) futures in replies, in order, as one reply
+    to message, at once with each text, leaving out those that failed.
+    Then queue an update of the reply with each text followed by its
+    summary, once every summary is looked up or budget seconds after
+    posting, whichever comes first.  A text whose summary failed or is
+    late is left as posted.
+    start is when message was matched.  posted, if given, is called with
+    the indexes of the replies posted in full, with their summary if
+    they have one.
+    """
+    texts, summaries, kept = [], [], []
+    for n, (text, summary) in enumerate(replies):
+        try:
+            texts.append(text.result())
+            summaries.append(summary)
+            kept.append(n)
+        except Exception as ex:
+            logger.error("send_message: {}".format(ex))
+
+    _post_replies(texts, message, say, client, logger, partial(
+        _progress, texts, summaries, kept, message, client, logger, budget,
+        start, posted))
+
+
+def _progress(texts, summaries, kept, message, client, logger, budget,
+              start, posted, posts):
+    """Queue the update of posts, the first reply of post_progressive(),
+    once every summary is looked up or budget seconds from now.
+    """
+    metrics_reply_time('first', time.monotonic() - start)
+    if posted:
+        posted([kept[n] for n in _posted(posts) if summaries[n] is None])
+        posted = partial(_reindexed, posted, kept)
+
+    pending = set(summary for summary in summaries if summary is not None)
+    if not pending:
+        return
+
+    # don't hold an event worker while the lookups finish
+    arrived = set()
+    lock = Lock()
+
+    def settle(summary):
+        with lock:
+            if arrived is None:
+                return
+
+            arrived.add(summary)
+            last = len(arrived) == len(pending)
+
+        if last:
+            timer.cancel()
+            update()
+
+    def update():
+        nonlocal arrived
+        with lock:
+            if arrived is None:
+                return
+
+            settled, arrived = arrived, None
+
+        if not util.events.event_queue.submit(
+                _update_progressive, posts, texts, summaries, settled,
+                message, client, logger, start, posted):
+            logger.warning('Event queue full, not updating replies')
+
+    timer = Timer(budget, update)
+    timer.daemon = True
+    timer.start()
+    for summary in pending:
+        summary.add_done_callback(settle)
+
+
+async def async_post_progressive(replies, message, say, client, logger,
+                                 budget, start, posted=None):
+    """Coroutine version of post_progressive() for replies that are, for
+    each bot, a tuple of a list of message text or the exception raised
+    building it, and a task of a list of the summary of each text or the
+    exception raised looking it up, or None.  posted is called with
+    indexes into the bots' texts taken in turn.
+    """
+    texts, summaries, kept = [], [], []
+    index = 0
+    for bot_texts, task in replies:
+        for n, text in enumerate(bot_texts):
+            if isinstance(text, Exception):
+                logger.error("send_message: {}".format(text))
+            else:
+                texts.append(text)
+                summaries.append((task, n))
+                kept.append(index)
+            index += 1
+
+    pending = set(task for bot_texts, task in replies if task is not None)
+    await _async_post_replies(texts, message, say, client, logger, partial(
+        _async_progress, texts, summaries, kept, pending, message, client,
+        logger, budget, start, posted))
+
+
+def _async_progress(texts, summaries, kept, pending, message, client,
+                    logger, budget, start, posted, posts):
+    metrics_reply_time('first', time.monotonic() - start)
+    if posted:
+        posted([kept[n] for n in _posted(posts) if summaries[n][0] is None])
+        posted = partial(_reindexed, posted, kept)
+
+    if not pending:
+        return
+
+    arrived = set()
+
+    def settle(task):
+        if arrived is not None:
+            arrived.add(task)
+            if len(arrived) == len(pending):
+                timer.cancel()
+                update()
+
+    def update():
+        nonlocal arrived
+        if arrived is None:
+            return
+
+        settled, arrived = arrived, None
+        if not util.events.async_event_queue.submit(
+                _async_update_progressive, posts, texts, summaries,
+                settled, message, client, logger, start, posted):
+            logger.warning('Event queue full, not updating replies')
+
+    timer = asyncio.get_event_loop().call_later(budget, update)
+    for task in pending:
+        task.add_done_callback(settle)
+
+
+def _update_progressive(posts, texts, summaries, arrived, message, client,
+                        logger, start, posted):
+    """Update the posts of texts with the summaries in arrived, the set
+    of those looked up in time.
+    """
+    found = []
+    for summary in summaries:
+        found.append(None)
+        if summary is None:
+            continue
+        elif summary not in arrived:
+            metrics_enriched('timeout')
+        elif summary.exception() is not None:
+            logger.error("send_message: {}".format(summary.exception()))
+            metrics_enriched('failed')
+        else:
+            found[-1] = summary.result()
+            metrics_enriched('enriched')
+
+    enriched = _enriched_posts(posts, texts, found)
+    _post_each([(partial(client.chat_update, channel=post['channel'],
+                         ts=post['ts']), text)
+                for post, span, text in enriched],
+               message.get('channel'), logger,
+               partial(_updated, enriched, posts, found, start, posted))
+
+
+async def _async_update_progressive(posts, texts, summaries, arrived,
+                                    message, client, logger, start, posted):
+    found = []
+    for task, index in summaries:
+        found.append(None)
+        if task is None:
+            continue
+        elif task not in arrived:
+            metrics_enriched('timeout')
+        elif task.exception() is not None:
+            logger.error("send_message: {}".format(task.exception()))
+            metrics_enriched('failed')
+        elif isinstance(task.result()[index], Exception):
+            logger.error("send_message: {}".format(task.result()[index]))
+            metrics_enriched('failed')
+        else:
+            found[-1] = task.result()[index]
+            metrics_enriched('enriched')
+
+    enriched = _enriched_posts(posts, texts, found)
+    await _async_post_each(
+        [(partial(client.chat_update, channel=post['channel'],
+                  ts=post['ts']), text) for post, span, text in enriched],
+        message.get('channel'), logger,
+        partial(_async_updated, enriched, posts, found, start, posted))
+
+
+def _updated(enriched, posts, summaries, start, posted, responses):
+    """Report the enriched posts, (response, range, text) tuples, that
+    were updated given responses, the response to each update or None.
+    """
+    updated = [span for (post, span, text), response
+               in zip(enriched, responses) if response is not None]
+    if updated:
+        metrics_reply_time('enriched', time.monotonic() - start)
+
+    if posted:
+        posted(_enriched(posts, summaries, updated))
+
+
+async def _async_updated(enriched, posts, summaries, start, posted,
+                         responses):
+    _updated(enriched, posts, summaries, start, posted, responses)
+
+
+def _post_replies(replies, message, say, client, logger, done=None):
+    """Post the message text in replies as few posts as join_replies()
+    allows, then call done, if given, with a list of (response, count)
+    tuples of the post, or None if it failed, and the count of replies
+    it joined.
+    """
+    joined = join_replies(replies)
+    channel = message.get('channel')
+    _post_each([(say, text) for text, count in joined], channel, logger,
+               partial(_replied, joined, channel, client, done))
+
+
+async def _async_post_replies(replies, message, say, client, logger,
+                              done=None):
+    joined = join_replies(replies)
+    channel = message.get('channel')
+    await _async_post_each(
+        [(say, text) for text, count in joined], channel, logger,
+        partial(_async_replied, joined, channel, client, done))
+
+
+def _replied(joined, channel, client, done, responses):
+    posts = []
+    for (text, count), response in zip(joined, responses):
+        if response is not None:
+            startup_replied()
+            metrics_counter(channel_name(channel, client), count)
+
+        posts.append((response, count))
+
+    if done:
+        done(posts)
+
+
+async def _async_replied(joined, channel, client, done, responses):
+    posts = []
+    for (text, count), response in zip(joined, responses):
+        if response is not None:
+            startup_replied()
+            metrics_counter(await async_channel_name(channel, client),
+                            count)
+
+        posts.append((response, count))
+
+    if done:
+        done(posts)
+
+
+def _post_each(sends, channel, logger, done, responses=None, attempt=0,
+               reserved=False):
+    """Call each send(text) in sends, (send, text) tuples posting or
+    updating a post to channel, in turn once the channel's rate limit
+    allows, retrying one Slack answers 429, then call done with the
+    response of each, or None if it failed.  Rather than hold the event
+    worker while the limit delays a post, the rest are queued again once
+    it allows.
+    """
+    responses = [] if responses is None else responses
+    while len(responses) < len(sends):
+        if not reserved:
+            delay = channel_limiter.reserve(channel)
+            metrics_post_delay(delay)
+            if delay:
+                _resume(delay, _post_each, sends, channel, logger, done,
+                        responses, attempt, True)
+                return
+
+        reserved = False
+        send, text = sends[len(responses)]
+        start = time.monotonic()
+        try:
+            responses.append(send(text=text, parse='none'))
+            metrics_post_time(time.monotonic() - start)
+        except Exception as ex:
+            if _rate_limited(ex, channel, attempt):
+                attempt += 1
+                continue
+
+            logger.error("send_message: {}".format(ex))
+            responses.append(None)
+
+        attempt = 0
+
+    done(responses)
+
+
+async def _async_post_each(sends, channel, logger, done, responses=None,
+                           attempt=0, reserved=False):
+    """Coroutine version of _post_each() for a coroutine function done."""
+    responses = [] if responses is None else responses
+    while len(responses) < len(sends):
+        if not reserved:
+            delay = channel_limiter.reserve(channel)
+            metrics_post_delay(delay)
+            if delay:
+                asyncio.get_event_loop().call_later(
+                    delay, _async_resume, _async_post_each, sends, channel,
+                    logger, done, responses, attempt, True)
+                return
+
+        reserved = False
+        send, text = sends[len(responses)]
+        start = time.monotonic()
+        try:
+            responses.append(await send(text=text, parse='none'))
+            metrics_post_time(time.monotonic() - start)
+        except Exception as ex:
+            if _rate_limited(ex, channel, attempt):
+                attempt += 1
+                continue
+
+            logger.error("send_message: {}".format(ex))
+            responses.append(None)
+
+        attempt = 0
+
+    await done(responses)
+
+
+def _resume(delay, fn, *args):
+    """Queue fn(*args) on the event queue in delay seconds, running it
+    on the timer's thread instead if the queue is full by then.
+    """
+    def submit():
+        if not util.events.event_queue.submit(fn, *args):
+            fn(*args)
+
+    timer = Timer(delay, submit)
+    timer.daemon = True
+    timer.start()
+
+
+def _async_resume(fn, *args):
+    if not util.events.async_event_queue.submit(fn, *args):
+        asyncio.ensure_future(fn(*args))
+
+
+def _spans(posts):
+    """Yield the response of each of posts, a list of (response, count)
+    tuples, and the range of the texts joined into it.
+    """
+    first = 0
+    for response, count in posts:
+        yield response, range(first, first + count)
+        first += count
+
+
+def _posted(posts):
+    """Return the indexes of the texts in posts that were posted."""
+    return [n for response, span in _spans(posts) if response is not None
+            for n in span]
+
+
+def _report(posted, kept, posts):
+    """Call posted with the indexes in kept of the texts in posts that
+    were posted.
+    """
+    posted([kept[n] for n in _posted(posts)])
+
+
+def _reindexed(posted, kept, indexes):
+    posted([kept[n] for n in indexes])
+
+
+def _enriched_posts(posts, texts, summaries):
+    """Return a list of (response, range, text) tuples of the posts of
+    texts given a summary, the range of the texts joined into each, and
+    their text with the summaries added.
+    """
+    enriched = []
+    for response, span in _spans(posts):
+        if response is not None and any(summaries[n] for n in span):
+            enriched.append((response, span, SEPARATOR.join(
+                texts[n] + (summaries[n] or '') for n in span)))
+
+    return enriched
+
+
+def _enriched(posts, summaries, updated):
+    """Return the indexes of the texts with a summary whose post shows
+    it, updated or needing no update.
+    """
+    return [n for response, span in _spans(posts)
+            if response is not None and (
+                span in updated or not any(summaries[n] for n in span))
+            for n in span if summaries[n] is not None]
+
+
+def post_unfurls(unfurls, event, client, logger):
+    """Unfurl the links of link_shared event with the dict of
+    attachments by url in unfurls.
+    """
+    start = time.monotonic()
+    try:
+        client.chat_unfurl(unfurls=unfurls, **_unfurl_target(event))
+        metrics_post_time(time.monotonic() - start)
+    except Exception as ex:
+        logger.error("unfurl: {}".format(ex))
+
+
+async def async_post_unfurls(unfurls, event, client, logger):
+    """Coroutine version of post_unfurls()."""
+    start = time.monotonic()
+    try:
+        await client.chat_unfurl(unfurls=unfurls, **_unfurl_target(event))
+        metrics_post_time(time.monotonic() - start)
+    except Exception as ex:
+        logger.error("unfurl: {}".format(ex))
+
+
+def _unfurl_target(event):
+    # links shared in the message composer have no message yet
+    if event.get('unfurl_id'):
+        return {'unfurl_id': event['unfurl_id'], 'source': event['source']}
+
+    return {'channel': event.get('channel'), 'ts': event.get('message_ts')}
+
+
+def _rate_limited(ex, channel, attempt):
+    """Return True if ex is a 429 worth retrying, holding channel for
+    the Retry-After Slack sent.
+    """
+    response = getattr(ex, 'response', None)
+    if getattr(response, 'status_code', None) != 429 or \
+            attempt >= RATE_LIMIT_RETRIES:
+        return False
+
+    retry_after = 1.0
+    for key, value in (response.headers or {}).items():
+        if key.lower() == 'retry-after':
+            try:
+                retry_after = float(value)
+            except (TypeError, ValueError):
+                pass
+
+    metrics_rate_limited()
+    channel_limiter.hold(channel, retry_after)
+    return True
@@ -6,19 +6,48 @@
 """
 Utilities for working with sites behind UW SSO.
 """
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-IDP = 'https://idp.u.washington.edu/'
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+from email.utils import parsedate_to_datetime
+from threading import Lock, Timer
+from util.async_http import AsyncSession
+from util.http import BackendSession
+from util.metrics import metrics_saml_login
+import asyncio
+import logging
+import pickle
+import time
+import os
+IDP = os.environ.get('SAML_IDP', 'https://idp.u.washington.edu/')
 
 
-class UwSamlSession(requests.Session):
+logger = logging.getLogger(__name__)
+
+
+class UwSamlSession(BackendSession):
     """
-    A requests.Session that checks responses for IdP redirects.
+    A BackendSession that checks responses for IdP redirects.
+
+    Logins are serialized: requests that land on the IdP while another
+    login is underway wait for it and then replay.  With a cookie_file,
+    session cookies are saved after each login and loaded at startup, and
+    the SP session is refreshed in the background refresh_margin seconds
+    before its cookies expire or session_lifetime seconds after login.
     """
-    def __init__(self, credentials=(None, None)):
+    refresh_margin = 300
+
+    def __init__(self, credentials=(None, None), cookie_file=None,
+                 session_lifetime=None, timeout=None, retries=None):
         self._credentials = credentials
-        super(UwSamlSession, self).__init__()
+        self._cookie_file = cookie_file
+        self._session_lifetime = session_lifetime
+        self._login_lock = Lock()
+        self._logins = 0
+        self._login_time = None
+        self._refresh_url = None
+        self._refresh_timer = None
+        super(UwSamlSession, self).__init__(timeout=timeout, retries=retries)
+        self._load_cookies()
 
     def request(self, method, url, *args, **kwargs):
         """
@@ -28,32 +57,321 @@ class UwSamlSession(requests.Session):
         request.
         """
         request = super(UwSamlSession, self).request
+        logins = self._logins
         response = request(method, url, *args, **kwargs)
         for _ in range(2):
             if not response.url.startswith(IDP):
                 break
-            url, form = self._form_data(response.content)
-            if 'j_username' in form:
-                user, password = self._credentials
-                form.update({
-                    'j_username': user,
-                    'j_password': password})
-            # don't let the client override content-type
-            headers = {'Content-Type': None}
-            response = request('POST', url=url, data=form, headers=headers)
-            if response.status_code != 200:
-                raise Exception('saml login failed', response)
+            with self._login_lock:
+                if self._logins == logins:
+                    return self._login(response, method, url)
+                logins = self._logins
+            # another request logged in while this one waited, so replay
+            response = request(method, url, *args, **kwargs)
+        return response
+
+    def _login(self, response, method, url):
+        """
+        Post the IdP forms in response, returning the SP's response.
+        """
+        request = super(UwSamlSession, self).request
+        start = time.monotonic()
+        try:
+            for _ in range(2):
+                if not response.url.startswith(IDP):
+                    break
+                url, form = _login_form(response.content, self._credentials)
+                # don't let the client override content-type
+                headers = {'Content-Type': None}
+                response = request('POST', url=url, data=form,
+                                   headers=headers)
+                if response.status_code != 200:
+                    raise Exception('saml login failed', response)
+        except Exception:
+            metrics_saml_login(time.monotonic() - start, 'failed')
+            raise
+
+        metrics_saml_login(time.monotonic() - start, 'ok')
+        self._logins += 1
+        self._login_time = time.time()
+        if method == 'GET':
+            self._refresh_url = response.url
+        self._save_cookies()
+        self._schedule_refresh()
         return response
 
+    def _refresh(self):
+        """
+        Drop the SP cookies and log in again off the request path.
+        """
+        try:
+            for cookie in list(self.cookies):
+                if not _is_idp(cookie.domain):
+                    self.cookies.clear(cookie.domain, cookie.path,
+                                       cookie.name)
+            self.get(self._refresh_url)
+        except Exception as ex:
+            logger.error("saml refresh: {}".format(ex))
+
+    def _schedule_refresh(self):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+
+        delay = _refresh_delay([
+            cookie.expires for cookie in self.cookies
+            if cookie.expires and not _is_idp(cookie.domain)],
+            self._login_time, self._session_lifetime, self.refresh_margin)
+        if delay is not None and self._refresh_url:
+            self._refresh_timer = Timer(delay, self._refresh)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+
+    def _load_cookies(self):
+        if self._cookie_file and os.path.exists(self._cookie_file):
+            try:
+                with open(self._cookie_file, 'rb') as f:
+                    self.cookies.update(pickle.load(f))
+            except Exception as ex:
+                logger.error("saml cookies {}: {}".format(
+                    self._cookie_file, ex))
+
+    def _save_cookies(self):
+        if self._cookie_file:
+            _write_atomic(self._cookie_file,
+                          lambda path: _pickle(self.cookies, path))
+
     @staticmethod
     def _form_data(content):
         """
         Return a tuple of (form url, form data) from response content.
         """
-        bs = BeautifulSoup(content, 'html.parser')
-        form = bs.find('form')
+        parser = _FormParser()
+        form = parser.parse(content)
         url = urljoin(IDP, form['action'])
-        data = {element['name']: element.get('value')
-                for element in form.find_all('input')
-                if element.get('name')}
-        return url, data
+        return url, parser.inputs
+
+
+class _FormParser(HTMLParser):
+    """
+    Extract the first form's attributes and named input values from
+    an IdP page, stopping once the form is closed.  Like the tree
+    builder it replaces, an end tag closes every element opened since
+    its matching start tag.
+    """
+    void_elements = {
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+        'keygen', 'link', 'menuitem', 'meta', 'param', 'source', 'track',
+        'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image',
+        'isindex', 'nextid', 'spacer'}
+
+    class _FormClosed(Exception):
+        pass
+
+    def __init__(self):
+        super(_FormParser, self).__init__(convert_charrefs=True)
+        self.form = None
+        self.inputs = {}
+        self._open = []
+        self._form_depth = None
+
+    def parse(self, content):
+        if isinstance(content, bytes):
+            try:
+                content = content.decode('utf-8')
+            except UnicodeDecodeError:
+                content = content.decode('windows-1252', 'replace')
+        try:
+            self.feed(content)
+            self.close()
+        except self._FormClosed:
+            pass
+        if self.form is None:
+            raise ValueError('no form in IdP response')
+        return self.form
+
+    def handle_starttag(self, tag, attrs):
+        self._element(tag, attrs)
+        if tag not in self.void_elements:
+            self._open.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._element(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag not in self._open:
+            return
+
+        while self._open.pop() != tag:
+            pass
+
+        if self._form_depth is not None and (
+                len(self._open) <= self._form_depth):
+            raise self._FormClosed()
+
+    def _element(self, tag, attrs):
+        if tag == 'form' and self.form is None:
+            self.form = self._attrs(attrs)
+            self._form_depth = len(self._open)
+        elif tag == 'input' and self._form_depth is not None:
+            element = self._attrs(attrs)
+            if element.get('name'):
+                self.inputs[element['name']] = element.get('value')
+
+    @staticmethod
+    def _attrs(attrs):
+        return {name: '' if value is None else value
+                for name, value in attrs}
+
+
+class AsyncUwSamlSession(AsyncSession):
+    """
+    An AsyncSession that checks responses for IdP redirects, with the
+    single-flight login, cookie persistence and refresh of UwSamlSession.
+    """
+    refresh_margin = UwSamlSession.refresh_margin
+
+    def __init__(self, credentials=(None, None), cookie_file=None,
+                 session_lifetime=None, timeout=None, retries=None):
+        self._credentials = credentials
+        self._cookie_file = cookie_file
+        self._session_lifetime = session_lifetime
+        self._login_lock = None
+        self._logins = 0
+        self._login_time = None
+        self._refresh_url = None
+        self._refresh_handle = None
+        super(AsyncUwSamlSession, self).__init__(timeout=timeout,
+                                                 retries=retries)
+
+    async def request(self, method, url, *args, **kwargs):
+        """
+        Coroutine version of UwSamlSession.request.
+        """
+        request = super(AsyncUwSamlSession, self).request
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+
+        logins = self._logins
+        response = await request(method, url, *args, **kwargs)
+        for _ in range(2):
+            if not response.url.startswith(IDP):
+                break
+            async with self._login_lock:
+                if self._logins == logins:
+                    return await self._login(response, method)
+                logins = self._logins
+            response = await request(method, url, *args, **kwargs)
+        return response
+
+    async def _login(self, response, method):
+        request = super(AsyncUwSamlSession, self).request
+        start = time.monotonic()
+        try:
+            for _ in range(2):
+                if not response.url.startswith(IDP):
+                    break
+                url, form = _login_form(response.content, self._credentials)
+                response = await request('POST', url, data=form)
+                if response.status_code != 200:
+                    raise Exception('saml login failed', response)
+        except Exception:
+            metrics_saml_login(time.monotonic() - start, 'failed')
+            raise
+
+        metrics_saml_login(time.monotonic() - start, 'ok')
+        self._logins += 1
+        self._login_time = time.time()
+        if method == 'GET':
+            self._refresh_url = response.url
+        self._save_cookies()
+        self._schedule_refresh()
+        return response
+
+    async def _refresh(self):
+        try:
+            jar = self.session.cookie_jar
+            jar.clear(lambda cookie: not _is_idp(cookie['domain']))
+            await self.get(self._refresh_url)
+        except Exception as ex:
+            logger.error("saml refresh: {}".format(ex))
+
+    def _schedule_refresh(self):
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+
+        expires = []
+        for cookie in self.session.cookie_jar:
+            if not _is_idp(cookie['domain']):
+                if cookie['max-age']:
+                    expires.append(self._login_time + int(cookie['max-age']))
+                elif cookie['expires']:
+                    expires.append(parsedate_to_datetime(
+                        cookie['expires']).timestamp())
+        delay = _refresh_delay(expires, self._login_time,
+                               self._session_lifetime, self.refresh_margin)
+        if delay is not None and self._refresh_url:
+            self._refresh_handle = asyncio.get_running_loop().call_later(
+                delay, lambda: asyncio.ensure_future(self._refresh()))
+
+    def _cookie_jar(self):
+        import aiohttp
+
+        jar = aiohttp.CookieJar()
+        if self._cookie_file and os.path.exists(self._cookie_file):
+            try:
+                jar.load(self._cookie_file)
+            except Exception as ex:
+                logger.error("saml cookies {}: {}".format(
+                    self._cookie_file, ex))
+        return jar
+
+    def _save_cookies(self):
+        if self._cookie_file:
+            _write_atomic(self._cookie_file, self.session.cookie_jar.save)
+
+
+def _login_form(content, credentials):
+    """
+    Return a tuple of (form url, form data) from IdP response content,
+    supplying credentials to a login form.
+    """
+    url, form = UwSamlSession._form_data(content)
+    if 'j_username' in form:
+        user, password = credentials
+        form.update({
+            'j_username': user,
+            'j_password': password})
+    return url, form
+
+
+def _is_idp(domain):
+    return (domain or '').lstrip('.') == urlparse(IDP).hostname
+
+
+def _refresh_delay(expires, login_time, session_lifetime, margin):
+    """
+    Return seconds until the SP session should be refreshed, or None if
+    nothing says when it expires.
+    """
+    if login_time and session_lifetime:
+        expires = expires + [login_time + session_lifetime]
+    if not expires:
+        return None
+    return max(min(expires) - margin - time.time(), 60)
+
+
+def _pickle(obj, path):
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f)
+
+
+def _write_atomic(path, save):
+    """
+    Replace the file at path with the one save(temporary path) writes.
+    """
+    try:
+        tmp = '{}.tmp'.format(path)
+        save(tmp)
+        os.replace(tmp, path)
+    except Exception as ex:
+        logger.error("write {}: {}".format(path, ex))
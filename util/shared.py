@@ -0,0 +1,143 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class implementing a key-value store shared by linkbot processes
+"""
+from contextlib import closing
+from threading import Thread, local
+import logging
+import os
+import pickle
+import sqlite3
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class SharedStore(object):
+    """Expiring key-value store in a sqlite file, so that pre-forked
+    linkbot processes share lookups, channel names and runtime state.
+
+    Keys are strings within a namespace, values are pickled.  Each
+    process and thread opens its own connection; the database runs in
+    WAL mode so readers never wait on a writer.  Once start()ed, expired
+    values are purged every purge_interval seconds, and each namespace
+    is cut to the size values expiring last.
+    """
+    def __init__(self, path, size=100000, purge_interval=60):
+        self.path = path
+        self.size = size
+        self.purge_interval = purge_interval
+        self._local = local()
+
+        # don't hold a connection a fork would copy
+        with closing(sqlite3.connect(self.path)) as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT,'
+                ' value BLOB, expires REAL, PRIMARY KEY (namespace, key))')
+
+    def get(self, namespace, key):
+        """Return the value stored for key, raising KeyError if there is
+        none or it has expired.
+        """
+        return self.entry(namespace, key)[0]
+
+    def entry(self, namespace, key):
+        """Return a tuple of the value stored for key and the time.time()
+        it expires, raising KeyError if there is none or it has expired.
+        """
+        row = self._db().execute(
+            'SELECT value, expires FROM kv WHERE namespace = ? AND key = ?'
+            ' AND expires > ?', (namespace, str(key), time.time())).fetchone()
+        if row is None:
+            raise KeyError(key)
+
+        return pickle.loads(row[0]), row[1]
+
+    def items(self, namespace):
+        """Return a list of (key, value, expires) tuples for the unexpired
+        values in namespace.
+        """
+        rows = self._db().execute(
+            'SELECT key, value, expires FROM kv WHERE namespace = ?'
+            ' AND expires > ?', (namespace, time.time())).fetchall()
+        return [(key, pickle.loads(value), expires)
+                for key, value, expires in rows]
+
+    def put(self, namespace, key, value, ttl):
+        """Store value for key for ttl seconds."""
+        self._db().execute(
+            'INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)',
+            (namespace, str(key), pickle.dumps(value), time.time() + ttl))
+
+    def add(self, namespace, key, value, ttl):
+        """Store value for key for ttl seconds unless an unexpired value
+        is already stored, returning True if value was stored.
+        """
+        now = time.time()
+        cursor = self._db().execute(
+            'INSERT INTO kv VALUES (?, ?, ?, ?)'
+            ' ON CONFLICT (namespace, key) DO UPDATE SET'
+            ' value = excluded.value, expires = excluded.expires'
+            ' WHERE kv.expires <= ?',
+            (namespace, str(key), pickle.dumps(value), now + ttl, now))
+        return cursor.rowcount > 0
+
+    def delete(self, namespace, key):
+        self._db().execute(
+            'DELETE FROM kv WHERE namespace = ? AND key = ?',
+            (namespace, str(key)))
+
+    def clear(self, namespace):
+        self._db().execute('DELETE FROM kv WHERE namespace = ?', (namespace,))
+
+    def purge(self):
+        """Delete expired values, then those past size in each namespace
+        that expire first.
+        """
+        db = self._db()
+        db.execute('DELETE FROM kv WHERE expires <= ?', (time.time(),))
+        for namespace, in db.execute(
+                'SELECT namespace FROM kv GROUP BY namespace'
+                ' HAVING COUNT(*) > ?', (self.size,)).fetchall():
+            db.execute(
+                'DELETE FROM kv WHERE rowid IN (SELECT rowid FROM kv'
+                ' WHERE namespace = ? ORDER BY expires DESC'
+                ' LIMIT -1 OFFSET ?)', (namespace, self.size))
+
+    def start(self):
+        """Purge every purge_interval seconds in a background thread.
+        One process purging is enough.
+        """
+        Thread(target=self._purge_periodically, daemon=True,
+               name='purge').start()
+
+    def _purge_periodically(self):
+        while True:
+            time.sleep(self.purge_interval)
+            try:
+                self.purge()
+            except Exception as ex:
+                logger.error("purge {}: {}".format(self.path, ex))
+
+    def _db(self):
+        # connections can't cross a fork or, by default, a thread
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+
+        return self._local.db
+
+
+shared_store = None
+
+
+def init_shared_store(path, size=100000, purge_interval=60):
+    global shared_store
+
+    shared_store = SharedStore(path, size=size, purge_interval=purge_interval)
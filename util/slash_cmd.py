@@ -6,7 +6,10 @@
 """
 Class implementing linkbot Slack slash command
 """
+from types import SimpleNamespace
+from util.stats import linkbot_stats
 import logging
+import time
 
 
 class SlashCommand:
@@ -24,19 +27,81 @@ class SlashCommand:
          'description': "*quips [on|off|reset]* Control link quip display"},
         {'name': ['links'],
          'method': 'op_links',
-         'description': "*links* Show links I'm looking for"}
+         'description': "*links* Show links I'm looking for"},
+        {'name': ['stats'],
+         'method': 'op_stats',
+         'description': "*stats* Show match, lookup and queue stats"}
     ]
 
     _client = None
     _channel_id = None
     _user_id = None
 
+    # seconds between checks for state set by another process
+    sync_interval = 1
+    state_ttl = 10 * 365 * 86400
+
     def __init__(self, *args, **kwargs):
         self._bot_list = kwargs.get('bot_list', [])
         self._logger = kwargs.get('logger', logging.getLogger(__name__))
+        self._store = kwargs.get('store')
+        self._state = {'debug': None, 'quip': None, 'quip_resets': 0}
+        self._synced = 0
+
+    def sync(self):
+        """
+        Apply debug and quip state set by a command handled by another
+        process sharing the store
+        """
+        now = time.monotonic()
+        if self._store is None or now < self._synced + self.sync_interval:
+            return
+
+        self._synced = now
+        try:
+            state = self._store.get('state', self.name)
+        except KeyError:
+            return
+        except Exception as ex:
+            self._logger.error("{} sync: {}".format(self.name, ex))
+            return
+
+        if state == self._state:
+            return
+
+        if state['debug'] is not None:
+            self._logger.setLevel(
+                logging.DEBUG if state['debug'] else logging.INFO)
+        if state['quip'] is not None:
+            for bot in self._bot_list:
+                bot.quip = state['quip']
+        if state['quip_resets'] != self._state['quip_resets']:
+            for bot in self._bot_list:
+                bot.quip_reset()
+
+        self._state = state
 
     def command(self, command, client, ack):
         ack()
+        self._command(command, client)
+
+    async def async_command(self, command, client, ack):
+        """
+        Coroutine version of command for AsyncApp, posting the operation's
+        replies once it completes
+        """
+        await ack()
+
+        posts = []
+        self._command(command, SimpleNamespace(
+            chat_postEphemeral=lambda **kwargs: posts.append(kwargs)))
+        for post in posts:
+            await client.chat_postEphemeral(**post)
+
+    def _command(self, command, client):
+        # start from the latest shared state
+        self._synced = 0
+        self.sync()
 
         self._client = client
         self._channel_id = command.get('channel_id')
@@ -58,8 +123,10 @@ class SlashCommand:
     def op_debug(self, argv):
         if argv[0]:
             try:
-                self._logger.setLevel(logging.DEBUG if (
-                    self._boolean(argv[0])) else logging.INFO)
+                debug = self._boolean(argv[0])
+                self._logger.setLevel(
+                    logging.DEBUG if debug else logging.INFO)
+                self._publish(debug=debug)
             except Exception as ex:
                 self._post("{} debug: {}".format(self.name, ex))
 
@@ -73,6 +140,7 @@ class SlashCommand:
                 for bot in self._bot_list:
                     bot.quip_reset()
 
+                self._publish(quip_resets=self._state['quip_resets'] + 1)
                 self._post("linkbot quips have been reset")
             else:
                 try:
@@ -80,6 +148,7 @@ class SlashCommand:
                     for bot in self._bot_list:
                         bot.quip = sense
 
+                    self._publish(quip=sense)
                     self._post("Linkbot turned {} quips".format(
                         self._boolean_state(sense)))
                 except Exception as ex:
@@ -105,6 +174,32 @@ class SlashCommand:
         else:
             self._post("unrecognized links option")
 
+    def op_stats(self, argv):
+        bots, queues = linkbot_stats([bot.name() for bot in self._bot_list])
+        lines = []
+        for name, stats in bots.items():
+            cache = stats['cached'] + stats['uncached']
+            lines.append(
+                "*{}* {:.0f} matched, {:.0f} lookups p50 {} p95 {}, "
+                "{} cache hits, {} errors".format(
+                    name, stats['matched'], stats['lookups'],
+                    self._milliseconds(stats['p50']),
+                    self._milliseconds(stats['p95']),
+                    self._percent(stats['cached'], cache),
+                    self._percent(stats['errors'], stats['lookups'])))
+
+        lines.append("*queues* {:.0f} events, {:.0f} lookups waiting".format(
+            queues['events'], queues['lookups']))
+        self._indented_list('Linkbot stats since startup', lines)
+
+    def _publish(self, **state):
+        """
+        Share state changed by this process with the other processes
+        """
+        self._state = dict(self._state, **state)
+        if self._store is not None:
+            self._store.put('state', self.name, self._state, self.state_ttl)
+
     def _indented_list(self, title, l, indent="> "):
         delim = "\n{}".format(indent)
         self._post("{}:{}{}".format(title, delim, delim.join(l)))
@@ -124,3 +219,9 @@ class SlashCommand:
 
     def _boolean_state(self, value):
         return 'on' if value else 'off'
+
+    def _milliseconds(self, seconds):
+        return '-' if seconds is None else '{:.0f}ms'.format(seconds * 1000)
+
+    def _percent(self, count, total):
+        return '-' if not total else '{:.0%}'.format(count / total)
@@ -0,0 +1,116 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Class saving the lookup caches and channel names to disk so that a
+restarted linkbot starts warm
+"""
+from threading import Thread
+from util.metrics import metrics_snapshot, metrics_snapshot_load
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot(object):
+    """Periodic snapshot of the bots' lookup caches and the channel
+    directory in the file at path.
+
+    The file is a magic string and format version followed by a zlib
+    compressed pickle of every entry with its expiry time, so restored
+    entries expire when they would have.  It's written to a temporary
+    file renamed into place, so a reader never sees part of one.  A file
+    that is corrupt, or of another format version, is skipped.
+    """
+    magic = b'linkbot-snapshot'
+    version = 2
+    _header = struct.Struct('!16sH')
+
+    def __init__(self, path, interval=300):
+        self.path = path
+        self.interval = interval
+
+    def save(self, caches, channels):
+        """Write the entries of caches, a dict of LookupCache by name, and
+        of the ChannelDirectory channels to the snapshot file.
+        """
+        start = time.monotonic()
+        data = zlib.compress(pickle.dumps({
+            'saved': time.time(),
+            'caches': {name: cache.snapshot()
+                       for name, cache in caches.items()},
+            'channels': channels.snapshot(),
+        }, protocol=pickle.HIGHEST_PROTOCOL))
+
+        temp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(self._header.pack(self.magic, self.version))
+            f.write(data)
+
+        os.replace(temp, self.path)
+        metrics_snapshot('save', time.monotonic() - start,
+                         self._header.size + len(data))
+
+    def load(self, caches, channels):
+        """Restore the unexpired entries of the snapshot file into caches,
+        a dict of LookupCache by name, and the ChannelDirectory channels.
+        """
+        start = time.monotonic()
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            metrics_snapshot_load('missing')
+            return
+        except OSError as ex:
+            logger.error("snapshot {}: {}".format(self.path, ex))
+            metrics_snapshot_load('corrupt')
+            return
+
+        try:
+            magic, version = self._header.unpack_from(raw)
+            if magic != self.magic:
+                raise ValueError('not a snapshot')
+            if version != self.version:
+                logger.warning("snapshot {}: skipping format {}".format(
+                    self.path, version))
+                metrics_snapshot_load('old_format')
+                return
+
+            snapshot = pickle.loads(zlib.decompress(raw[self._header.size:]))
+        except Exception as ex:
+            logger.warning("snapshot {}: skipping: {}".format(self.path, ex))
+            metrics_snapshot_load('corrupt')
+            return
+
+        restored = 0
+        for name, entries in snapshot['caches'].items():
+            if name in caches:
+                restored += caches[name].restore(entries)
+
+        restored += channels.restore(snapshot['channels'])
+        metrics_snapshot('load', time.monotonic() - start, len(raw))
+        metrics_snapshot_load('ok')
+        logger.info("restored {} entries from {} in {:.1f}s".format(
+            restored, self.path, time.monotonic() - start))
+
+    def start(self, caches, channels):
+        """Save a snapshot every interval seconds in a background
+        thread.
+        """
+        Thread(target=self._save_periodically, args=(caches, channels),
+               daemon=True, name='snapshot').start()
+
+    def _save_periodically(self, caches, channels):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save(caches, channels)
+            except Exception as ex:
+                logger.error("snapshot {}: {}".format(self.path, ex))
@@ -0,0 +1,75 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Functions timing linkbot startup
+"""
+from util.metrics import metrics_startup
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def _uptime():
+    """
+    Return seconds since boot, or a monotonic time where boot time
+    isn't available
+    """
+    if hasattr(time, 'CLOCK_BOOTTIME'):
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+
+    return time.monotonic()
+
+
+def _process_start():
+    """
+    Return the _uptime() at which this process started, or now if the
+    platform doesn't say
+    """
+    try:
+        if hasattr(time, 'CLOCK_BOOTTIME'):
+            with open('/proc/self/stat') as f:
+                ticks = int(f.read().rpartition(')')[2].split()[19])
+            return ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return _uptime()
+
+
+# forked workers inherit their parent's start
+started = _process_start()
+_replied = False
+
+
+def startup_elapsed():
+    """
+    Return the seconds since the process started, or since its parent
+    started for a forked worker
+    """
+    return _uptime() - started
+
+
+def startup_listening():
+    """
+    Report the time to serve events
+    """
+    elapsed = startup_elapsed()
+    metrics_startup('listen', elapsed)
+    logger.info("listening {:.2f}s after start".format(elapsed))
+
+
+def startup_replied():
+    """
+    Report the time to the first reply, once
+    """
+    global _replied
+
+    if not _replied:
+        _replied = True
+        elapsed = startup_elapsed()
+        metrics_startup('first_reply', elapsed)
+        logger.info("first reply {:.2f}s after start".format(elapsed))
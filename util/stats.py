@@ -0,0 +1,73 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Functions summarizing linkbot's metrics for the stats slash command
+"""
+from collections import defaultdict
+from util.metrics import metrics_samples
+
+
+def linkbot_stats(bot_names):
+    """
+    Return a dict of per-bot stats by bot name, for the bots in
+    bot_names, and a dict of queue depths, from the metrics collected
+    since startup
+    """
+    bots = {name: {'matched': 0, 'lookups': 0, 'errors': 0, 'cached': 0,
+                   'uncached': 0, 'buckets': defaultdict(float)}
+            for name in bot_names}
+    queues = {'events': 0, 'lookups': 0}
+    for sample in metrics_samples():
+        bot = bots.get(sample.labels.get('bot'))
+        if sample.name == 'event_queue_depth':
+            queues['events'] += sample.value
+        elif sample.name == 'lookup_queue_depth':
+            queues['lookups'] += sample.value
+        elif bot is None:
+            continue
+        elif sample.name == 'match_count_total':
+            bot['matched'] += sample.value
+        elif sample.name == 'lookup_seconds_count':
+            bot['lookups'] += sample.value
+            if sample.labels['outcome'] in ('error', 'circuit_open'):
+                bot['errors'] += sample.value
+        elif sample.name == 'lookup_seconds_bucket':
+            bot['buckets'][float(sample.labels['le'])] += sample.value
+        elif sample.name == 'lookup_cache_count_total':
+            event = sample.labels['event']
+            if event in ('hit', 'stale'):
+                bot['cached'] += sample.value
+            elif event == 'miss':
+                bot['uncached'] += sample.value
+
+    for bot in bots.values():
+        buckets = sorted(bot.pop('buckets').items())
+        bot['p50'] = bucket_quantile(buckets, 0.5)
+        bot['p95'] = bucket_quantile(buckets, 0.95)
+
+    return bots, queues
+
+
+def bucket_quantile(buckets, q):
+    """
+    Return the q quantile of a histogram's sorted (upper bound,
+    cumulative count) buckets, interpolated within its bucket as
+    Prometheus' histogram_quantile does, or None if it is empty
+    """
+    if not buckets or not buckets[-1][1]:
+        return None
+
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+
+            return lower + (bound - lower) * (
+                (rank - below) / (count - below) if count > below else 1)
+
+        lower, below = bound, count
+
+    return lower
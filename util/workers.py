@@ -0,0 +1,137 @@
+# Copyright 2023 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Functions and class providing a bounded pool for linkbot lookups
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from util.metrics import metrics_lookup_queued, metrics_lookup_started
+import asyncio
+import time
+
+
+class LookupPool(object):
+    """Thread pool fanning out backend lookups, allowing at most
+    host_limit lookups against any one backend host at a time.  Lookups
+    past a host's limit wait in that host's queue rather than on a
+    worker, so a slow host can't hold workers other hosts need.
+    """
+    def __init__(self, max_workers=8, host_limit=4):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='lookup')
+        self._host_limit = host_limit
+        self._running = {}
+        self._waiting = {}
+        self._lock = Lock()
+
+    def submit(self, host, fn, *args):
+        """Return a Future for fn(*args) run against host."""
+        lookup = (Future(), fn, args, time.monotonic())
+        metrics_lookup_queued()
+        with self._lock:
+            running = self._running.get(host, 0)
+            if running >= self._host_limit:
+                self._waiting.setdefault(host, deque()).append(lookup)
+                return lookup[0]
+
+            self._running[host] = running + 1
+
+        self._dispatch(host, lookup)
+        return lookup[0]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _dispatch(self, host, lookup):
+        try:
+            self._executor.submit(self._run, host, lookup)
+        except RuntimeError as ex:
+            # shut down
+            lookup[0].set_exception(ex)
+            self._next(host)
+
+    def _run(self, host, lookup):
+        future, fn, args, queued = lookup
+        metrics_lookup_started(host, time.monotonic() - queued)
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as ex:
+                    future.set_exception(ex)
+        finally:
+            self._next(host)
+
+    def _next(self, host):
+        """Start the next lookup waiting on host, if any."""
+        with self._lock:
+            waiting = self._waiting.get(host)
+            if not waiting:
+                self._running[host] -= 1
+                return
+
+            lookup = waiting.popleft()
+
+        self._dispatch(host, lookup)
+
+
+lookup_pool = None
+lookup_host_limit = 4
+_async_semaphores = {}
+
+
+def init_lookup_pool(max_workers, host_limit):
+    global lookup_pool, lookup_host_limit
+
+    lookup_pool = LookupPool(max_workers=max_workers, host_limit=host_limit)
+    lookup_host_limit = host_limit
+
+
+def submit_lookup(host, fn, *args):
+    """
+    Return a Future for fn(*args), run on the lookup pool when there is
+    one and host names a backend, otherwise run inline
+    """
+    if lookup_pool and host:
+        return lookup_pool.submit(host, fn, *args)
+
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as ex:
+        future.set_exception(ex)
+
+    return future
+
+
+def chain_future(source, target):
+    """
+    Copy the outcome of the source future to the target future once done
+    """
+    def done(future):
+        try:
+            target.set_result(future.result())
+        except Exception as ex:
+            target.set_exception(ex)
+
+    source.add_done_callback(done)
+
+
+async def await_lookup(host, fn, *args):
+    """
+    Await fn(*args), allowing at most lookup_host_limit concurrent
+    lookups against host
+    """
+    if not host:
+        return await fn(*args)
+
+    if host not in _async_semaphores:
+        _async_semaphores[host] = asyncio.Semaphore(lookup_host_limit)
+
+    queued = time.monotonic()
+    metrics_lookup_queued()
+    async with _async_semaphores[host]:
+        metrics_lookup_started(host, time.monotonic() - queued)
+        return await fn(*args)